@@ -6,18 +6,35 @@ import os
 import re
 import time
 import usb.core
-import usb.util
 import threading
-import queue
-import platform
-import inspect
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
-                             QLabel, QLineEdit, QPushButton, QFileDialog, QTextEdit,
-                             QGroupBox, QGridLayout, QMessageBox, QProgressBar, QListWidget,
-                             QSplitter, QComboBox, QCheckBox, QFrame, QSizePolicy)
-from PyQt5.QtCore import Qt, QThread, pyqtSignal, QDir
+                              QLabel, QLineEdit, QPushButton, QFileDialog, QPlainTextEdit,
+                              QGroupBox, QGridLayout, QMessageBox, QProgressBar,
+                              QListView, QTableWidget, QTableWidgetItem, QHeaderView, QSplitter, QComboBox, QCheckBox, QFrame, QSizePolicy)
+from PyQt5.QtCore import Qt, QThread, pyqtSignal, QDir, QTimer, QAbstractListModel, QModelIndex
 from PyQt5.QtGui import QFont, QPalette, QColor
 
+# 发送引擎、文件搜索/索引和设备管理均在不依赖Qt的find_send_engine模块中，命令行工具共用
+from find_send_engine import (TRANSFER_MODE_BULK, TRANSFER_MODE_LEGACY, TRANSFER_MODE_WINDOW,
+                              DEFAULT_TRANSFER_SIZE, DEFAULT_QUEUE_DEPTH, DEFAULT_READ_AHEAD_DEPTH,
+                              DEFAULT_READ_AHEAD_CHUNK, LOG_TRACE, LOG_DEBUG, LOG_INFO, LOG_WARNING,
+                              LOG_ERROR, LOG_LEVEL_NAMES, LOG_BUFFER_CAPACITY, LOG_FLUSH_INTERVAL,
+                              MATCH_SUBSTRING, MATCH_GLOB, MATCH_REGEX, DEVICE_POLL_INTERVAL,
+                              HEX_DUMP_WIDTH, SORT_NONE, SORT_NAME, SORT_SIZE, SORT_MTIME,
+                              SearchOptions, SharedFileData, format_log_entry, LogBuffer,
+                              AsyncLogFileWriter, format_size, format_duration, format_hex,
+                              HexDumpBuffer, make_name_matcher, filter_search_results,
+                              SearchResultStore, ParallelDirectoryWalker, FileIndex,
+                              usb_backend_available, device_label, endpoint_max_packet_size,
+                              DeviceRegistry, DeviceSessionPool, TransferEngine,
+                              default_digest_cache, format_digest, METRICS_DIR, TRACE_DIR,
+                              SESSION_DIR, request_profile)
+
+# 包大小/批量传输大小下拉框中的自动选项
+PACKET_SIZE_AUTO = "自动"
+TRANSFER_SIZE_AUTO = "自动调优"
+
+
 # 自定义UI组件
 class RoundedButton(QPushButton):
     def __init__(self, text, parent=None):
@@ -73,166 +90,215 @@ class HighlightLabel(QLabel):
         """)
 
 class UsbTransferThread(QThread):
+    """在后台运行发送引擎(TransferEngine)，把引擎回调转换为Qt信号"""
     update_progress = pyqtSignal(int)
+    progress_stats = pyqtSignal(object)
+    overall_stats = pyqtSignal(object)
+    file_started = pyqtSignal(int, int, str)
     update_status = pyqtSignal(str)
-    log_message = pyqtSignal(str)
     transfer_complete = pyqtSignal()
     error_occurred = pyqtSignal(str)
     data_received = pyqtSignal(bytes)
 
-    def __init__(self, vid, pid, interface, ep_in, ep_out, file_path, packet_size=64,auto_read=False):
+    def __init__(self, *args, **kwargs):
+        """参数与TransferEngine相同(回调参数除外)"""
         super().__init__()
-        self.vid = vid
-        self.pid = pid
-        self.interface = interface
-        self.ep_in = ep_in
-        self.ep_out = ep_out
-        self.file_path = file_path
-        self.packet_size = packet_size
-        self.is_cancelled = False
-        self.usb_device = None
-        self.data_queue = queue.Queue()
-        self.auto_read = auto_read
+        self.engine = TransferEngine(*args, on_status=self.update_status.emit,
+                                     on_file_started=self.file_started.emit,
+                                     on_progress=self.progress_stats.emit,
+                                     on_overall_progress=self.emit_overall_progress,
+                                     on_data=self.data_received.emit, **kwargs)
+
+    def emit_overall_progress(self, progress):
+        self.update_progress.emit(progress.percent)
+        self.overall_stats.emit(progress)
 
     def run(self):
         try:
-            # 转换VID/PID为整数
-            vid_int = int(self.vid, 16)
-            pid_int = int(self.pid, 16)
-            interface_num = int(self.interface)
-            
-            # 查找USB设备
-            self.update_status.emit("正在连接USB设备...")
-            self.log_message.emit(f"尝试连接设备: VID=0x{self.vid}, PID=0x{self.pid}, 接口={self.interface}, 输入端点={hex(self.ep_in)}, 输出端点={hex(self.ep_out)}")
-            
-            self.usb_device = usb.core.find(idVendor=vid_int, idProduct=pid_int)
-            if self.usb_device is None:
-                raise ValueError("未找到指定的USB设备")
-            
-            # 配置设备
-            print(f"当前平台: {platform.system()}")
-            if platform.system() == 'Windows':
-                print('当前运行的系统是 Windows')
-            else:
-                print('当前运行的系统不是 Windows')
-
-#            if self.usb_device.is_kernel_driver_active(interface_num):
-#                self.usb_device.detach_kernel_driver(interface_num)
-                
-            configuration = self.usb_device.get_active_configuration()
-            interface = configuration[(interface_num, 0)]
-            
-            # 获取端点
-            ep_in = usb.util.find_descriptor(
-                interface,
-                custom_match=lambda e: \
-                    usb.util.endpoint_direction(e.bEndpointAddress) == \
-                    usb.util.ENDPOINT_IN and \
-                    e.bEndpointAddress == self.ep_in
-            )
-            
-            ep_out = usb.util.find_descriptor(
-                interface,
-                custom_match=lambda e: \
-                    usb.util.endpoint_direction(e.bEndpointAddress) == \
-                    usb.util.ENDPOINT_OUT and \
-                    e.bEndpointAddress == self.ep_out
-            )
-            
-            if ep_in is None or ep_out is None:
-                raise ValueError("无法找到指定的端点")
-            
-            # 获取文件大小
-            file_size = os.path.getsize(self.file_path)
-            bytes_sent = 0
-            
-            self.update_status.emit(f"开始发送文件: {os.path.basename(self.file_path)}")
-            self.log_message.emit(f"文件大小: {file_size} 字节 | 包大小: {self.packet_size} 字节")
-            
-            # 创建接收数据的线程
-            if self.auto_read :
-                self.log_message.emit("自动读取已启用，启动接收线程")
-                receive_thread = threading.Thread(target=self.receive_data, args=(ep_in,))
-                receive_thread.daemon = False  # 修改为非守护线程 True
-                receive_thread.start()
-            else:
-                self.log_message.emit("自动读取未启用，接收线程不会启动")
-
-            # 发送文件数据
-            print(self.file_path)
-            with open(self.file_path, 'rb') as file:
-                while not self.is_cancelled:
-                    chunk = file.read(self.packet_size)
-                    if not chunk:
-                        break
-                    
-                    # 发送数据到输出端点
-                    #print(f"发送数据: {chunk.hex()}")
-                    self.send_data(ep_out, chunk)
-                    bytes_sent += len(chunk)
-                    
-                    # 更新进度
-                    progress = int((bytes_sent / file_size) * 100)
-                    self.update_progress.emit(progress)
-                    
-                    # 添加一点延迟以防止USB过载
-                    time.sleep(0.01)
-            
-            if not self.is_cancelled:
-                self.update_status.emit("文件发送完成!")
-                self.log_message.emit(f"成功发送 {bytes_sent} 字节")
-                self.transfer_complete.emit()
-        
+            self.engine.run()
         except Exception as e:
             self.error_occurred.emit(f"传输错误: {str(e)}")
-            self.log_message.emit(f"错误: {str(e)}")
-        finally:
-            # 清理资源
-            self.is_cancelled = True
-            #if self.usb_device:
-                #usb.util.dispose_resources(self.usb_device)
-    
-    def send_data(self, ep_out, data):
-        """发送数据到USB设备"""
-        print(f"{inspect.currentframe().f_code.co_name},line={inspect.currentframe().f_lineno}")
-        try:
-            # 如果数据长度小于包大小，补齐
-            if len(data) < self.packet_size:
-                data += b'\x00' * (self.packet_size - len(data))
-            
-            #print(data)  # 调试输出数据内容
-            self.log_message.emit(f"发送数据(16进制): {data.hex()}")
-            # 发送数据
-            ep_out.write(data)
-            
-        except usb.core.USBError as e:
-            if e.errno != 110:  # 忽略超时错误
-                raise
-    
-    def receive_data(self, ep_in):
-        """在后台线程中持续接收USB数据"""
-        print(f"{inspect.currentframe().f_code.co_name},line={inspect.currentframe().f_lineno}")
+        else:
+            if self.engine.completed:
+                self.transfer_complete.emit()
+
+    def cancel(self):
+        self.engine.cancel()
+
+
+class DeviceMonitorThread(QThread):
+    """后台枚举USB设备并定期对比，发现设备插拔时通知界面"""
+    devices_changed = pyqtSignal(list, list)
+    error_occurred = pyqtSignal(str)
+
+    def __init__(self, registry, interval=DEVICE_POLL_INTERVAL):
+        super().__init__()
+        self.registry = registry
+        self.interval = interval
+        self._wakeup = threading.Event()
+        self._stopped = False
+
+    def run(self):
+        first = True
+        while not self._stopped:
+            try:
+                added, removed = self.registry.poll()
+                if added or removed or first:
+                    self.devices_changed.emit(added, removed)
+                first = False
+            except Exception as e:
+                self.error_occurred.emit(f"扫描USB设备错误: {str(e)}")
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def refresh_now(self):
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+
+class FileIndexThread(QThread):
+    """后台加载/建立/增量刷新文件索引，完成后通知界面重新查询"""
+    index_ready = pyqtSignal(object, bool)
+    error_occurred = pyqtSignal(str)
+
+    def __init__(self, index, log_buffer):
+        super().__init__()
+        self.index = index
+        self.log_buffer = log_buffer
+
+    def run(self):
         try:
-            while not self.is_cancelled:
-                # 尝试从输入端点读取数据
-                try:
-                    data = ep_in.read(self.packet_size, timeout=100)
-                    if data:
-                        self.data_received.emit(bytes(data))
-                except usb.core.USBError as e:
-                    if e.errno != 110:  # 忽略超时错误
-                        self.log_message.emit(f"读取错误: {str(e)}")
-                time.sleep(0.01)
+            started = time.perf_counter()
+            if not self.index.ready:
+                if self.index.load():
+                    self.log_buffer.log(LOG_INFO, f"已加载文件索引: {self.index.root} ({self.index.file_count} 个文件)")
+                    # 加载后先把磁盘上的变化补上
+                    self.index.refresh()
+                else:
+                    self.log_buffer.log(LOG_INFO, f"正在建立文件索引: {self.index.root}")
+                    self.index.build()
+                changed = True
+                if self.index.start_watching():
+                    self.log_buffer.log(LOG_DEBUG, "已启用inotify监视索引目录")
+            else:
+                changed = self.index.refresh()
+            if changed:
+                self.index.save()
+                self.log_buffer.log(LOG_DEBUG, f"索引已更新: {self.index.file_count} 个文件，"
+                                               f"耗时 {time.perf_counter() - started:.2f}s")
+            self.index_ready.emit(self.index, changed)
         except Exception as e:
-            self.log_message.emit(f"接收线程错误: {str(e)}")
-    
+            self.error_occurred.emit(f"建立文件索引时出错: {str(e)}")
+
+
+class SearchResultModel(QAbstractListModel):
+    """搜索结果列表模型：视图只请求可见行的数据，不为每个结果创建条目对象"""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.store = SearchResultStore()
+        self.sort_key = SORT_NONE
+        self.descending = False
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.store)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = index.row()
+        if role == Qt.DisplayRole:
+            return self.store.path(row)
+        if role == Qt.ToolTipRole:
+            size = self.store.size(row)
+            modified = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.store.mtime(row)))
+            return f"{format_size(size) if size is not None else '未知大小'} | 修改时间 {modified}"
+        return None
+
+    def append_results(self, results):
+        if not results:
+            return
+        first = len(self.store)
+        self.beginInsertRows(QModelIndex(), first, first + len(results) - 1)
+        self.store.extend(results)
+        self.endInsertRows()
+
+    def clear(self):
+        self.beginResetModel()
+        self.store.clear()
+        self.endResetModel()
+
+    def sort_by(self, key, descending=False):
+        self.sort_key = key
+        self.descending = descending
+        self.layoutAboutToBeChanged.emit()
+        self.store.sort(key, descending)
+        self.layoutChanged.emit()
+
+
+class HexDumpModel(QAbstractListModel):
+    """接收数据的十六进制视图模型：只格式化视图请求的可见行"""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.buffer = HexDumpBuffer()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.buffer.row_count()
+
+    def data(self, index, role=Qt.DisplayRole):
+        if index.isValid() and role == Qt.DisplayRole:
+            return self.buffer.row(index.row())
+        return None
+
+    def append_data(self, data):
+        if not data:
+            return
+        buffer = self.buffer
+        if len(buffer) + len(data) > buffer.capacity:
+            # 需要丢弃最旧的行，所有行号都会变化，直接重置模型
+            self.beginResetModel()
+            buffer.append(data)
+            self.endResetModel()
+            return
+        old_rows = buffer.row_count()
+        partial = len(buffer) % buffer.width != 0
+        new_rows = (len(buffer) + len(data) + buffer.width - 1) // buffer.width
+        if new_rows > old_rows:
+            self.beginInsertRows(QModelIndex(), old_rows, new_rows - 1)
+            buffer.append(data)
+            self.endInsertRows()
+        else:
+            buffer.append(data)
+        if partial:
+            # 原来未满的末行被补齐，通知视图重绘该行
+            last = self.index(old_rows - 1)
+            self.dataChanged.emit(last, last)
+
+    def clear(self):
+        self.beginResetModel()
+        self.buffer.clear()
+        self.endResetModel()
+
+
+class FileSearchThread(QThread):
+    """在后台并行遍历目录，分批把匹配结果推送给界面"""
+    results_found = pyqtSignal(list)
+    search_finished = pyqtSignal(int, bool)
+
+    def __init__(self, root, match, options):
+        super().__init__()
+        self.walker = ParallelDirectoryWalker(root, match, options, on_batch=self.results_found.emit)
+
+    def run(self):
+        found = self.walker.run()
+        self.search_finished.emit(found, self.walker.cancelled)
+
     def cancel(self):
-        print(f"{inspect.currentframe().f_code.co_name}: line {inspect.currentframe().f_lineno}: ")
-        self.is_cancelled = True
-        self.update_status.emit("操作已取消")
-        # 立即释放资源
-        if self.usb_device:
-            usb.util.dispose_resources(self.usb_device)
+        self.walker.cancel()
 
 
 class UsbTransferApp(QMainWindow):
@@ -272,7 +338,7 @@ class UsbTransferApp(QMainWindow):
                 background-color: #4a86e8;
                 width: 10px;
             }
-            QTextEdit {
+            QTextEdit, QPlainTextEdit {
                 border: 1px solid #cccccc;
                 border-radius: 4px;
                 font-family: Consolas, Courier New;
@@ -281,8 +347,30 @@ class UsbTransferApp(QMainWindow):
         """)
         
         # 初始化USB设备列表
-        self.usb_devices = []
+        self.device_registry = DeviceRegistry()
+        self.device_monitor = None
+        self.session_pool = DeviceSessionPool()
         self.selected_file = ""
+        self.selected_files = []
+        self.batch_position = (0, 0)
+        
+        # 群发：每个设备一个传输线程，按(bus, 地址)记录
+        self.fanout_threads = {}
+        self.fanout_rows = {}
+        self.fanout_failed = set()
+        
+        # 文件名索引(按根目录)与后台索引线程
+        self.file_indexes = {}
+        self.index_thread = None
+        self.search_thread = None
+        self.stopped_search_threads = []
+        self.pending_query = None
+        self.result_root = ""
+        self.search_keyword = ""
+        
+        # 日志缓冲区：所有线程写入，界面定时批量刷新
+        self.log_buffer = LogBuffer()
+        self.log_file_writer = None
         
         # 初始化UI
         self.init_ui()
@@ -326,20 +414,75 @@ class UsbTransferApp(QMainWindow):
         self.search_edit = QLineEdit()
         self.search_edit.setPlaceholderText("输入文件名关键字")
         
+        self.search_edit.returnPressed.connect(self.search_files)
+        
+        # 匹配方式与是否使用索引
+        self.match_mode = QComboBox()
+        self.match_mode.addItem("包含", MATCH_SUBSTRING)
+        self.match_mode.addItem("通配符", MATCH_GLOB)
+        self.match_mode.addItem("正则", MATCH_REGEX)
+        self.use_index = QCheckBox("使用索引")
+        self.use_index.setChecked(True)
+        
         search_btn = RoundedButton("搜索文件")
         search_btn.clicked.connect(self.search_files)
         
         search_layout.addWidget(QLabel("文件名过滤:"), 1)
         search_layout.addWidget(self.search_edit, 5)
+        search_layout.addWidget(self.match_mode)
+        search_layout.addWidget(self.use_index)
         search_layout.addWidget(search_btn, 1)
         
+        # 搜索选项：最大深度、排除目录、文件大小范围，可提前剪掉整个子树
+        options_layout = QHBoxLayout()
+        self.max_depth_edit = QLineEdit()
+        self.max_depth_edit.setPlaceholderText("不限")
+        self.exclude_dirs_edit = QLineEdit(".git;.svn;__pycache__;node_modules")
+        self.exclude_dirs_edit.setPlaceholderText("以;分隔，支持通配符")
+        self.min_size_edit = QLineEdit()
+        self.min_size_edit.setPlaceholderText("最小")
+        self.max_size_edit = QLineEdit()
+        self.max_size_edit.setPlaceholderText("最大")
+        self.stop_search_btn = RoundedButton("停止搜索")
+        self.stop_search_btn.clicked.connect(self.stop_search)
+        self.stop_search_btn.setEnabled(False)
+        
+        options_layout.addWidget(QLabel("最大深度:"))
+        options_layout.addWidget(self.max_depth_edit, 1)
+        options_layout.addWidget(QLabel("排除目录:"))
+        options_layout.addWidget(self.exclude_dirs_edit, 3)
+        options_layout.addWidget(QLabel("大小(KB):"))
+        options_layout.addWidget(self.min_size_edit, 1)
+        options_layout.addWidget(QLabel("-"))
+        options_layout.addWidget(self.max_size_edit, 1)
+        options_layout.addWidget(self.stop_search_btn)
+        
+        # 结果排序
+        self.sort_combo = QComboBox()
+        for text, key, descending in (("不排序", SORT_NONE, False), ("名称↑", SORT_NAME, False),
+                                      ("名称↓", SORT_NAME, True), ("大小↑", SORT_SIZE, False),
+                                      ("大小↓", SORT_SIZE, True), ("时间↑", SORT_MTIME, False),
+                                      ("时间↓", SORT_MTIME, True)):
+            self.sort_combo.addItem(text, (key, descending))
+        self.sort_combo.currentIndexChanged.connect(self.sort_results)
+        options_layout.addWidget(QLabel("排序:"))
+        options_layout.addWidget(self.sort_combo)
+        
         # 文件列表
         file_layout.addLayout(path_layout)
         file_layout.addLayout(search_layout)
+        file_layout.addLayout(options_layout)
         
-        self.file_list = QListWidget()
+        # 结果列表：模型/视图，只渲染可见行
+        self.result_model = SearchResultModel(self)
+        self.file_list = QListView()
+        self.file_list.setModel(self.result_model)
+        self.file_list.setUniformItemSizes(True)
+        self.file_list.setLayoutMode(QListView.Batched)
         self.file_list.setMinimumHeight(180)
-        self.file_list.itemClicked.connect(self.file_selected)
+        # 可多选，多个文件按列表顺序在同一个设备会话中依次发送
+        self.file_list.setSelectionMode(QListView.ExtendedSelection)
+        self.file_list.selectionModel().selectionChanged.connect(self.selection_changed)
         file_layout.addWidget(self.file_list)
         
         # 显示选中的文件
@@ -387,13 +530,47 @@ class UsbTransferApp(QMainWindow):
         
         # 包大小设置
         self.packet_size = QComboBox()
-        self.packet_size.addItems(["8", "16", "32", "64", "128", "256"])
-        self.packet_size.setCurrentIndex(3)  # 默认64
+        self.packet_size.addItems([PACKET_SIZE_AUTO, "8", "16", "32", "64", "128", "256", "512", "1024"])
+        self.packet_size.setCurrentText("64")  # 默认64
+        
+        # 发送模式与批量传输大小
+        self.transfer_mode = QComboBox()
+        self.transfer_mode.addItem("高速批量", TRANSFER_MODE_BULK)
+        self.transfer_mode.addItem("传统节流", TRANSFER_MODE_LEGACY)
+        # ACK窗口流控：按设备在输入端点回复的确认包控制在途数据量，需要勾选“发送后自动读取”
+        self.transfer_mode.addItem("ACK窗口流控", TRANSFER_MODE_WINDOW)
+        self.transfer_mode.setCurrentIndex(0)
+        
+        self.transfer_size = QComboBox()
+        self.transfer_size.setEditable(True)
+        self.transfer_size.addItems([TRANSFER_SIZE_AUTO, "4096", "16384", "65536", "262144"])
+        # 自动调优：首次传输用文件开头的数据校准各候选大小，结果按设备端点缓存
+        self.transfer_size.setCurrentText(TRANSFER_SIZE_AUTO)
+        
+        self.queue_depth = QComboBox()
+        self.queue_depth.addItems(["1", "2", "4", "8", "16"])
+        self.queue_depth.setCurrentText(str(DEFAULT_QUEUE_DEPTH))
+        
+        # 预读队列深度(0为关闭)与预读块大小
+        self.read_ahead_depth = QComboBox()
+        self.read_ahead_depth.addItems(["0", "2", "4", "8", "16"])
+        self.read_ahead_depth.setCurrentText(str(DEFAULT_READ_AHEAD_DEPTH))
+        
+        self.read_ahead_chunk = QComboBox()
+        self.read_ahead_chunk.setEditable(True)
+        self.read_ahead_chunk.addItems(["65536", "262144", "1048576"])
+        self.read_ahead_chunk.setCurrentText(str(DEFAULT_READ_AHEAD_CHUNK))
         
         # 刷新设备按钮
         refresh_btn = RoundedButton("🔍 刷新USB设备")
         refresh_btn.clicked.connect(self.scan_usb_devices)
         
+        # 已连接设备(来自后台缓存的描述符树)，选择后自动填写VID/PID/接口/端点
+        self.device_combo = QComboBox()
+        self.device_combo.addItem("正在扫描USB设备...", None)
+        self.device_combo.activated.connect(self.device_chosen)
+        self.interface_input.activated.connect(self.interface_chosen)
+        
         # 第一行：VID/PID
         param_layout.addWidget(QLabel("VID (十六进制):"), 0, 0)
         param_layout.addWidget(self.vid_input, 0, 1)
@@ -403,6 +580,8 @@ class UsbTransferApp(QMainWindow):
         # 第二行：接口号
         param_layout.addWidget(QLabel("接口号:"), 1, 0)
         param_layout.addWidget(self.interface_input, 1, 1)
+        param_layout.addWidget(QLabel("发送模式:"), 1, 2)
+        param_layout.addWidget(self.transfer_mode, 1, 3)
         
         # 第三行：端点
         param_layout.addWidget(QLabel("输入端点:"), 2, 0)
@@ -415,6 +594,22 @@ class UsbTransferApp(QMainWindow):
         param_layout.addWidget(self.packet_size, 3, 1)
         param_layout.addWidget(refresh_btn, 3, 2, 1, 2)
         
+        # 第五行：批量传输大小
+        param_layout.addWidget(QLabel("批量传输大小:"), 4, 0)
+        param_layout.addWidget(self.transfer_size, 4, 1)
+        param_layout.addWidget(QLabel("队列深度:"), 4, 2)
+        param_layout.addWidget(self.queue_depth, 4, 3)
+        
+        # 第六行：预读设置
+        param_layout.addWidget(QLabel("预读队列深度:"), 5, 0)
+        param_layout.addWidget(self.read_ahead_depth, 5, 1)
+        param_layout.addWidget(QLabel("预读块大小:"), 5, 2)
+        param_layout.addWidget(self.read_ahead_chunk, 5, 3)
+        
+        # 第七行：已连接设备
+        param_layout.addWidget(QLabel("已连接设备:"), 6, 0)
+        param_layout.addWidget(self.device_combo, 6, 1, 1, 3)
+        
         # 按钮区域
         btn_layout = QHBoxLayout()
         self.send_btn = RoundedButton("🚀 发送文件")
@@ -422,12 +617,40 @@ class UsbTransferApp(QMainWindow):
         self.cancel_btn = RoundedButton("❌ 取消传输")
         self.cancel_btn.clicked.connect(self.cancel_transfer)
         self.cancel_btn.setEnabled(False)
+        # 群发：把文件同时发送到所有VID/PID匹配的设备
+        self.fan_out = QCheckBox("发送到所有匹配设备")
+        # 断点续传：中断时保存已确认的偏移，下次发送同一文件从该处继续
+        self.resume = QCheckBox("断点续传")
+        self.resume.setToolTip("传输中断时记录已确认的偏移，再次发送同一文件时从断点继续")
+        # 以设备在输入端点回复的确认包为准确定续传位置(需要自动读取)
+        self.use_ack = QCheckBox("设备ACK确认")
+        self.use_ack.setToolTip("设备每收到一次写入在输入端点回复确认包，续传从设备确认的位置开始")
+        # 差量发送：设备端固件需要支持差量帧格式
+        self.delta = QCheckBox("差量发送")
+        self.delta.setToolTip("按块哈希与该设备上次收到的镜像比较，只发送变化的块(设备需支持差量帧格式；"
+                              "需要启用自动读取，设备确认已应用后才记录镜像清单)")
+        # 发送后校验：请求设备回复收到数据的CRC32/SHA-256(需要自动读取)
+        self.verify = QCheckBox("发送后校验")
+        self.verify.setToolTip("每个文件发送完后请求设备回复收到数据的CRC32/SHA-256，与本地文件比较")
+        # 录制会话：收发的全部数据保存为会话文件，可用find-send-replay查看和回放
+        self.record_session = QCheckBox("录制会话")
+        self.record_session.setToolTip(f"把收发的全部数据录制到 {SESSION_DIR}，可用 find-send-replay 查看、搜索和回放")
+        # 性能分析：下一次传输保存cProfile结果和跟踪文件
+        self.profile_btn = RoundedButton("📈 分析下一次传输")
+        self.profile_btn.clicked.connect(self.request_profile)
         self.clear_log_btn = RoundedButton("🧹 清除日志")
         self.clear_log_btn.clicked.connect(self.clear_log)
         
         btn_layout.addWidget(self.send_btn)
         btn_layout.addWidget(self.cancel_btn)
+        btn_layout.addWidget(self.fan_out)
+        btn_layout.addWidget(self.resume)
+        btn_layout.addWidget(self.use_ack)
+        btn_layout.addWidget(self.delta)
+        btn_layout.addWidget(self.verify)
+        btn_layout.addWidget(self.record_session)
         btn_layout.addStretch()
+        btn_layout.addWidget(self.profile_btn)
         btn_layout.addWidget(self.clear_log_btn)
         
         # 进度条
@@ -438,11 +661,29 @@ class UsbTransferApp(QMainWindow):
         self.status_label = QLabel("准备就绪")
         self.status_label.setStyleSheet("font-weight: bold; padding: 5px;")
         
+        # 传输统计：已发送字节、瞬时/平均速率、剩余时间
+        self.stats_label = QLabel("")
+        self.stats_label.setStyleSheet("padding: 0px 5px; color: #555555;")
+        self.batch_label = QLabel("")
+        self.batch_label.setStyleSheet("padding: 0px 5px; color: #555555;")
+        
         # 日志区域
         usb_layout.addLayout(param_layout)
         usb_layout.addWidget(self.progress_bar)
         usb_layout.addLayout(btn_layout)
         usb_layout.addWidget(self.status_label)
+        usb_layout.addWidget(self.stats_label)
+        usb_layout.addWidget(self.batch_label)
+        
+        # 群发时每个设备一行，显示各自的进度、速率和状态
+        self.fanout_table = QTableWidget(0, 4)
+        self.fanout_table.setHorizontalHeaderLabels(["设备", "进度", "速率", "状态"])
+        self.fanout_table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.fanout_table.verticalHeader().setVisible(False)
+        self.fanout_table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.fanout_table.setMaximumHeight(160)
+        self.fanout_table.hide()
+        usb_layout.addWidget(self.fanout_table)
         
         # 日志标题
         log_title_layout = QHBoxLayout()
@@ -451,18 +692,54 @@ class UsbTransferApp(QMainWindow):
         self.show_hex.setChecked(True)
         self.auto_read = QCheckBox("发送后自动读取")  # 新增复选框
         self.auto_read.setChecked(True)
+        # 日志级别，TRACE级别才记录逐包十六进制数据
+        self.log_level = QComboBox()
+        for level in (LOG_TRACE, LOG_DEBUG, LOG_INFO, LOG_WARNING, LOG_ERROR):
+            self.log_level.addItem(LOG_LEVEL_NAMES[level], level)
+        self.log_level.setCurrentText(LOG_LEVEL_NAMES[LOG_INFO])
+        self.log_level.currentIndexChanged.connect(self.change_log_level)
+        self.log_to_file = QCheckBox("写入日志文件")
+        self.log_to_file.toggled.connect(self.toggle_log_file)
+        self.capture_to_file = QCheckBox("接收数据存文件")
+        self.capture_to_file.toggled.connect(self.toggle_capture_file)
+        self.capture_path = None
         log_title_layout.addStretch()
         log_title_layout.addWidget(self.show_hex)
         log_title_layout.addWidget(self.auto_read)    # 添加到布局
+        log_title_layout.addWidget(QLabel("日志级别:"))
+        log_title_layout.addWidget(self.log_level)
+        log_title_layout.addWidget(self.log_to_file)
+        log_title_layout.addWidget(self.capture_to_file)
         usb_layout.addLayout(log_title_layout)
         
-        # 日志视图
-        self.log_view = QTextEdit()
+        # 日志视图：纯文本并限制行数，长时间运行内存不会增长
+        self.log_view = QPlainTextEdit()
         self.log_view.setReadOnly(True)
         self.log_view.setFont(QFont("Courier", 10))
         self.log_view.setMinimumHeight(180)
+        self.log_view.setMaximumBlockCount(LOG_BUFFER_CAPACITY)
         usb_layout.addWidget(self.log_view)
         
+        # 接收数据十六进制视图：只渲染可见行，大量接收数据也能即时滚动
+        hex_title_layout = QHBoxLayout()
+        hex_title_layout.addWidget(SectionTitle("接收数据"))
+        self.hex_label = QLabel("")
+        hex_title_layout.addStretch()
+        hex_title_layout.addWidget(self.hex_label)
+        usb_layout.addLayout(hex_title_layout)
+        self.hex_model = HexDumpModel(self)
+        self.hex_view = QListView()
+        self.hex_view.setModel(self.hex_model)
+        self.hex_view.setUniformItemSizes(True)
+        self.hex_view.setFont(QFont("Courier", 10))
+        self.hex_view.setMinimumHeight(120)
+        usb_layout.addWidget(self.hex_view)
+        
+        # 定时把缓冲区中的日志批量刷新到界面
+        self.log_timer = QTimer(self)
+        self.log_timer.timeout.connect(self.flush_log)
+        self.log_timer.start(LOG_FLUSH_INTERVAL)
+        
         # 添加组件到分割器
         splitter.addWidget(file_frame)
         splitter.addWidget(usb_frame)
@@ -481,7 +758,8 @@ class UsbTransferApp(QMainWindow):
     
     def search_files(self):
         directory = self.path_edit.text()
-        keyword = self.search_edit.text().strip().lower()
+        keyword = self.search_edit.text().strip()
+        mode = self.match_mode.currentData()
         
         if not directory:
             QMessageBox.warning(self, "错误", "请先选择目录")
@@ -491,85 +769,312 @@ class UsbTransferApp(QMainWindow):
             QMessageBox.warning(self, "错误", "目录路径无效")
             return
         
-        self.file_list.clear()
+        try:
+            match = make_name_matcher(keyword, mode)
+        except re.error as e:
+            QMessageBox.warning(self, "错误", f"正则表达式无效: {str(e)}")
+            return
+        
+        try:
+            options = self.search_options()
+        except ValueError:
+            QMessageBox.warning(self, "错误", "最大深度和文件大小必须为非负整数")
+            return
+        
+        self.stop_search()
+        self.result_model.clear()
         self.selected_file = ""
+        self.selected_files = []
         self.selected_file_label.setText("未选择文件")
         
-        try:
-            for root, dirs, files in os.walk(directory):
-                for file in files:
-                    if keyword in file.lower():
-                        full_path = os.path.join(root, file)
-                        relative_path = os.path.relpath(full_path, directory)
-                        self.file_list.addItem(relative_path)
-            
-            if self.file_list.count() == 0:
-                self.log_message(f"在目录 '{directory}' 中未找到包含 '{keyword}' 的文件")
-            else:
-                self.log_message(f"找到 {self.file_list.count()} 个包含 '{keyword}' 的文件")
-        except Exception as e:
-            QMessageBox.critical(self, "错误", f"搜索文件时出错: {str(e)}")
+        if not self.use_index.isChecked():
+            self.search_files_walk(directory, keyword, match, options)
+            return
+        
+        # 索引已就绪时直接在内存中查询，同时在后台增量刷新
+        root = os.path.abspath(directory)
+        index = self.file_indexes.setdefault(root, FileIndex(root))
+        self.pending_query = (root, keyword, mode, options)
+        if index.ready:
+            self.show_search_results(root, keyword, filter_search_results(index.search(keyword, mode), options))
+        else:
+            self.status_label.setText("正在建立文件索引...")
+        self.start_index_thread(index)
     
-    def file_selected(self, item):
-        directory = self.path_edit.text()
-        relative_path = item.text()
+    def search_options(self):
+        """从界面读取搜索选项，输入无效时抛出ValueError"""
+        def non_negative(text, scale=1):
+            text = text.strip()
+            if not text:
+                return None
+            value = int(text)
+            if value < 0:
+                raise ValueError(text)
+            return value * scale
+        
+        exclude_dirs = tuple(p.strip() for p in self.exclude_dirs_edit.text().split(';') if p.strip())
+        return SearchOptions(non_negative(self.max_depth_edit.text()), exclude_dirs,
+                              non_negative(self.min_size_edit.text(), 1024),
+                              non_negative(self.max_size_edit.text(), 1024))
+    
+    def search_files_walk(self, directory, keyword, match, options):
+        """不使用索引时在后台并行遍历目录，结果边找边显示"""
+        self.result_root = directory
+        self.pending_query = None
+        self.search_keyword = keyword
+        self.search_thread = FileSearchThread(directory, match, options)
+        self.search_thread.results_found.connect(self.append_search_results)
+        self.search_thread.search_finished.connect(self.search_finished)
+        self.stop_search_btn.setEnabled(True)
+        self.status_label.setText("正在搜索文件...")
+        self.search_thread.start()
+    
+    def stop_search(self):
+        if self.search_thread is not None and self.search_thread.isRunning():
+            # 断开信号，已排队的旧结果不会混入新的搜索
+            self.search_thread.results_found.disconnect()
+            self.search_thread.search_finished.disconnect()
+            self.search_thread.cancel()
+            # 保留引用直到线程真正退出
+            thread = self.search_thread
+            self.stopped_search_threads.append(thread)
+            thread.finished.connect(lambda: self.stopped_search_threads.remove(thread))
+            self.log_message("已停止搜索")
+            self.status_label.setText("准备就绪")
+        self.stop_search_btn.setEnabled(False)
+    
+    def append_search_results(self, results):
+        self.result_model.append_results(results)
+    
+    def sort_results(self):
+        key, descending = self.sort_combo.currentData()
+        self.result_model.sort_by(key, descending)
+    
+    def search_finished(self, found, cancelled):
+        self.stop_search_btn.setEnabled(False)
+        self.status_label.setText("准备就绪")
+        # 流式追加的结果按当前排序方式重新排序
+        self.sort_results()
+        self.log_search_summary(self.result_root, self.search_keyword)
+    
+    def start_index_thread(self, index):
+        if self.index_thread is not None and self.index_thread.isRunning():
+            return
+        self.index_thread = FileIndexThread(index, self.log_buffer)
+        self.index_thread.index_ready.connect(self.index_updated)
+        self.index_thread.error_occurred.connect(lambda message: QMessageBox.critical(self, "错误", message))
+        self.index_thread.start()
+    
+    def index_updated(self, index, changed):
+        """索引建立或刷新完成；结果有变化时重新执行当前查询"""
+        if self.pending_query is None:
+            return
+        root, keyword, mode, options = self.pending_query
+        if root != index.root:
+            # 查询期间切换了目录，为新目录启动索引
+            self.start_index_thread(self.file_indexes[root])
+            return
+        if changed:
+            if self.status_label.text() == "正在建立文件索引...":
+                self.status_label.setText("准备就绪")
+            self.result_model.clear()
+            self.show_search_results(root, keyword, filter_search_results(index.search(keyword, mode), options))
+    
+    def show_search_results(self, directory, keyword, results):
+        self.result_root = directory
+        self.append_search_results(results)
+        self.sort_results()
+        self.log_search_summary(directory, keyword)
+    
+    def log_search_summary(self, directory, keyword):
+        if self.result_model.rowCount() == 0:
+            self.log_message(f"在目录 '{directory}' 中未找到包含 '{keyword}' 的文件")
+        else:
+            self.log_message(f"找到 {self.result_model.rowCount()} 个包含 '{keyword}' 的文件")
+    
+    def selection_changed(self):
+        rows = sorted(index.row() for index in self.file_list.selectionModel().selectedRows())
+        if len(rows) == 1:
+            self.file_selected(self.result_model.index(rows[0]))
+            return
+        if not rows:
+            return
+        directory = self.result_root or self.path_edit.text()
+        store = self.result_model.store
+        self.selected_files = [os.path.join(directory, store.path(row)) for row in rows]
+        self.selected_file = self.selected_files[0]
+        total_kb = sum(store.size(row) or 0 for row in rows) / 1024.0
+        self.selected_file_label.setText(f"已选择 {len(rows)} 个文件 (共 {total_kb:.2f} KB)，将按列表顺序依次发送")
+        self.log_message(f"已选择 {len(rows)} 个文件: " + ", ".join(store.path(row) for row in rows))
+    
+    def file_selected(self, index):
+        """从模型取路径和大小，不再逐次访问文件系统；文件有效性在开始传输时检查"""
+        directory = self.result_root or self.path_edit.text()
+        row = index.row()
+        relative_path = self.result_model.store.path(row)
+        file_size = self.result_model.store.size(row)
         full_path = os.path.join(directory, relative_path)
         
-        if os.path.isfile(full_path):
+        if file_size is not None:
             self.selected_file = full_path
-            file_size = os.path.getsize(full_path)
+            self.selected_files = [full_path]
             size_kb = file_size / 1024.0
-            self.selected_file_label.setText(f"已选择: {relative_path} ({size_kb:.2f} KB)")
+            # 发送过的文件显示缓存的摘要(只查缓存，不在界面线程中计算)
+            digest = default_digest_cache.lookup(full_path, file_size, self.result_model.store.mtime(row))
+            digest_text = f" | {format_digest(*digest)}" if digest is not None else ""
+            self.selected_file_label.setText(f"已选择: {relative_path} ({size_kb:.2f} KB){digest_text}")
             self.log_message(f"已选择文件: {relative_path}")
         else:
             self.selected_file = ""
+            self.selected_files = []
             self.selected_file_label.setText("文件无效或不存在")
     
     def scan_usb_devices(self):
-        """扫描并显示连接的USB设备"""
-        try:
-            self.usb_devices = list(usb.core.find(find_all=True))
-            count = len(self.usb_devices)
-            self.log_message(f"发现 {count} 个USB设备")
-            
-            for dev in self.usb_devices:
-                self.log_message(f"设备: VID=0x{dev.idVendor:04x} PID=0x{dev.idProduct:04x}")
-                
-                # 显示设备配置信息
-                try:
-                    for cfg in dev:
-                        self.log_message(f"  配置: {cfg.bConfigurationValue}")
-                        for intf in cfg:
-                            self.log_message(f"    接口: {intf.bInterfaceNumber}")
-                            for ep in intf:
-                                ep_type = "控制" if usb.util.endpoint_type(ep.bmAttributes) == usb.ENDPOINT_TYPE_CONTROL else \
-                                          "中断" if usb.util.endpoint_type(ep.bmAttributes) == usb.ENDPOINT_TYPE_INTERRUPT else \
-                                          "批量" if usb.util.endpoint_type(ep.bmAttributes) == usb.ENDPOINT_TYPE_BULK else \
-                                          "等时"
-                                direction = "IN" if usb.util.endpoint_direction(ep.bEndpointAddress) == usb.ENDPOINT_IN else "OUT"
-                                self.log_message(f"      端点: 0x{ep.bEndpointAddress:02x} ({direction}, {ep_type})")
-                except usb.core.USBError as e:
-                    self.log_message(f"  无法获取配置信息: {str(e)}")
+        """启动后台设备监视线程；已在运行时立即重新枚举"""
+        if self.device_monitor is not None and self.device_monitor.isRunning():
+            self.device_monitor.refresh_now()
+            return
+        self.device_monitor = DeviceMonitorThread(self.device_registry)
+        self.device_monitor.devices_changed.connect(self.devices_changed)
+        self.device_monitor.error_occurred.connect(lambda message: self.log_message(message, LOG_ERROR))
+        self.device_monitor.start()
+    
+    def devices_changed(self, added, removed):
+        """设备插拔后更新设备列表并记录日志"""
+        for info in removed:
+            self.session_pool.invalidate_device(info.bus, info.address)
+            self.log_message(f"设备已移除: VID=0x{info.vid:04x} PID=0x{info.pid:04x} (Bus {info.bus:03d} 地址 {info.address:03d})")
+        for info in added:
+            self.log_message(f"设备: VID=0x{info.vid:04x} PID=0x{info.pid:04x}")
+            if not info.configurations:
+                self.log_message("  无法获取配置信息", LOG_WARNING)
+            for cfg in info.configurations:
+                self.log_message(f"  配置: {cfg.value}", LOG_DEBUG)
+                for intf in cfg.interfaces:
+                    self.log_message(f"    接口: {intf.number}", LOG_DEBUG)
+                    for ep in intf.endpoints:
+                        self.log_message(f"      端点: 0x{ep.address:02x} ({ep.direction}, {ep.type_name})", LOG_DEBUG)
+        self.log_message(f"发现 {len(self.device_registry.devices)} 个USB设备")
         
-        except Exception as e:
-            self.log_message(f"扫描USB设备错误: {str(e)}")
+        current = self.device_combo.currentData()
+        self.device_combo.clear()
+        self.device_combo.addItem("选择设备以自动填写参数", None)
+        for key, info in sorted(self.device_registry.devices.items()):
+            self.device_combo.addItem(device_label(info), key)
+        if current is not None and current in self.device_registry.devices:
+            self.device_combo.setCurrentIndex(self.device_combo.findData(current))
+    
+    def selected_device_info(self):
+        key = self.device_combo.currentData()
+        return self.device_registry.devices.get(key) if key is not None else None
     
-    def log_message(self, message):
-        """添加带时间戳的消息到日志"""
-        timestamp = time.strftime("%H:%M:%S", time.localtime())
-        self.log_view.append(f"[{timestamp}] {message}")
+    def device_chosen(self):
+        """按缓存的描述符树填写VID/PID和可选接口"""
+        info = self.selected_device_info()
+        if info is None:
+            return
+        self.vid_input.setText(f"{info.vid:04x}")
+        self.pid_input.setText(f"{info.pid:04x}")
+        interfaces = [intf for cfg in info.configurations[:1] for intf in cfg.interfaces if intf.alternate == 0]
+        if interfaces:
+            self.interface_input.clear()
+            self.interface_input.addItems([str(intf.number) for intf in interfaces])
+            # 优先选择同时具有批量IN/OUT端点的接口
+            bulk = [i for i, intf in enumerate(interfaces)
+                    if {ep.direction for ep in intf.endpoints if ep.type_name == "批量"} == {"IN", "OUT"}]
+            self.interface_input.setCurrentIndex(bulk[0] if bulk else 0)
+            self.interface_chosen()
+    
+    def interface_chosen(self):
+        """按所选接口填写输入/输出端点"""
+        info = self.selected_device_info()
+        if info is None:
+            return
+        number = self.interface_input.currentText().strip()
+        for cfg in info.configurations[:1]:
+            for intf in cfg.interfaces:
+                if str(intf.number) != number or intf.alternate != 0:
+                    continue
+                for combo, direction in ((self.ep_in_input, "IN"), (self.ep_out_input, "OUT")):
+                    addresses = [f"0x{ep.address:02X}" for ep in intf.endpoints if ep.direction == direction]
+                    if addresses:
+                        combo.clear()
+                        combo.addItems(addresses)
+                        combo.setCurrentIndex(0)
+    
+    def log_message(self, message, level=LOG_INFO):
+        """添加带时间戳的消息到日志缓冲区，由定时器批量刷新到界面"""
+        self.log_buffer.log(level, message)
+    
+    def flush_log(self):
+        """把缓冲区中的新日志一次性追加到日志视图"""
+        entries, dropped = self.log_buffer.drain()
+        if not entries and not dropped:
+            return
+        lines = [format_log_entry(entry) for entry in entries]
+        if dropped:
+            lines.insert(0, f"... 日志过多，省略 {dropped} 条 ...")
+        self.log_view.appendPlainText('\n'.join(lines))
         
         # 滚动到底部
         scrollbar = self.log_view.verticalScrollBar()
         scrollbar.setValue(scrollbar.maximum())
     
+    def change_log_level(self):
+        self.log_buffer.level = self.log_level.currentData()
+    
+    def toggle_log_file(self, checked):
+        """开启时选择日志文件并启动后台写入线程"""
+        if checked:
+            path, _ = QFileDialog.getSaveFileName(self, "保存日志文件",
+                                                  os.path.join(QDir.homePath(), "usb_transfer.log"),
+                                                  "日志文件 (*.log *.txt)")
+            if not path:
+                self.log_to_file.setChecked(False)
+                return
+            self.log_file_writer = AsyncLogFileWriter(path)
+            self.log_buffer.file_writer = self.log_file_writer
+            self.log_message(f"日志同时写入文件: {path}")
+        elif self.log_file_writer is not None:
+            self.log_buffer.file_writer = None
+            self.log_file_writer.close()
+            self.log_file_writer = None
+    
+    def toggle_capture_file(self, checked):
+        """开启时选择抓包文件，之后的传输把接收到的原始数据写入该文件"""
+        if checked:
+            path, _ = QFileDialog.getSaveFileName(self, "保存接收数据",
+                                                  os.path.join(QDir.homePath(), "usb_capture.bin"),
+                                                  "二进制文件 (*.bin);;所有文件 (*)")
+            if not path:
+                self.capture_to_file.setChecked(False)
+                return
+            self.capture_path = path
+            self.log_message(f"接收数据将保存到: {path}")
+        else:
+            self.capture_path = None
+    
+    def request_profile(self):
+        if request_profile():
+            self.log_message(f"下一次传输将保存cProfile结果和跟踪文件到 {TRACE_DIR}")
+        else:
+            self.log_message("无法创建分析请求文件")
+
     def clear_log(self):
         self.log_view.clear()
+        self.log_buffer.clear()
+        self.hex_model.clear()
+        self.hex_label.setText("")
     
     def start_transfer(self):
-        if not self.selected_file or not os.path.isfile(self.selected_file):
+        files = self.selected_files or ([self.selected_file] if self.selected_file else [])
+        if not files:
             QMessageBox.warning(self, "错误", "请先选择一个有效文件")
             return
+        invalid = [path for path in files if not os.path.isfile(path)]
+        if invalid:
+            QMessageBox.warning(self, "错误", f"文件无效或不存在: {invalid[0]}")
+            return
         
         # 获取USB参数
         vid = self.vid_input.text().strip()
@@ -577,7 +1082,15 @@ class UsbTransferApp(QMainWindow):
         interface = self.interface_input.currentText().strip()
         ep_in_text = self.ep_in_input.currentText().strip()
         ep_out_text = self.ep_out_input.currentText().strip()
-        packet_size = int(self.packet_size.currentText())
+        # 包大小选"自动"时由发送引擎取端点的wMaxPacketSize
+        packet_text = self.packet_size.currentText()
+        packet_size = None if packet_text == PACKET_SIZE_AUTO else int(packet_text)
+        transfer_mode = self.transfer_mode.currentData()
+        if transfer_mode == TRANSFER_MODE_WINDOW and not self.auto_read.isChecked():
+            QMessageBox.warning(self, "错误", "ACK窗口流控需要勾选“发送后自动读取”，由接收线程读取设备的确认包")
+            return
+        queue_depth = int(self.queue_depth.currentText())
+        read_ahead_depth = int(self.read_ahead_depth.currentText())
         
         # 验证参数
         if not all([vid, pid, interface, ep_in_text, ep_out_text]):
@@ -592,36 +1105,186 @@ class UsbTransferApp(QMainWindow):
             QMessageBox.warning(self, "错误", "端点地址格式无效，请使用十六进制格式 (如0x81)")
             return
         
+        auto_tune = self.transfer_size.currentText().strip() == TRANSFER_SIZE_AUTO
+        try:
+            transfer_size = DEFAULT_TRANSFER_SIZE if auto_tune else int(self.transfer_size.currentText().strip())
+            if transfer_size <= 0:
+                raise ValueError
+        except ValueError:
+            QMessageBox.warning(self, "错误", "批量传输大小必须为正整数")
+            return
+        
+        try:
+            read_ahead_chunk = int(self.read_ahead_chunk.currentText().strip())
+            if read_ahead_chunk <= 0:
+                raise ValueError
+        except ValueError:
+            QMessageBox.warning(self, "错误", "预读块大小必须为正整数")
+            return
+        
         # 禁用UI控件
         self.send_btn.setEnabled(False)
         self.cancel_btn.setEnabled(True)
         self.progress_bar.setValue(0)
+        self.stats_label.setText("")
+        self.batch_label.setText("")
         self.status_label.setStyleSheet("font-weight: bold; color: #d35400;")
         self.status_label.setText("正在准备传输...")
         
+        engine_options = dict(auto_tune=auto_tune, resume=self.resume.isChecked(),
+                              use_ack=self.use_ack.isChecked(), delta=self.delta.isChecked(),
+                              verify=self.verify.isChecked(), metrics_dir=METRICS_DIR)
+        if self.record_session.isChecked():
+            engine_options["record_path"] = os.path.join(
+                SESSION_DIR, f"session-{time.strftime('%Y%m%d-%H%M%S')}.fss")
+        if self.fan_out.isChecked():
+            self.start_fan_out(files, (vid, pid, interface, ep_in, ep_out, files, packet_size,
+                                       self.auto_read.isChecked(), transfer_mode, transfer_size,
+                                       queue_depth, read_ahead_depth, read_ahead_chunk,
+                                       self.log_buffer, self.session_pool), **engine_options)
+            return
+        
         # 创建并启动传输线程
+        self.fanout_table.hide()
         self.transfer_thread = UsbTransferThread(
             vid, 
             pid, 
             interface,
             ep_in, 
             ep_out, 
-            self.selected_file,
+            files,
             packet_size,
-            self.auto_read.isChecked()
+            self.auto_read.isChecked(),
+            transfer_mode,
+            transfer_size,
+            queue_depth,
+            read_ahead_depth,
+            read_ahead_chunk,
+            self.log_buffer,
+            self.session_pool,
+            capture_path=self.capture_path,
+            **engine_options
         )
         self.transfer_thread.update_progress.connect(self.progress_bar.setValue)
+        self.transfer_thread.progress_stats.connect(self.show_progress_stats)
+        self.transfer_thread.overall_stats.connect(self.show_overall_stats)
+        self.transfer_thread.file_started.connect(self.batch_file_started)
         self.transfer_thread.update_status.connect(self.status_label.setText)
-        self.transfer_thread.log_message.connect(self.log_message)
         self.transfer_thread.error_occurred.connect(self.handle_error)
         self.transfer_thread.transfer_complete.connect(self.transfer_completed)
         self.transfer_thread.data_received.connect(self.handle_received_data)
         self.transfer_thread.start()
     
+    def start_fan_out(self, files, thread_args, **engine_options):
+        """为每个匹配的设备启动独立的传输线程，文件只读一次并在内存中共享"""
+        vid, pid, ep_out, packet_size = thread_args[0], thread_args[1], thread_args[4], thread_args[6]
+        try:
+            devices = self.device_registry.find(int(vid, 16), int(pid, 16))
+        except ValueError:
+            devices = []
+        if not devices:
+            QMessageBox.warning(self, "错误", "未找到匹配VID/PID的设备")
+            self.send_btn.setEnabled(True)
+            self.cancel_btn.setEnabled(False)
+            self.status_label.setText("准备就绪")
+            return
+        devices.sort(key=lambda info: (info.bus, info.port_path, info.address))
+        if packet_size is None:
+            # 共享数据按包大小补齐末包，需要在启动线程前从描述符中确定
+            packet_size = endpoint_max_packet_size(devices[0], ep_out) or 64
+            thread_args = thread_args[:6] + (packet_size,) + thread_args[7:]
+            self.log_message(f"包大小自动设为端点wMaxPacketSize: {packet_size} 字节")
+        
+        try:
+            shared_sources = {path: SharedFileData(path, packet_size) for path in files}
+        except OSError as e:
+            self.handle_error(f"读取文件失败: {str(e)}")
+            return
+        
+        self.fanout_threads = {}
+        self.fanout_rows = {}
+        self.fanout_failed = set()
+        # 会话池至少能为每个设备保留一个会话，下次群发无需重新连接
+        self.session_pool.max_sessions = max(self.session_pool.max_sessions, len(devices))
+        self.fanout_table.setRowCount(len(devices))
+        self.fanout_table.show()
+        self.log_message(f"群发: 共 {len(devices)} 个设备")
+        for row, info in enumerate(devices):
+            key = (info.bus, info.address)
+            label = device_label(info)
+            self.fanout_rows[key] = row
+            for column, text in enumerate((label, "0%", "", "等待")):
+                self.fanout_table.setItem(row, column, QTableWidgetItem(text))
+            self.log_message(f"  {label}")
+            
+            thread = UsbTransferThread(*thread_args, bus=info.bus, address=info.address,
+                                       shared_sources=shared_sources, capture_path=self.capture_path,
+                                       **engine_options)
+            thread.update_progress.connect(lambda value, key=key: self.set_fanout_cell(key, 1, f"{value}%"))
+            thread.progress_stats.connect(
+                lambda progress, key=key: self.set_fanout_cell(key, 2, f"{format_size(progress.avg_rate)}/s"))
+            thread.update_status.connect(lambda text, key=key: self.set_fanout_cell(key, 3, text))
+            thread.error_occurred.connect(lambda message, key=key: self.fanout_error(key, message))
+            thread.data_received.connect(lambda data, label=label: self.handle_received_data(data, label))
+            thread.finished.connect(self.fanout_finished)
+            self.fanout_threads[key] = thread
+        self.status_label.setText(f"群发中: 共 {len(devices)} 个设备")
+        for thread in self.fanout_threads.values():
+            thread.start()
+    
+    def set_fanout_cell(self, key, column, text):
+        row = self.fanout_rows.get(key)
+        if row is not None:
+            self.fanout_table.item(row, column).setText(text)
+    
+    def fanout_error(self, key, message):
+        """单个设备失败只标记该设备，不影响其他设备"""
+        self.fanout_failed.add(key)
+        self.set_fanout_cell(key, 3, message)
+        self.fanout_table.item(self.fanout_rows[key], 3).setForeground(QColor("#c0392b"))
+        self.log_message(f"设备 Bus {key[0]:03d} 地址 {key[1]:03d} 失败: {message}", LOG_ERROR)
+    
+    def fanout_finished(self):
+        if any(thread.isRunning() for thread in self.fanout_threads.values()):
+            return
+        total = len(self.fanout_threads)
+        failed = len(self.fanout_failed)
+        self.send_btn.setEnabled(True)
+        self.cancel_btn.setEnabled(False)
+        color = "#27ae60" if not failed else "#c0392b"
+        self.status_label.setStyleSheet(f"font-weight: bold; color: {color};")
+        self.status_label.setText(f"群发结束: 成功 {total - failed} / 失败 {failed} / 共 {total}")
+        self.log_message(f"群发结束: 成功 {total - failed} 个，失败 {failed} 个")
+    
+    def batch_file_started(self, index, count, file_path):
+        self.batch_position = (index, count)
+        if count > 1:
+            self.log_message(f"发送第 {index + 1}/{count} 个文件: {os.path.basename(file_path)}")
+    
+    def show_overall_stats(self, progress):
+        """多文件发送时显示整批进度"""
+        index, count = self.batch_position
+        if count <= 1:
+            return
+        self.batch_label.setText(
+            f"总进度: 文件 {index + 1}/{count} | 已发送 {format_size(progress.bytes_sent)} / "
+            f"{format_size(progress.total)} | 平均 {format_size(progress.avg_rate)}/s | "
+            f"剩余 {format_duration(progress.eta)}")
+    
+    def show_progress_stats(self, progress):
+        self.stats_label.setText(
+            f"已发送 {format_size(progress.bytes_sent)} / {format_size(progress.total)} | "
+            f"瞬时 {format_size(progress.rate)}/s | 平均 {format_size(progress.avg_rate)}/s | "
+            f"剩余 {format_duration(progress.eta)}")
+    
     def cancel_transfer(self):
         if self.transfer_thread and self.transfer_thread.isRunning():
             self.transfer_thread.cancel()
             self.status_label.setText("正在取消操作...")
+        for thread in self.fanout_threads.values():
+            if thread.isRunning():
+                thread.cancel()
+                self.status_label.setText("正在取消操作...")
     
     def transfer_completed(self):
         self.send_btn.setEnabled(True)
@@ -636,29 +1299,48 @@ class UsbTransferApp(QMainWindow):
         self.status_label.setText("传输错误")
         QMessageBox.critical(self, "错误", message)
     
-    def handle_received_data(self, data):
-        """处理收到的USB数据"""
+    def handle_received_data(self, data, source=None):
+        """处理收到的USB数据(群发时source为设备标签)"""
+        prefix = f"[{source}] " if source else ""
         if self.show_hex.isChecked():
-            # 十六进制格式显示
-            hex_data = ' '.join(f'{b:02X}' for b in data)
-            self.log_message(f"收到数据(16进制): {hex_data}")
-            ascii_data = ''.join([chr(byte) if 32 <= byte <= 126 else '.' for byte in data])
-            self.log_message(f"收到数据(ASCII): {ascii_data}")
+            # 完整数据进入十六进制视图，日志只记录摘要
+            self.hex_model.append_data(data)
+            self.log_message(f"{prefix}收到数据 {len(data)} 字节: {format_hex(data[:HEX_DUMP_WIDTH])}"
+                              f"{' ...' if len(data) > HEX_DUMP_WIDTH else ''}")
+            buffer = self.hex_model.buffer
+            self.hex_label.setText(f"共 {format_size(buffer.base_offset + len(buffer))}")
+            scrollbar = self.hex_view.verticalScrollBar()
+            if scrollbar.value() >= scrollbar.maximum() - 1:
+                self.hex_view.scrollToBottom()
         else:
             # 尝试解码为文本
             try:
                 text = data.decode('utf-8', errors='replace').strip()
-                self.log_message(f"收到文本: {text}")
+                self.log_message(f"{prefix}收到文本: {text}")
             except:
                 # 如果解码失败，显示十六进制
-                hex_data = ' '.join(f'{b:02X}' for b in data)
-                self.log_message(f"出现异常，收到数据: {hex_data}")
+                self.log_message(f"{prefix}出现异常，收到数据: {format_hex(data)}")
 
     def closeEvent(self, event):
         """窗口关闭时确保停止传输线程"""
         if self.transfer_thread and self.transfer_thread.isRunning():
             self.transfer_thread.cancel()
             self.transfer_thread.wait(2000)  # 等待2秒让线程结束
+        for thread in self.fanout_threads.values():
+            if thread.isRunning():
+                thread.cancel()
+                thread.wait(2000)
+        if self.index_thread and self.index_thread.isRunning():
+            self.index_thread.wait(2000)
+        if self.device_monitor and self.device_monitor.isRunning():
+            self.device_monitor.stop()
+            self.device_monitor.wait(2000)
+        if self.search_thread and self.search_thread.isRunning():
+            self.search_thread.cancel()
+            self.search_thread.wait(2000)
+        self.session_pool.close_all()
+        if self.log_file_writer is not None:
+            self.log_file_writer.close()
         event.accept()
 
 
@@ -666,9 +1348,10 @@ if __name__ == "__main__":
     print(f"__name__ is {__name__},sys.argv is {sys.argv}")
     app = QApplication(sys.argv)
     
-    # 检查pyusb是否可用
+    # 检查pyusb是否可用(只加载后端，设备枚举在窗口显示后于后台进行)
     try:
-        usb.core.find()
+        if not usb_backend_available():
+            raise usb.core.NoBackendError("No backend available")
     except:
         msg = QMessageBox()
         msg.setIcon(QMessageBox.Critical)
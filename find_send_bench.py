@@ -0,0 +1,188 @@
+'''
+ 发送性能基准：在模拟USB后端上按包大小、文件大小、日志级别组合运行发送循环，
+ 输出MB/s、CPU时间和峰值内存，并与基线文件对比，发现性能回退时返回非0退出码
+ 用法: python find_send_bench.py [--save-baseline] [--baseline bench_baseline.json]
+'''
+import sys
+import os
+import json
+import time
+import argparse
+import itertools
+import tempfile
+import tracemalloc
+
+from find_send_engine import (TRANSFER_MODE_BULK, TRANSFER_MODE_LEGACY, TRANSFER_MODE_WINDOW,
+                              DEFAULT_TRANSFER_SIZE, LOG_TRACE, LOG_DEBUG, LOG_INFO, LOG_LEVEL_NAMES,
+                              TransferSizeCache, TransferCheckpointStore, FileDigestCache, BlockHashCache,
+                              DeltaManifestStore, DeviceSessionPool, LogBuffer, TransferEngine, format_size)
+from find_send_simulator import (RESPONSE_NONE, RESPONSE_ECHO, RESPONSE_ACK,
+                                 SimulatedBackend, SimulatedDevice)
+
+DEFAULT_BASELINE = "bench_baseline.json"
+DEFAULT_TOLERANCE = 0.15           # 超过基线15%视为回退
+
+# 默认测试矩阵
+PACKET_SIZES = (64, 512)
+FILE_SIZES = (1024 * 1024, 16 * 1024 * 1024)
+LOG_LEVELS = (LOG_INFO, LOG_TRACE)
+
+
+def case_key(mode, packet_size, file_size, log_level):
+    return f"{mode}/pkt{packet_size}/{file_size // 1024}K/{LOG_LEVEL_NAMES[log_level]}"
+
+
+def make_test_file(directory, size):
+    path = os.path.join(directory, f"bench_{size}.bin")
+    if not os.path.exists(path):
+        with open(path, 'wb') as f:
+            remaining = size
+            while remaining:
+                block = os.urandom(min(remaining, 1024 * 1024))
+                f.write(block)
+                remaining -= len(block)
+    return path
+
+
+def engine_stores(directory):
+    """每次运行使用临时目录中的空缓存，不写入用户的 ~/.find-send-byusb，各次运行的条件相同"""
+    state = tempfile.mkdtemp(prefix="state-", dir=directory)
+    return dict(tune_cache=TransferSizeCache(os.path.join(state, "tuning.json")),
+                checkpoint_store=TransferCheckpointStore(os.path.join(state, "checkpoints.json")),
+                digest_cache=FileDigestCache(os.path.join(state, "digests.json")),
+                hash_cache=BlockHashCache(os.path.join(state, "block_hashes.json")),
+                manifest_store=DeltaManifestStore(os.path.join(state, "delta_manifests.json")))
+
+
+def run_transfer(path, mode, packet_size, log_level, device_args):
+    """发送一次文件，返回(发送字节数, 墙钟时间, CPU时间)；
+    模拟后端没有libusb异步传输，队列深度固定为1(同步批量发送)"""
+    if mode == TRANSFER_MODE_WINDOW:
+        # 窗口流控依赖设备的确认包
+        device_args = dict(device_args, response=RESPONSE_ACK)
+    device = SimulatedDevice(**device_args)
+    pool = DeviceSessionPool(backend=SimulatedBackend(device))
+    auto_read = device.response != RESPONSE_NONE
+    engine = TransferEngine(device.vid, device.pid, device.interface, device.ep_in if auto_read else None,
+                            device.ep_out, path, packet_size=packet_size, auto_read=auto_read,
+                            transfer_mode=mode, transfer_size=DEFAULT_TRANSFER_SIZE,
+                            queue_depth=1, log_buffer=LogBuffer(level=log_level),
+                            session_pool=pool, **engine_stores(os.path.dirname(path)))
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        sent = engine.run()
+    finally:
+        pool.close_all()
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    if device.bytes_received < sent:
+        raise RuntimeError(f"模拟设备只收到 {device.bytes_received}/{sent} 字节")
+    return sent, wall, cpu
+
+
+def run_case(path, mode, packet_size, log_level, device_args, repeat):
+    """重复运行取最快一次；峰值内存单独用tracemalloc再跑一次，避免跟踪开销影响速度"""
+    best = None
+    for _ in range(repeat):
+        sent, wall, cpu = run_transfer(path, mode, packet_size, log_level, device_args)
+        if best is None or wall < best[1]:
+            best = (sent, wall, cpu)
+    sent, wall, cpu = best
+    tracemalloc.start()
+    try:
+        run_transfer(path, mode, packet_size, log_level, device_args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"mb_s": round(sent / wall / 1e6, 2) if wall else 0.0,
+            "cpu_s": round(cpu, 4),
+            "peak_kb": round(peak / 1024, 1)}
+
+
+def compare(result, baseline, tolerance):
+    """与基线对比，返回回退项列表"""
+    regressions = []
+    if result["mb_s"] < baseline["mb_s"] * (1 - tolerance):
+        regressions.append(f"速度 {result['mb_s']} < 基线 {baseline['mb_s']} MB/s")
+    if result["cpu_s"] > baseline["cpu_s"] * (1 + tolerance) and result["cpu_s"] - baseline["cpu_s"] > 0.01:
+        regressions.append(f"CPU {result['cpu_s']} > 基线 {baseline['cpu_s']} s")
+    if result["peak_kb"] > baseline["peak_kb"] * (1 + tolerance) and result["peak_kb"] - baseline["peak_kb"] > 64:
+        regressions.append(f"峰值内存 {result['peak_kb']} > 基线 {baseline['peak_kb']} KB")
+    return regressions
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="在模拟USB设备上测量发送性能")
+    parser.add_argument("--packet-sizes", type=int, nargs="+", default=PACKET_SIZES)
+    parser.add_argument("--file-sizes", type=int, nargs="+", default=FILE_SIZES, help="文件大小(字节)")
+    parser.add_argument("--log-levels", nargs="+", default=[LOG_LEVEL_NAMES[l] for l in LOG_LEVELS],
+                        choices=[LOG_LEVEL_NAMES[l] for l in (LOG_TRACE, LOG_DEBUG, LOG_INFO)])
+    parser.add_argument("--legacy", action="store_true", help="同时测试传统节流模式(每包固定延迟，很慢)")
+    parser.add_argument("--window", action="store_true", help="同时测试ACK窗口流控模式(模拟设备回复确认包)")
+    parser.add_argument("--process-rate", type=float, default=None,
+                        help="模拟设备处理数据的速度(MB/s)，默认收到即处理")
+    parser.add_argument("--bandwidth", type=float, default=None, help="模拟总线带宽(MB/s)，默认不限速")
+    parser.add_argument("--latency", type=float, default=0.0, help="模拟每次传输的固定延迟(毫秒)")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="模拟写入超时(NAK)的概率")
+    parser.add_argument("--response", choices=(RESPONSE_NONE, RESPONSE_ECHO, RESPONSE_ACK), default=RESPONSE_NONE,
+                        help="模拟设备的回复方式，非none时同时启动接收线程")
+    parser.add_argument("--repeat", type=int, default=3, help="每个组合重复次数，取最快一次")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="基线文件")
+    parser.add_argument("--save-baseline", action="store_true", help="把本次结果写入基线文件")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="允许的回退比例")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    level_by_name = {name: level for level, name in LOG_LEVEL_NAMES.items()}
+    device_args = dict(bandwidth=args.bandwidth * 1e6 if args.bandwidth else None,
+                       latency=args.latency / 1000.0, timeout_rate=args.timeout_rate,
+                       response=args.response, seed=0,
+                       process_rate=args.process_rate * 1e6 if args.process_rate else None)
+    modes = (TRANSFER_MODE_BULK,) + ((TRANSFER_MODE_LEGACY,) if args.legacy else ()) + \
+        ((TRANSFER_MODE_WINDOW,) if args.window else ())
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            saved = json.load(f)
+        # 模拟设备参数不同时结果没有可比性
+        if saved.get("device") == device_args:
+            baseline = saved.get("cases", {})
+        else:
+            print(f"基线 {args.baseline} 的模拟设备参数与本次不同，不做对比")
+
+    results = {}
+    failures = []
+    print(f"{'组合':<36}{'MB/s':>10}{'CPU(s)':>10}{'峰值内存':>12}  对比基线")
+    with tempfile.TemporaryDirectory(prefix="find-send-bench-") as directory:
+        for mode, packet_size, file_size, level_name in itertools.product(
+                modes, args.packet_sizes, args.file_sizes, args.log_levels):
+            level = level_by_name[level_name]
+            key = case_key(mode, packet_size, file_size, level)
+            path = make_test_file(directory, file_size)
+            result = results[key] = run_case(path, mode, packet_size, level, device_args, args.repeat)
+            note = "无基线"
+            if key in baseline:
+                regressions = compare(result, baseline[key], args.tolerance)
+                failures.extend(f"{key}: {r}" for r in regressions)
+                note = "回退: " + "; ".join(regressions) if regressions else "正常"
+            print(f"{key:<36}{result['mb_s']:>10.2f}{result['cpu_s']:>10.3f}"
+                  f"{format_size(result['peak_kb'] * 1024):>12}  {note}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({"device": device_args, "cases": results}, f, indent=2, sort_keys=True)
+        print(f"基线已保存到 {args.baseline}")
+    if failures:
+        print(f"\n发现 {len(failures)} 项性能回退:")
+        for failure in failures:
+            print(f"  {failure}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
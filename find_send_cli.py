@@ -0,0 +1,196 @@
+'''
+ 命令行发送工具：不加载PyQt5，适合在无界面的构建机上由脚本调用
+ 用法: find-send --vid 0483 --pid 8004 --ep-out 0x06 FILE...
+'''
+import sys
+import os
+import argparse
+import usb.core
+
+from find_send_engine import (TRANSFER_MODE_BULK, TRANSFER_MODE_LEGACY, TRANSFER_MODE_WINDOW,
+                              DEFAULT_TRANSFER_SIZE, DEFAULT_QUEUE_DEPTH, DEFAULT_READ_AHEAD_DEPTH, DEFAULT_READ_AHEAD_CHUNK,
+                              RESUME_MAX_RECONNECTS, METRICS_DIR,
+                              LOG_TRACE, LOG_DEBUG, LOG_INFO, LOG_WARNING, LOG_ERROR,
+                              DeviceNotFoundError, VerifyError, DeviceSessionPool, LogBuffer, TransferEngine,
+                              format_log_entry, format_size, format_duration, usb_backend_available)
+
+# 退出码
+EXIT_OK = 0
+EXIT_TRANSFER_ERROR = 1      # USB通信或其他传输错误
+EXIT_USAGE = 2               # 参数错误(argparse默认)
+EXIT_DEVICE_NOT_FOUND = 3    # 未找到设备或端点
+EXIT_FILE_ERROR = 4          # 文件不存在或无法读取
+EXIT_NO_BACKEND = 5          # pyusb没有可用的USB后端
+EXIT_VERIFY_FAILED = 6       # 设备校验结果与本地文件不一致
+EXIT_CANCELLED = 130         # 被Ctrl+C中断
+
+LOG_LEVELS = {"trace": LOG_TRACE, "debug": LOG_DEBUG, "info": LOG_INFO,
+              "warning": LOG_WARNING, "error": LOG_ERROR}
+
+
+def hex_id(text):
+    """VID/PID参数按十六进制解析，格式错误时由argparse报参数错误"""
+    return int(text, 16)
+
+
+def packet_size_arg(text):
+    """包大小：数字或auto(取端点wMaxPacketSize)"""
+    return None if text == "auto" else int(text)
+
+
+def int_auto(text):
+    """端点等数值参数支持十进制和0x前缀的十六进制"""
+    return int(text, 0)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="find-send",
+        description="通过USB批量端点发送文件",
+        epilog=f"退出码: {EXIT_OK}成功 {EXIT_TRANSFER_ERROR}传输错误 {EXIT_USAGE}参数错误 "
+               f"{EXIT_DEVICE_NOT_FOUND}未找到设备 {EXIT_FILE_ERROR}文件错误 "
+               f"{EXIT_NO_BACKEND}无USB后端 {EXIT_VERIFY_FAILED}校验失败 {EXIT_CANCELLED}被中断")
+    parser.add_argument("files", nargs="+", metavar="FILE", help="要发送的文件，按顺序在同一个设备会话中发送")
+    parser.add_argument("--vid", type=hex_id, required=True, help="厂商ID(十六进制)，如 0483")
+    parser.add_argument("--pid", type=hex_id, required=True, help="产品ID(十六进制)，如 8004")
+    parser.add_argument("--interface", type=int, default=0, help="接口号(默认0)")
+    parser.add_argument("--ep-out", type=int_auto, required=True, help="输出端点地址，如 0x06")
+    parser.add_argument("--ep-in", type=int_auto, default=None, help="输入端点地址，如 0x86")
+    parser.add_argument("--bus", type=int, default=None, help="只连接指定bus上的设备")
+    parser.add_argument("--address", type=int, default=None, help="只连接指定地址的设备")
+    parser.add_argument("--packet-size", type=packet_size_arg, default=64,
+                        help="包大小(默认64)，auto表示使用端点的wMaxPacketSize")
+    parser.add_argument("--mode", choices=(TRANSFER_MODE_BULK, TRANSFER_MODE_LEGACY, TRANSFER_MODE_WINDOW),
+                        default=TRANSFER_MODE_BULK,
+                        help="发送模式：bulk高速批量(默认)，legacy逐包节流，window按设备确认包的窗口流控(需要--ep-in)")
+    parser.add_argument("--transfer-size", type=int, default=DEFAULT_TRANSFER_SIZE, help="批量模式单次写入字节数")
+    parser.add_argument("--auto-tune", action="store_true",
+                        help="自动调优批量写入大小：首次发送时校准并按VID/PID/接口/端点缓存结果")
+    parser.add_argument("--resume", action="store_true",
+                        help="断点续传：中断时保存已确认的偏移，再次发送同一文件时从断点继续")
+    parser.add_argument("--ack", action="store_true",
+                        help="以设备在输入端点回复的确认包为准确定续传位置(需要--ep-in)")
+    parser.add_argument("--max-reconnects", type=int, default=RESUME_MAX_RECONNECTS,
+                        help=f"传输中断后自动重连续传的次数(默认{RESUME_MAX_RECONNECTS})，0表示不重连")
+    parser.add_argument("--delta", action="store_true",
+                        help="差量发送：只发送与该设备上次收到的镜像相比有变化的块(设备需支持差量帧格式，需要--ep-in接收设备确认)")
+    parser.add_argument("--delta-full", action="store_true",
+                        help="与--delta一起使用：忽略记录的清单完整发送一次，之后的差量以本次为基础")
+    parser.add_argument("--verify", action="store_true",
+                        help="每个文件发送后请求设备回复收到数据的CRC32/SHA-256并与本地比较(需要--ep-in)")
+    parser.add_argument("--queue-depth", type=int, default=DEFAULT_QUEUE_DEPTH, help="异步传输队列深度，1为同步")
+    parser.add_argument("--read-ahead-depth", type=int, default=DEFAULT_READ_AHEAD_DEPTH,
+                        help="预读队列深度，0关闭预读")
+    parser.add_argument("--read-ahead-chunk", type=int, default=DEFAULT_READ_AHEAD_CHUNK, help="预读块大小")
+    parser.add_argument("--metrics", metavar="DIR", nargs="?", const=METRICS_DIR, default=None,
+                        help=f"传输结束后把指标写入目录：每次一个JSON摘要，另有供Prometheus textfile收集器读取的"
+                             f".prom文件(不指定DIR时为 {METRICS_DIR})")
+    parser.add_argument("--trace", metavar="PATH", default=None,
+                        help="保存本次传输的跟踪文件(Chrome跟踪格式，可用chrome://tracing或Perfetto打开)")
+    parser.add_argument("--profile", metavar="PATH", default=None,
+                        help="用cProfile分析本次传输并保存结果(python -m pstats PATH 查看)")
+    parser.add_argument("--capture", metavar="PATH", default=None,
+                        help="发送期间从输入端点读取数据并保存到文件(需要--ep-in)")
+    parser.add_argument("--record", metavar="PATH", default=None,
+                        help="把收发的全部数据录制为会话文件，可用 find-send-replay 查看、搜索和回放")
+    parser.add_argument("--simulate", action="store_true",
+                        help="不连接真实硬件，发送到按参数构造的模拟设备(用于测试脚本)")
+    parser.add_argument("--log-level", choices=tuple(LOG_LEVELS), default="info", help="日志级别")
+    parser.add_argument("-q", "--quiet", action="store_true", help="不输出进度，只输出错误")
+    return parser
+
+
+def print_logs(log_buffer):
+    entries, dropped = log_buffer.drain()
+    if dropped:
+        print(f"(省略 {dropped} 条日志)", file=sys.stderr)
+    for entry in entries:
+        print(format_log_entry(entry), file=sys.stderr)
+
+
+def print_progress(progress, interactive):
+    line = (f"{progress.percent:3d}% {format_size(progress.bytes_sent)}/{format_size(progress.total)} "
+            f"{format_size(progress.rate)}/s 剩余 {format_duration(progress.eta)}")
+    if interactive:
+        sys.stderr.write(f"\r{line}")
+    else:
+        sys.stderr.write(f"{line}\n")
+    sys.stderr.flush()
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.capture and args.ep_in is None:
+        parser.error("--capture 需要同时指定 --ep-in")
+    if args.ack and args.ep_in is None:
+        parser.error("--ack 需要同时指定 --ep-in")
+    if args.mode == TRANSFER_MODE_WINDOW and args.ep_in is None:
+        parser.error("--mode window 需要同时指定 --ep-in")
+    if args.verify and args.ep_in is None:
+        parser.error("--verify 需要同时指定 --ep-in")
+    if args.delta and args.ep_in is None:
+        parser.error("--delta 需要同时指定 --ep-in")
+    use_ack = args.ack or args.mode == TRANSFER_MODE_WINDOW
+    if args.delta_full and not args.delta:
+        parser.error("--delta-full 需要与 --delta 一起使用")
+
+    for path in args.files:
+        if not os.path.isfile(path) or not os.access(path, os.R_OK):
+            print(f"错误: 文件不存在或无法读取: {path}", file=sys.stderr)
+            return EXIT_FILE_ERROR
+    session_pool = None
+    if args.simulate:
+        # 模拟后端只在需要时导入
+        from find_send_simulator import RESPONSE_ACK, RESPONSE_ECHO, SimulatedBackend, SimulatedDevice
+        device = SimulatedDevice(vid=args.vid, pid=args.pid, bus=args.bus or 1, address=args.address or 1,
+                                 interface=args.interface, ep_out=args.ep_out,
+                                 ep_in=args.ep_in if args.ep_in is not None else args.ep_out | 0x80,
+                                 response=RESPONSE_ACK if use_ack else RESPONSE_ECHO, delta_image=args.delta,
+                                 verify=args.verify)
+        session_pool = DeviceSessionPool(backend=SimulatedBackend(device))
+    elif not usb_backend_available():
+        print("错误: 没有可用的USB后端，请安装libusb", file=sys.stderr)
+        return EXIT_NO_BACKEND
+
+    log_buffer = LogBuffer(level=LOG_ERROR if args.quiet else LOG_LEVELS[args.log_level])
+    engine = TransferEngine(args.vid, args.pid, args.interface, args.ep_in, args.ep_out, args.files,
+                            packet_size=args.packet_size,
+                            auto_read=bool(args.capture) or use_ack or args.verify or args.delta,
+                            transfer_mode=args.mode, transfer_size=args.transfer_size,
+                            queue_depth=args.queue_depth, read_ahead_depth=args.read_ahead_depth,
+                            read_ahead_chunk=args.read_ahead_chunk, log_buffer=log_buffer,
+                            auto_tune=args.auto_tune, session_pool=session_pool, bus=args.bus, address=args.address,
+                            capture_path=args.capture, resume=args.resume, use_ack=args.ack,
+                            max_reconnects=args.max_reconnects, delta=args.delta, delta_full=args.delta_full,
+                            verify=args.verify, metrics_dir=args.metrics, trace_path=args.trace,
+                            profile_path=args.profile, record_path=args.record)
+    # 交互终端上进度在同一行刷新，非终端(日志文件/CI)时逐行输出
+    interactive = sys.stderr.isatty() and not args.quiet
+    exit_code = EXIT_OK
+    try:
+        for progress in engine.iter_progress():
+            print_logs(log_buffer)
+            if not args.quiet:
+                print_progress(progress, interactive)
+    except KeyboardInterrupt:
+        exit_code = EXIT_CANCELLED
+    except DeviceNotFoundError:
+        exit_code = EXIT_DEVICE_NOT_FOUND
+    except VerifyError:
+        exit_code = EXIT_VERIFY_FAILED
+    except usb.core.USBError:
+        exit_code = EXIT_TRANSFER_ERROR
+    except OSError:
+        exit_code = EXIT_FILE_ERROR
+    except Exception:
+        exit_code = EXIT_TRANSFER_ERROR
+    if interactive:
+        sys.stderr.write("\n")
+    # 引擎已把错误写入日志，这里一并输出
+    print_logs(log_buffer)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,3575 @@
+'''
+ USB文件发送引擎：文件搜索/索引、设备枚举与会话、发送与接收，不依赖PyQt5，
+ 图形界面(find-send-byusb.py)和命令行(find_send_cli.py)共用
+'''
+import os
+import re
+import json
+import time
+import zlib
+import struct
+import usb.core
+import usb.util
+import threading
+import queue
+import platform
+import atexit
+import cProfile
+import ctypes
+import mmap
+import array
+import collections
+import fnmatch
+import hashlib
+import bisect
+import pickle
+import concurrent.futures
+
+# inotify为可选依赖(pip install inotify_simple)，不可用时按目录mtime增量刷新索引
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+# 发送模式
+TRANSFER_MODE_BULK = "bulk"        # 高吞吐批量发送，仅在设备反压时节流
+TRANSFER_MODE_LEGACY = "legacy"    # 传统节流：每包固定延迟
+TRANSFER_MODE_WINDOW = "window"    # ACK窗口流控：按设备确认包控制在途数据量
+LEGACY_PACKET_DELAY = 0.01         # 传统模式下每包之后的固定延迟(秒)
+DEFAULT_TRANSFER_SIZE = 16384      # 批量模式下单次写入的默认字节数
+DEFAULT_WRITE_TIMEOUT = 1000       # 单次写入超时(毫秒)
+DEFAULT_QUEUE_DEPTH = 4            # 同时在途的批量传输数量
+DEFAULT_READ_AHEAD_DEPTH = 4       # 预读队列深度，0表示关闭预读线程
+DEFAULT_READ_AHEAD_CHUNK = 262144  # 预读线程单次读取的字节数
+TUNE_TRANSFER_SIZES = (4096, 16384, 65536, 262144)  # 自动调优时校准的批量写入大小
+TUNE_BURST_BYTES = 1024 * 1024     # 每个候选大小的校准数据量(文件较小时按文件大小平分)
+TUNE_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".find-send-byusb", "tuning.json")
+RESUME_MAX_RECONNECTS = 5          # 传输中断后自动重连续传的最大次数
+RESUME_RECONNECT_DELAY = 0.5       # 第一次重连前的等待(秒)，之后每次加倍
+RESUME_RECONNECT_MAX_DELAY = 8.0   # 重连等待的上限(秒)
+CHECKPOINT_PATH = os.path.join(os.path.expanduser("~"), ".find-send-byusb", "checkpoints.json")
+
+# 设备确认包：4字节标识 + 本次确认的字节数(小端uint32)，设备每收到一次写入回复一个
+ACK_MAGIC = b'ACK\x00'
+ACK_FORMAT = '<4sI'
+ACK_SIZE = struct.calcsize(ACK_FORMAT)
+
+# 差量发送：按块哈希与设备上次收到的镜像比较，只发送变化的块
+DELTA_BLOCK_SIZE = 4096            # 哈希分块大小
+DELTA_MAX_FRAME = 65536            # 相邻变化块合并后单个数据帧的最大负载
+DELTA_HASH_SIZE = 16               # 块哈希长度(blake2b)
+DELTA_HASH_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".find-send-byusb", "block_hashes.json")
+DELTA_HASH_CACHE_ENTRIES = 256     # 块哈希缓存保留的文件数
+DELTA_MANIFEST_PATH = os.path.join(os.path.expanduser("~"), ".find-send-byusb", "delta_manifests.json")
+
+# 差量帧格式(小端)：帧头20字节 = 标识 DLT\x01 | 类型(uint8) | 标志(uint8) | 保留(uint16) | 负载长度(uint32) | 偏移(uint64)，
+# 帧头后紧跟负载。一个镜像的帧流为 BEGIN、若干DATA、END：
+#   BEGIN  偏移=新镜像大小，负载=基础镜像标签(uint64) + 新镜像标签(uint64)；DELTA_FLAG_FULL表示整个镜像都会发送
+#   DATA   偏移=镜像内的位置，负载=该位置的新数据
+#   END    偏移=新镜像大小，负载=新镜像的CRC32(uint32)
+# 设备在当前镜像的副本上应用DATA，收到END时截断/扩展到新大小并校验CRC32，通过后替换当前镜像并记下新标签；
+# 非完整发送且基础镜像标签与设备当前镜像不符时，设备应丢弃到下一个BEGIN为止。END之后的补零字节忽略。
+# 设备每收到一个END(包括被丢弃的帧流)，在输入端点回复一个STATUS帧：
+#   STATUS 标志=结果(DELTA_STATUS_*)，偏移=设备当前镜像大小，负载=设备当前镜像标签(uint64)
+# 主机收到“已应用”且标签为新镜像标签后才记录清单，否则清除该设备的清单，下次完整发送
+DELTA_MAGIC = b'DLT\x01'
+DELTA_HEADER_FORMAT = '<4sBBHIQ'
+DELTA_HEADER_SIZE = struct.calcsize(DELTA_HEADER_FORMAT)
+DELTA_BEGIN_FORMAT = '<QQ'
+DELTA_END_FORMAT = '<I'
+DELTA_FRAME_BEGIN = 1
+DELTA_FRAME_DATA = 2
+DELTA_FRAME_END = 3
+DELTA_FRAME_STATUS = 4
+DELTA_FLAG_FULL = 0x01
+DELTA_STATUS_FORMAT = '<Q'
+DELTA_STATUS_SIZE = DELTA_HEADER_SIZE + struct.calcsize(DELTA_STATUS_FORMAT)
+DELTA_STATUS_APPLIED = 0           # 已应用，设备镜像已替换为新镜像
+DELTA_STATUS_BASE_MISMATCH = 1     # 设备上不是差量的基础镜像，整个帧流被丢弃
+DELTA_STATUS_CRC_MISMATCH = 2      # 应用后CRC32不符，设备保留原镜像
+DELTA_STATUS_TIMEOUT = 5.0         # 等待设备回复STATUS帧的超时(秒)
+# 完整性校验：发送时在预读线程中计算CRC32/SHA-256，按路径/大小/修改时间缓存
+DIGEST_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".find-send-byusb", "digests.json")
+DIGEST_CACHE_ENTRIES = 1024        # 摘要缓存保留的文件数
+# 校验请求(主机单独写入)：标识 VRFY + 文件长度(uint64)；
+# 设备回复：标识 DGST + 长度(uint64) + CRC32(uint32) + SHA-256(32字节)，按上一次校验请求之后收到的前“长度”个字节计算
+VERIFY_MAGIC = b'VRFY'
+VERIFY_REQUEST_FORMAT = '<4sQ'
+DIGEST_MAGIC = b'DGST'
+DIGEST_REPORT_FORMAT = '<4sQI32s'
+DIGEST_REPORT_SIZE = struct.calcsize(DIGEST_REPORT_FORMAT)
+VERIFY_TIMEOUT = 5.0               # 等待设备回复校验结果的超时(秒)
+# 传输指标：写入/读取延迟直方图、吞吐随时间变化、超时重试、队列等待和各阶段耗时
+METRICS_DIR = os.path.join(os.path.expanduser("~"), ".find-send-byusb", "metrics")
+METRICS_KEEP = 100                 # 指标目录中保留的JSON摘要数
+METRICS_RATE_INTERVAL = 1.0        # 吞吐采样间隔(秒)
+METRICS_MAX_SAMPLES = 3600         # 吞吐采样点上限，超过后合并相邻采样点并加倍采样间隔
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5)   # 延迟直方图各桶上限(秒)
+# 跟踪与性能分析：命名区间按Chrome跟踪格式导出(chrome://tracing、Perfetto可直接打开)
+TRACE_DIR = os.path.join(os.path.expanduser("~"), ".find-send-byusb", "traces")
+TRACE_MAX_EVENTS = 1000000         # 内存中保留的最近跟踪事件数
+TRACE_ENV = "FIND_SEND_TRACE"      # 环境变量设为文件路径时启动即开启跟踪，进程退出时写入该文件
+# 该文件存在时下一次传输保存cProfile结果和跟踪文件到TRACE_DIR，随后删除(不用改代码或重启即可分析某台工位)
+PROFILE_TRIGGER_PATH = os.path.join(os.path.expanduser("~"), ".find-send-byusb", "profile-next")
+# 会话录制(小端)：文件头 = 标识 FSSESS01 + 开始时间(double，Unix秒)，之后为连续的记录；
+# 记录 = 相对开始的纳秒(uint64) | 方向(uint8，0发送/1接收) | 端点地址(uint8) | 长度(uint32) + 数据。
+# 关闭时另写索引文件(会话文件名+.idx)：标识 FSIDX001 | 会话文件大小(uint64) | 记录数(uint64)，
+# 之后依次为各记录的文件偏移(uint64[])、时间(uint64[])、长度(uint32[])、方向<<8|端点(uint16[])
+SESSION_MAGIC = b'FSSESS01'
+SESSION_HEADER_FORMAT = '<8sd'
+SESSION_HEADER_SIZE = struct.calcsize(SESSION_HEADER_FORMAT)
+SESSION_RECORD_FORMAT = '<QBBI'
+SESSION_RECORD_SIZE = struct.calcsize(SESSION_RECORD_FORMAT)
+SESSION_DIR_OUT = 0
+SESSION_DIR_IN = 1
+SESSION_INDEX_MAGIC = b'FSIDX001'
+SESSION_INDEX_FORMAT = '<8sQQ'
+SESSION_INDEX_SUFFIX = ".idx"
+SESSION_DIR = os.path.join(os.path.expanduser("~"), ".find-send-byusb", "sessions")
+ACK_WINDOW_INITIAL = 4             # ACK窗口流控的初始窗口(未确认的写入次数)
+ACK_WINDOW_MIN = 1
+ACK_WINDOW_MAX = 64
+ACK_WAIT_TIMEOUT = 0.5             # 窗口已满时等待确认的超时(秒)，超时后窗口减半
+ACK_MAX_STALLS = 8                 # 连续等待确认超时的次数上限，超过后按USB错误处理(重连续传)
+
+# 日志级别
+LOG_TRACE = 5      # 逐包十六进制数据
+LOG_DEBUG = 10
+LOG_INFO = 20
+LOG_WARNING = 30
+LOG_ERROR = 40
+LOG_LEVEL_NAMES = {LOG_TRACE: "TRACE", LOG_DEBUG: "DEBUG", LOG_INFO: "INFO",
+                   LOG_WARNING: "WARN", LOG_ERROR: "ERROR"}
+LOG_BUFFER_CAPACITY = 20000        # 内存环形缓冲区保留的日志条数
+LOG_FLUSH_INTERVAL = 100           # 日志刷新到界面的间隔(毫秒)
+PROGRESS_MIN_INTERVAL = 0.2        # 两次进度事件之间的最小间隔(秒)
+PROGRESS_MAX_INTERVAL = 1.0        # 进度百分比不变时也至少每隔多久刷新一次速率
+PROGRESS_MIN_STEP = 1              # 触发进度事件的最小百分比变化
+
+# 文件名匹配方式
+MATCH_SUBSTRING = "substring"
+MATCH_GLOB = "glob"
+MATCH_REGEX = "regex"
+INDEX_DIR = os.path.join(os.path.expanduser("~"), ".find-send-byusb", "index")
+INDEX_VERSION = 1
+SEARCH_WORKERS = 8                 # 并行遍历目录的线程数
+SEARCH_BATCH_SIZE = 500            # 每批推送到界面的最大结果数
+SEARCH_BATCH_INTERVAL = 0.1        # 结果不足一批时的推送间隔(秒)
+
+DEVICE_POLL_INTERVAL = 2.0         # 设备列表轮询对比的间隔(秒)
+SESSION_POOL_SIZE = 4              # 设备会话池保留的最大会话数
+RECEIVE_READ_SIZE = 16384          # 接收端单次读取的最大字节数(按wMaxPacketSize对齐)
+RECEIVE_READ_TIMEOUT = 100         # 接收端单次读取超时(毫秒)
+RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024  # 接收环形缓冲区大小
+RECEIVE_NOTIFY_INTERVAL = 0.1      # 向界面汇总通知接收数据的间隔(秒)
+RECEIVE_DRAIN_TIME = 0.5           # 发送结束后继续读出设备剩余数据的最长时间(秒)
+HEX_DUMP_WIDTH = 16                # 十六进制视图每行字节数
+HEX_VIEW_CAPACITY = 64 * 1024 * 1024  # 十六进制视图保留的最大接收字节数
+
+# 搜索结果排序方式
+SORT_NONE = None
+SORT_NAME = "name"
+SORT_SIZE = "size"
+SORT_MTIME = "mtime"
+
+# 搜索选项：最大深度(None不限，0只搜根目录)、排除目录名(支持通配符)、文件大小范围(字节)
+SearchOptions = collections.namedtuple(
+    'SearchOptions', ['max_depth', 'exclude_dirs', 'min_size', 'max_size'],
+    defaults=[None, (), None, None])
+
+
+def is_usb_timeout(e):
+    """判断USB异常是否为超时/NAK反压(各平台错误码不同)"""
+    timeout_error = getattr(usb.core, 'USBTimeoutError', None)
+    if timeout_error is not None and isinstance(e, timeout_error):
+        return True
+    return e.errno == 110 or getattr(e, 'backend_error_code', None) == -7
+
+
+class BackpressurePacer:
+    """根据设备反压自适应调整发送间隔：无反压时不延迟，出现超时/NAK时指数退避"""
+
+    def __init__(self, min_delay=0.0005, max_delay=0.1, max_retries=8):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self.delay = 0.0
+        self.retries = 0
+        self.pushback_count = 0
+
+    def on_success(self):
+        # 写入成功后逐步减小延迟，直到完全取消节流
+        self.retries = 0
+        self.delay = self.delay / 2 if self.delay > self.min_delay else 0.0
+
+    def on_pushback(self):
+        # 设备反压时加倍延迟；连续重试超过上限则返回False
+        self.retries += 1
+        self.pushback_count += 1
+        self.delay = min(max(self.delay * 2, self.min_delay), self.max_delay)
+        return self.retries <= self.max_retries
+
+    def wait(self):
+        if self.delay:
+            time.sleep(self.delay)
+
+
+class AckWindow:
+    """ACK窗口：最多limit个写入未被设备确认；确认到达时增大窗口(低于阈值时倍增，之后线性增长)，
+    等待确认超时或写入被NAK时窗口减半，类似TCP拥塞控制，发送速率收敛到设备实际能处理的速率"""
+
+    def __init__(self, initial=ACK_WINDOW_INITIAL, minimum=ACK_WINDOW_MIN, maximum=ACK_WINDOW_MAX):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = float(initial)
+        self.threshold = float(maximum)
+        self.peak = self.window
+        self.timeouts = 0
+
+    @property
+    def limit(self):
+        return max(self.minimum, int(self.window))
+
+    def on_ack(self, writes):
+        """设备确认了writes个写入(按字节数折算，可以是小数)"""
+        if self.window < self.threshold:
+            self.window += writes
+        else:
+            self.window += writes / self.window
+        self.window = min(self.window, self.maximum)
+        self.peak = max(self.peak, self.window)
+
+    def on_timeout(self):
+        self.timeouts += 1
+        self.threshold = max(self.minimum, self.window / 2)
+        self.window = self.threshold
+
+    def summary(self):
+        return f"ACK窗口: 当前 {self.limit}，最大 {int(self.peak)}，超时收缩 {self.timeouts} 次"
+
+class MappedFileSource:
+    """内存映射的文件数据源：按块返回memoryview切片，只有最后不足一包的数据从预分配缓冲区补齐"""
+
+    def __init__(self, file_path, packet_size):
+        self.packet_size = packet_size
+        self._file = open(file_path, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+        # 空文件无法映射
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+        self._view = memoryview(self._mmap) if self._mmap is not None else memoryview(b'')
+        self._pad = bytearray(packet_size)
+
+    def chunks(self, chunk_size, start=0):
+        """依次返回chunk_size(应为包大小的整数倍)大小的切片；末尾先返回按包对齐的部分，再返回补零后的最后一包"""
+        offset = start
+        while offset < self.size:
+            end = min(offset + chunk_size, self.size)
+            tail = (self.size - start) % self.packet_size if end == self.size else 0
+            if tail == 0:
+                yield self._view[offset:end]
+            else:
+                aligned_end = end - tail
+                if aligned_end > offset:
+                    yield self._view[offset:aligned_end]
+                self._pad[:tail] = self._view[aligned_end:end]
+                self._pad[tail:] = bytes(self.packet_size - tail)
+                yield memoryview(self._pad)
+            offset = end
+
+    def close(self):
+        self._view.release()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # 仍有切片被引用时交给垃圾回收关闭
+                pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SharedFileData:
+    """一次性读入内存并补齐末包的文件数据，多个设备的发送线程共享同一份只读数据"""
+
+    def __init__(self, file_path, packet_size):
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        self.size = len(data)
+        remainder = self.size % packet_size
+        if remainder:
+            data += bytes(packet_size - remainder)
+        self._view = memoryview(data)
+
+    def chunks(self, chunk_size, start=0):
+        # 切片不共享任何可变状态，可在多个线程中同时迭代
+        for offset in range(start, len(self._view), chunk_size):
+            yield self._view[offset:offset + chunk_size]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class WriteBuffer:
+    """可复用的写缓冲区：把memoryview拷入预分配的array('B')，pyusb可直接使用而不再逐字节转换"""
+
+    def __init__(self):
+        self._arrays = {}
+
+    def load(self, view):
+        length = len(view)
+        buf = self._arrays.get(length)
+        if buf is None:
+            buf = self._arrays[length] = array.array('B', bytes(length))
+        memoryview(buf)[:] = view
+        return buf
+
+
+class BulkWriter:
+    """同步批量写入，write()返回(设备实际接收的字节数, 超时异常或None)
+
+    pyusb的write超时时不返回已被设备接收的字节数，整块重发会让设备收到重复数据：
+    libusb1后端直接调用libusb_bulk_transfer取得实际字节数；后端提供bulk_write_partial时(如模拟设备)使用它；
+    其它后端按wMaxPacketSize逐包写入(granularity)，单个包要么整包被接收要么没有，超时后重发不会重复"""
+
+    def __init__(self, device, ep_out):
+        self.ep_out = ep_out
+        self.endpoint = ep_out.bEndpointAddress
+        self.granularity = None
+        backend = device._ctx.backend
+        if AsyncBulkSender.is_supported(device):
+            from usb.backend import libusb1
+            self._libusb1 = libusb1
+            device._ctx.managed_open()
+            self._handle = device._ctx.handle.handle
+            self.write = self._write_libusb1
+        elif hasattr(backend, 'bulk_write_partial'):
+            device._ctx.managed_open()
+            self._backend = backend
+            self._handle = device._ctx.handle
+            self._interface = getattr(ep_out, 'interface', 0)
+            self.write = self._write_backend
+        else:
+            self.granularity = getattr(ep_out, 'wMaxPacketSize', 0) or None
+            self.write = self._write_pyusb
+
+    def _write_libusb1(self, data, timeout):
+        if not isinstance(data, array.array):
+            data = array.array('B', data)
+        address, length = data.buffer_info()
+        transferred = ctypes.c_int()
+        ret = self._libusb1._lib.libusb_bulk_transfer(self._handle, self.endpoint,
+                                                      ctypes.cast(address, ctypes.POINTER(ctypes.c_ubyte)),
+                                                      length, ctypes.byref(transferred), timeout)
+        try:
+            self._libusb1._check(ret)
+        except usb.core.USBError as e:
+            if not is_usb_timeout(e):
+                raise
+            return transferred.value, e
+        return transferred.value, None
+
+    def _write_backend(self, data, timeout):
+        return self._backend.bulk_write_partial(self._handle, self.endpoint, self._interface, data, timeout)
+
+    def _write_pyusb(self, data, timeout):
+        try:
+            return self.ep_out.write(data, timeout=timeout), None
+        except usb.core.USBError as e:
+            if not is_usb_timeout(e):
+                raise
+            return 0, e
+
+
+class ReadAheadPipeline:
+    """双缓冲读写流水线：读取线程把数据块预取到有界队列，发送端从队列取出，互不阻塞"""
+
+    def __init__(self, source, data_queue, read_chunk_size=DEFAULT_READ_AHEAD_CHUNK, digest=None):
+        self.source = source
+        self.size = source.size
+        self.data_queue = data_queue
+        self.read_chunk_size = read_chunk_size
+        # 可选的StreamingDigest，在读取线程中随数据一起计算，不占用USB发送循环
+        self.digest = digest
+        self.reader_stalls = 0        # 队列已满、读取端等待发送端的次数
+        self.reader_wait_time = 0.0
+        self.writer_stalls = 0        # 队列为空、发送端等待读取端的次数
+        self.writer_wait_time = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+        # 预分配缓冲区池，读取端取空闲缓冲区，发送端用完后归还
+        self._free = queue.Queue()
+
+    def chunks(self, chunk_size, start=0):
+        """从队列中取出预读的数据块，再按chunk_size切分返回；start为开始读取的文件偏移(续传)"""
+        block_size = max(chunk_size, self.read_chunk_size - self.read_chunk_size % chunk_size)
+        for _ in range((self.data_queue.maxsize or DEFAULT_READ_AHEAD_DEPTH) + 2):
+            self._free.put(bytearray(block_size))
+        self._thread = threading.Thread(target=self._reader, args=(block_size, start), name="read-ahead", daemon=True)
+        self._thread.start()
+        while True:
+            try:
+                item = self.data_queue.get_nowait()
+            except queue.Empty:
+                self.writer_stalls += 1
+                started = time.perf_counter()
+                item = self.data_queue.get()
+                self.writer_wait_time += time.perf_counter() - started
+                if tracer.enabled:
+                    tracer.complete("read_ahead.wait", started)
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            buf, length = item
+            view = memoryview(buf)[:length]
+            for offset in range(0, length, chunk_size):
+                yield view[offset:offset + chunk_size]
+            self._free.put(buf)
+
+    def _reader(self, block_size, start):
+        try:
+            for chunk in self.source.chunks(block_size, start):
+                buf = self._free.get()
+                if self._stop.is_set():
+                    return
+                length = len(chunk)
+                # 在读取线程中拷贝，磁盘/网络读取的等待不会阻塞USB发送
+                buf[:length] = chunk
+                if self.digest is not None:
+                    self.digest.update(memoryview(buf)[:length])
+                if not self._put((buf, length)):
+                    return
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        try:
+            self.data_queue.put_nowait(item)
+            return True
+        except queue.Full:
+            self.reader_stalls += 1
+        started = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                self.data_queue.put(item, timeout=0.1)
+                self.reader_wait_time += time.perf_counter() - started
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def stall_summary(self):
+        """根据双方等待时间判断瓶颈所在"""
+        bottleneck = "读取端" if self.writer_wait_time > self.reader_wait_time else "USB发送端"
+        return (f"预读统计: 读取端等待 {self.reader_stalls} 次 ({self.reader_wait_time:.2f}s)，"
+                f"发送端等待 {self.writer_stalls} 次 ({self.writer_wait_time:.2f}s)，瓶颈: {bottleneck}")
+
+    def close(self):
+        self._stop.set()
+        # 归还一个缓冲区并清空队列，让阻塞中的读取线程退出
+        self._free.put(bytearray(0))
+        self._drain()
+        if self._thread is not None:
+            self._thread.join(1.0)
+        # 读取线程退出前可能又放入一块数据，队列由下一次发送复用(续传)，必须清空
+        self._drain()
+
+    def _drain(self):
+        while True:
+            try:
+                self.data_queue.get_nowait()
+            except queue.Empty:
+                break
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TransferSizeTuner:
+    """批量写入大小校准：依次用每个候选大小发送一段数据并计时，选出没有超时/错误且最快的大小"""
+
+    def __init__(self, candidates, burst_bytes=TUNE_BURST_BYTES):
+        self.candidates = list(candidates)
+        self.burst_bytes = burst_bytes
+        self.max_size = max(self.candidates)
+        self.results = {}     # 大小 -> [字节数, 耗时, 错误次数]
+        self._index = 0
+
+    @classmethod
+    def for_endpoint(cls, unit, data_size, burst_bytes=TUNE_BURST_BYTES):
+        """候选大小按端点写入单位(wMaxPacketSize与包大小的较大者)对齐；
+        每个候选的校准数据量按要发送的数据量平分，小文件也能校准完所有候选"""
+        sizes = sorted({max(unit, size - size % unit) for size in TUNE_TRANSFER_SIZES})
+        return cls(sizes, max(1, min(burst_bytes, data_size // len(sizes))))
+
+    @property
+    def size(self):
+        return self.candidates[self._index]
+
+    @property
+    def done(self):
+        return self._index >= len(self.candidates)
+
+    def record(self, length, elapsed, errors=0):
+        result = self.results.setdefault(self.size, [0, 0.0, 0])
+        result[0] += length
+        result[1] += elapsed
+        result[2] += errors
+        if result[0] >= self.burst_bytes:
+            self._index += 1
+
+    def rate(self, size):
+        length, elapsed, _ = self.results[size]
+        return length / elapsed if elapsed > 0 else float('inf')
+
+    def best(self):
+        """错误最少的候选中速度最快的大小；还没有任何测量时返回None"""
+        if not self.results:
+            return None
+        return min(self.results, key=lambda size: (self.results[size][2], -self.rate(size)))
+
+    def summary(self):
+        return "，".join(f"{size}: {format_size(self.rate(size))}/s" +
+                        (f" (错误 {self.results[size][2]} 次)" if self.results[size][2] else "")
+                        for size in sorted(self.results))
+
+
+def write_text_atomic(path, text):
+    """先写临时文件再替换，进程中途退出或其他程序同时读取时不会看到半个文件；返回是否写入成功"""
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+        return True
+    except OSError:
+        return False
+
+
+def write_json_atomic(path, data):
+    return write_text_atomic(path, json.dumps(data, indent=1))
+
+
+class JsonFileStore:
+    """保存在JSON文件中的键值记录：首次使用时读入，修改后整体原子写回；子类在self._lock内读写"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = None
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def _save(self):
+        # 这些记录都只是优化或提示，写入失败时本次进程内仍然有效
+        return write_json_atomic(self.path, self._entries)
+
+
+class TransferSizeCache(JsonFileStore):
+    """按VID/PID/接口/端点缓存校准结果(JSON文件)，之后的传输直接使用"""
+
+    def __init__(self, path=TUNE_CACHE_PATH):
+        super().__init__(path)
+
+    @staticmethod
+    def key(vid, pid, interface_num, endpoint):
+        return f"{vid:04x}:{pid:04x}:{interface_num}:{endpoint:02x}"
+
+    def get(self, key, max_packet_size):
+        """返回缓存的写入大小；端点wMaxPacketSize变化(如换了固件)时缓存失效"""
+        with self._lock:
+            entry = self._load().get(key)
+        if entry is None or entry.get('max_packet_size') != max_packet_size:
+            return None
+        return entry['transfer_size']
+
+    def put(self, key, max_packet_size, transfer_size, rate):
+        with self._lock:
+            self._load()[key] = {'transfer_size': transfer_size, 'max_packet_size': max_packet_size,
+                                 'rate': round(rate), 'time': time.time()}
+            self._save()
+
+
+# 进程内共享的校准缓存，群发时多个发送线程同时写入也不会冲突
+default_tune_cache = TransferSizeCache()
+
+
+class TransferCheckpointStore(JsonFileStore):
+    """断点记录(JSON文件)：按设备端点保存中断时正在发送的文件和已确认的偏移，下次发送同一文件时从该处继续"""
+
+    def __init__(self, path=CHECKPOINT_PATH):
+        super().__init__(path)
+
+    def find(self, key, file_paths):
+        """返回(文件序号, 偏移)；记录的文件不在本次列表中或已被修改(大小/修改时间变化)时返回(0, 0)"""
+        with self._lock:
+            entry = self._load().get(key)
+        if entry is None:
+            return 0, 0
+        for index, path in enumerate(file_paths):
+            if os.path.abspath(path) != entry['path']:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                break
+            if stat.st_size == entry['size'] and stat.st_mtime == entry['mtime']:
+                return index, entry['offset']
+            break
+        return 0, 0
+
+    def save(self, key, path, offset):
+        stat = os.stat(path)
+        with self._lock:
+            self._load()[key] = {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime,
+                                 'offset': offset, 'time': time.time()}
+            self._save()
+
+    def clear(self, key):
+        with self._lock:
+            if self._load().pop(key, None) is not None:
+                self._save()
+
+
+default_checkpoint_store = TransferCheckpointStore()
+
+
+class StreamingDigest:
+    """边读边算的CRC32和SHA-256；超过文件大小的部分(末包补零)不计入"""
+
+    def __init__(self, size):
+        self.size = size
+        self.length = 0
+        self.crc32 = 0
+        self._sha256 = hashlib.sha256()
+
+    def update(self, data):
+        data = data[:self.size - self.length]
+        self.length += len(data)
+        self.crc32 = zlib.crc32(data, self.crc32)
+        self._sha256.update(data)
+
+    @property
+    def complete(self):
+        return self.length == self.size
+
+    @property
+    def sha256(self):
+        return self._sha256.hexdigest()
+
+
+def format_digest(crc32, sha256):
+    return f"CRC32 {crc32:08X} | SHA-256 {sha256}"
+
+
+class FileDigestCache(JsonFileStore):
+    """文件摘要缓存(JSON文件)：按路径保存大小、修改时间、CRC32和SHA-256，重复发送同一文件不再计算"""
+
+    def __init__(self, path=DIGEST_CACHE_PATH, max_entries=DIGEST_CACHE_ENTRIES):
+        super().__init__(path)
+        self.max_entries = max_entries
+
+    def lookup(self, path, size=None, mtime=None):
+        """返回缓存的(CRC32, SHA-256)，没有或文件已修改时返回None；
+        调用方已知大小和修改时间(如搜索结果)时不访问文件系统"""
+        if size is None or mtime is None:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return None
+            size, mtime = stat.st_size, stat.st_mtime
+        with self._lock:
+            entry = self._load().get(os.path.abspath(path))
+        if entry is None or (entry['size'], entry['mtime']) != (size, mtime):
+            return None
+        return entry['crc32'], entry['sha256']
+
+    def get(self, path):
+        """返回(CRC32, SHA-256)，没有缓存时读取文件计算并缓存"""
+        cached = self.lookup(path)
+        if cached is not None:
+            return cached
+        stat = os.stat(path)
+        digest = StreamingDigest(stat.st_size)
+        with open(path, 'rb') as f:
+            buf = bytearray(DEFAULT_READ_AHEAD_CHUNK)
+            view = memoryview(buf)
+            while True:
+                length = f.readinto(buf)
+                if not length:
+                    break
+                digest.update(view[:length])
+        self.put(path, stat, digest)
+        return digest.crc32, digest.sha256
+
+    def put(self, path, stat, digest):
+        """记录摘要；与已缓存的内容相同时只更新内存中的使用时间，不重写JSON文件"""
+        with self._lock:
+            entries = self._load()
+            key = os.path.abspath(path)
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'crc32': digest.crc32,
+                     'sha256': digest.sha256, 'time': time.time()}
+            old_entry = entries.get(key)
+            entries[key] = entry
+            if old_entry is not None and all(old_entry.get(field) == entry[field]
+                                             for field in ('size', 'mtime', 'crc32', 'sha256')):
+                return
+            for old in sorted(entries, key=lambda k: entries[k]['time'])[:max(0, len(entries) - self.max_entries)]:
+                del entries[old]
+            self._save()
+
+
+default_digest_cache = FileDigestCache()
+
+
+def pack_delta_header(frame_type, offset, length, flags=0):
+    return struct.pack(DELTA_HEADER_FORMAT, DELTA_MAGIC, frame_type, flags, 0, length, offset)
+
+
+def parse_delta_header(data, pos=0):
+    """解析帧头，返回(类型, 标志, 负载长度, 偏移)；标识不符时抛出ValueError"""
+    magic, frame_type, flags, _, length, offset = struct.unpack_from(DELTA_HEADER_FORMAT, data, pos)
+    if magic != DELTA_MAGIC:
+        raise ValueError("差量帧标识错误")
+    return frame_type, flags, length, offset
+
+
+def manifest_tag(hashes, size):
+    """镜像标签：由大小和全部块哈希导出的非0 uint64，设备据此判断自己持有的是否为差量的基础镜像"""
+    digest = hashlib.blake2b(size.to_bytes(8, 'little') + hashes, digest_size=8).digest()
+    return int.from_bytes(digest, 'little') or 1
+
+
+class BlockHashCache(JsonFileStore):
+    """文件分块哈希缓存(JSON文件)：按路径保存大小、修改时间、块哈希和CRC32，文件未修改时不再重新计算"""
+
+    def __init__(self, path=DELTA_HASH_CACHE_PATH, block_size=DELTA_BLOCK_SIZE,
+                 max_entries=DELTA_HASH_CACHE_ENTRIES):
+        super().__init__(path)
+        self.block_size = block_size
+        self.max_entries = max_entries
+
+    def get(self, path):
+        """返回(块哈希拼接的bytes, 文件大小, CRC32)"""
+        key = os.path.abspath(path)
+        stat = os.stat(path)
+        with self._lock:
+            entry = self._load().get(key)
+        if entry is not None and (entry['size'], entry['mtime'], entry['block_size']) == \
+                (stat.st_size, stat.st_mtime, self.block_size):
+            return bytes.fromhex(entry['hashes']), entry['size'], entry['crc32']
+
+        hashes = bytearray()
+        crc = 0
+        with open(path, 'rb') as f:
+            buf = bytearray(self.block_size)
+            view = memoryview(buf)
+            while True:
+                length = f.readinto(buf)
+                if not length:
+                    break
+                block = view[:length]
+                hashes += hashlib.blake2b(block, digest_size=DELTA_HASH_SIZE).digest()
+                crc = zlib.crc32(block, crc)
+        hashes = bytes(hashes)
+        with self._lock:
+            entries = self._load()
+            entries[key] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'block_size': self.block_size,
+                            'hashes': hashes.hex(), 'crc32': crc, 'time': time.time()}
+            # 只保留最近使用的文件
+            for old in sorted(entries, key=lambda k: entries[k]['time'])[:max(0, len(entries) - self.max_entries)]:
+                del entries[old]
+            self._save()
+        return hashes, stat.st_size, crc
+
+
+class DeltaManifestStore(JsonFileStore):
+    """按设备保存最近一次送达的镜像清单(块哈希)，下次向该设备发送时只发送变化的块"""
+
+    def __init__(self, path=DELTA_MANIFEST_PATH):
+        super().__init__(path)
+
+    def get(self, device_id):
+        with self._lock:
+            return self._load().get(device_id)
+
+    def put(self, device_id, path, plan):
+        with self._lock:
+            self._load()[device_id] = plan.manifest(path)
+            self._save()
+
+    def clear(self, device_id):
+        with self._lock:
+            if self._load().pop(device_id, None) is not None:
+                self._save()
+
+
+default_hash_cache = BlockHashCache()
+default_manifest_store = DeltaManifestStore()
+
+
+class DeltaPlan:
+    """差量发送计划：与设备上次收到的镜像清单逐块比较，相邻的变化块合并为数据帧；没有可用清单时整个镜像都发送"""
+
+    def __init__(self, hashes, size, crc, base=None, block_size=DELTA_BLOCK_SIZE, max_frame=DELTA_MAX_FRAME):
+        self.hashes = hashes
+        self.size = size
+        self.crc = crc
+        self.block_size = block_size
+        self.tag = manifest_tag(hashes, size)
+        self.block_count = len(hashes) // DELTA_HASH_SIZE
+        base_hashes = None
+        if base is not None and base.get('block_size') == block_size:
+            base_hashes = bytes.fromhex(base['hashes'])
+        self.full = base_hashes is None
+        self.base_tag = 0 if self.full else base['tag']
+
+        # 变化的块按偏移合并为(偏移, 长度)，单帧不超过max_frame
+        self.ranges = []
+        for index in range(self.block_count):
+            digest = hashes[index * DELTA_HASH_SIZE:(index + 1) * DELTA_HASH_SIZE]
+            if not self.full and base_hashes[index * DELTA_HASH_SIZE:(index + 1) * DELTA_HASH_SIZE] == digest:
+                continue
+            offset = index * block_size
+            length = min(block_size, size - offset)
+            if self.ranges and sum(self.ranges[-1]) == offset and self.ranges[-1][1] + length <= max_frame:
+                self.ranges[-1] = (self.ranges[-1][0], self.ranges[-1][1] + length)
+            else:
+                self.ranges.append((offset, length))
+        self.changed_blocks = sum((length + block_size - 1) // block_size for _, length in self.ranges)
+        self.payload_size = sum(length for _, length in self.ranges)
+        self.stream_size = (DELTA_HEADER_SIZE * (len(self.ranges) + 2) + struct.calcsize(DELTA_BEGIN_FORMAT) +
+                            struct.calcsize(DELTA_END_FORMAT) + self.payload_size)
+
+    def manifest(self, path):
+        return {'path': os.path.abspath(path), 'size': self.size, 'block_size': self.block_size,
+                'hashes': self.hashes.hex(), 'tag': self.tag, 'time': time.time()}
+
+    def summary(self):
+        if self.full:
+            return f"差量发送: 设备没有可用的基础镜像清单，完整发送 {self.block_count} 块"
+        return (f"差量发送: {self.changed_blocks}/{self.block_count} 块有变化，"
+                f"发送 {format_size(self.stream_size)} (镜像 {format_size(self.size)})")
+
+
+class DeltaFrameSource:
+    """差量发送的数据源：把计划中的帧(帧头 + 文件数据)拼成连续字节流，接口与MappedFileSource相同，
+    各发送模式和断点续传按帧流偏移工作，不需要区分是否差量"""
+
+    def __init__(self, source, plan, packet_size):
+        self.source = source
+        self.plan = plan
+        self.packet_size = packet_size
+        self.size = plan.stream_size
+        self._view = source._view
+
+    def frames(self):
+        plan = self.plan
+        yield pack_delta_header(DELTA_FRAME_BEGIN, plan.size, struct.calcsize(DELTA_BEGIN_FORMAT),
+                                DELTA_FLAG_FULL if plan.full else 0) + \
+            struct.pack(DELTA_BEGIN_FORMAT, plan.base_tag, plan.tag)
+        for offset, length in plan.ranges:
+            yield pack_delta_header(DELTA_FRAME_DATA, offset, length)
+            yield self._view[offset:offset + length]
+        yield pack_delta_header(DELTA_FRAME_END, plan.size, struct.calcsize(DELTA_END_FORMAT)) + \
+            struct.pack(DELTA_END_FORMAT, plan.crc)
+
+    def chunks(self, chunk_size, start=0):
+        """按chunk_size切分帧流，从流偏移start开始；最后一块补零到包大小的整数倍"""
+        buf = bytearray(chunk_size)
+        fill = 0
+        skip = start
+        for piece in self.frames():
+            piece = memoryview(piece)
+            if skip:
+                if len(piece) <= skip:
+                    skip -= len(piece)
+                    continue
+                piece, skip = piece[skip:], 0
+            while piece:
+                length = min(len(piece), chunk_size - fill)
+                buf[fill:fill + length] = piece[:length]
+                fill += length
+                piece = piece[length:]
+                if fill == chunk_size:
+                    yield memoryview(buf)
+                    fill = 0
+        if fill:
+            pad = -fill % self.packet_size
+            buf[fill:fill + pad] = bytes(pad)
+            yield memoryview(buf)[:fill + pad]
+
+    def close(self):
+        self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def format_log_entry(entry):
+    created, level, message = entry
+    timestamp = time.strftime("%H:%M:%S", time.localtime(created))
+    if level == LOG_INFO:
+        return f"[{timestamp}] {message}"
+    return f"[{timestamp}] [{LOG_LEVEL_NAMES.get(level, level)}] {message}"
+
+
+class LogBuffer:
+    """线程安全的日志环形缓冲区：按级别过滤，界面定时批量取出，内存占用有上限"""
+
+    def __init__(self, capacity=LOG_BUFFER_CAPACITY, level=LOG_INFO):
+        self.level = level
+        self._pending = collections.deque()
+        self._capacity = capacity
+        self._dropped = 0
+        self._lock = threading.Lock()
+        self.file_writer = None
+
+    def enabled(self, level):
+        """调用方在格式化开销大的消息(如十六进制)之前先检查级别"""
+        return level >= self.level
+
+    def log(self, level, message):
+        if level < self.level:
+            return
+        entry = (time.time(), level, message)
+        with self._lock:
+            if len(self._pending) >= self._capacity:
+                # 界面来不及刷新时丢弃最旧的待显示条目
+                self._pending.popleft()
+                self._dropped += 1
+            self._pending.append(entry)
+        if self.file_writer is not None:
+            self.file_writer.write(entry)
+
+    def drain(self):
+        """取出自上次刷新以来的日志，返回(条目列表, 丢弃条数)"""
+        with self._lock:
+            entries = list(self._pending)
+            self._pending.clear()
+            dropped, self._dropped = self._dropped, 0
+        return entries, dropped
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+            self._dropped = 0
+
+
+class AsyncLogFileWriter:
+    """后台线程批量写日志文件，写盘不阻塞传输线程和界面"""
+
+    def __init__(self, path, max_queue=LOG_BUFFER_CAPACITY):
+        self.path = path
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._file = open(path, 'a', encoding='utf-8')
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, entry):
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            entry = self._queue.get()
+            batch = [entry]
+            # 一次取出队列中所有条目，合并写入
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            self._file.write(''.join(format_log_entry(e) + '\n' for e in batch if e is not None))
+            self._file.flush()
+            if stop:
+                break
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join(2.0)
+        self._file.close()
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'args', 'started')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.started = 0.0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.complete(self.name, self.started, self.args)
+        return False
+
+
+class Tracer:
+    """命名区间跟踪：关闭时span()返回共享的空上下文，热路径只判断一次enabled属性，几乎没有开销；
+    可在运行中开关，事件保存在有界环形队列中，按Chrome跟踪格式导出"""
+
+    def __init__(self, max_events=TRACE_MAX_EVENTS):
+        self.enabled = False
+        self._requested = False     # 手动开启(set_enabled)
+        self._captures = 0          # 正在采集跟踪文件的传输数
+        self._events = collections.deque(maxlen=max_events)
+        self._lock = threading.Lock()
+
+    def set_enabled(self, enabled):
+        with self._lock:
+            self._requested = enabled
+            self.enabled = self._requested or self._captures > 0
+
+    def span(self, name, **args):
+        """with tracer.span("connect"): ...；用于非逐包的路径"""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args or None)
+
+    def complete(self, name, started, args=None, ended=None):
+        """记录一个已结束的区间；热路径在enabled为True时直接调用，省去上下文对象"""
+        duration = (ended if ended is not None else time.perf_counter()) - started
+        self._events.append((name, started, duration, threading.get_ident(), args))
+
+    def begin_capture(self):
+        """开始为一次传输采集跟踪，返回开始时间(传给end_capture)"""
+        with self._lock:
+            self._captures += 1
+            self.enabled = True
+        return time.perf_counter()
+
+    def end_capture(self, started, path):
+        """结束采集，把开始之后的事件写入path，返回事件数"""
+        with self._lock:
+            self._captures -= 1
+            self.enabled = self._requested or self._captures > 0
+        return self.dump(path, started)
+
+    def dump(self, path, since=None):
+        """写入Chrome跟踪格式文件(时间单位微秒)，返回事件数"""
+        events = [event for event in self._events.copy() if since is None or event[1] >= since]
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        pid = os.getpid()
+        trace = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': names.get(tid, str(tid))}}
+                 for tid in {event[3] for event in events}]
+        for name, started, duration, tid, args in events:
+            entry = {'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                     'ts': round(started * 1e6, 3), 'dur': round(duration * 1e6, 3)}
+            if args:
+                entry['args'] = args
+            trace.append(entry)
+        write_json_atomic(path, {'traceEvents': trace, 'displayTimeUnit': 'ms'})
+        return len(events)
+
+    def clear(self):
+        self._events.clear()
+
+
+tracer = Tracer()
+
+if os.environ.get(TRACE_ENV):
+    tracer.set_enabled(True)
+    atexit.register(tracer.dump, os.environ[TRACE_ENV])
+
+
+def request_profile():
+    """请求分析下一次传输(创建PROFILE_TRIGGER_PATH)，返回是否成功"""
+    return write_text_atomic(PROFILE_TRIGGER_PATH, time.strftime('%Y-%m-%d %H:%M:%S\n'))
+
+
+def take_profile_request():
+    """存在分析请求时删除并返回True；群发时只有先取到的一个传输会被分析"""
+    try:
+        os.remove(PROFILE_TRIGGER_PATH)
+        return True
+    except OSError:
+        return False
+
+
+TransferProgress = collections.namedtuple(
+    'TransferProgress', ['bytes_sent', 'total', 'percent', 'rate', 'avg_rate', 'eta'])
+
+
+def format_size(num_bytes):
+    for unit in ('B', 'KB', 'MB'):
+        if num_bytes < 1024:
+            return f"{num_bytes:.1f} {unit}" if unit != 'B' else f"{int(num_bytes)} B"
+        num_bytes /= 1024.0
+    return f"{num_bytes:.2f} GB"
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "--:--"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes:02d}:{seconds:02d}"
+
+
+# 不可打印字节映射为'.'，整块数据一次translate得到ASCII视图
+_ASCII_TABLE = bytes(b if 32 <= b <= 126 else ord('.') for b in range(256))
+
+
+def format_hex(data):
+    return data.hex(' ').upper()
+
+
+def format_ascii(data):
+    return bytes(data).translate(_ASCII_TABLE).decode('ascii')
+
+
+def format_hex_line(data, offset, width=HEX_DUMP_WIDTH):
+    """一行十六进制转储：偏移 + 十六进制 + ASCII"""
+    hex_width = width * 3 - 1
+    return f"{offset:08X}  {format_hex(data):<{hex_width}}  {format_ascii(data)}"
+
+
+def hex_dump(data, offset=0, width=HEX_DUMP_WIDTH):
+    """整块数据的十六进制转储文本，每行一次hex/translate调用，没有逐字节的Python循环"""
+    view = memoryview(data)
+    return '\n'.join(format_hex_line(view[pos:pos + width], offset + pos, width)
+                     for pos in range(0, len(view), width))
+
+
+class HexDumpBuffer:
+    """十六进制视图的数据缓冲区：超过容量时按整行丢弃最旧数据，行号与偏移保持对齐"""
+
+    def __init__(self, capacity=HEX_VIEW_CAPACITY, width=HEX_DUMP_WIDTH):
+        self.width = width
+        # 容量取整行，丢弃数据后每行仍从width的整数倍偏移开始
+        self.capacity = max(width, capacity - capacity % width)
+        self.data = bytearray()
+        self.base_offset = 0    # data[0]对应的累计接收偏移
+
+    def __len__(self):
+        return len(self.data)
+
+    def row_count(self):
+        return (len(self.data) + self.width - 1) // self.width
+
+    def append(self, chunk):
+        """追加数据，返回因超出容量被丢弃的行数"""
+        self.data += chunk
+        excess = len(self.data) - self.capacity
+        if excess <= 0:
+            return 0
+        rows = (excess + self.width - 1) // self.width
+        del self.data[:rows * self.width]
+        self.base_offset += rows * self.width
+        return rows
+
+    def row(self, row):
+        start = row * self.width
+        return format_hex_line(memoryview(self.data)[start:start + self.width],
+                               self.base_offset + start, self.width)
+
+    def clear(self):
+        self.data = bytearray()
+        self.base_offset = 0
+
+
+class ProgressTracker:
+    """累计已发送字节，按时间间隔和百分比步长合并进度事件，附带瞬时/平均速率和剩余时间"""
+
+    def __init__(self, total, callback, min_interval=PROGRESS_MIN_INTERVAL,
+                 max_interval=PROGRESS_MAX_INTERVAL, min_step=PROGRESS_MIN_STEP, parent=None):
+        self.total = total
+        self.callback = callback
+        self.parent = parent
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.min_step = min_step
+        self.bytes_sent = 0
+        self.skipped = 0      # 续传跳过的字节数
+        self.started = time.perf_counter()
+        self._last_time = self.started
+        self._last_bytes = 0
+        self._last_percent = -1
+
+    def add(self, num_bytes):
+        before = self.bytes_sent
+        self.update(before + num_bytes)
+        if self.parent is not None:
+            # 只累计有效字节(不含末包补齐)
+            self.parent.add(self.bytes_sent - before)
+
+    def skip(self, num_bytes):
+        """续传时跳过之前已发送的字节：计入进度但不计入速率"""
+        before = self.bytes_sent
+        self.bytes_sent = min(before + num_bytes, self.total)
+        self.skipped += self.bytes_sent - before
+        self._last_bytes = self.bytes_sent
+        if self.parent is not None:
+            self.parent.skip(self.bytes_sent - before)
+        self.update(self.bytes_sent, force=True)
+
+    def rewind(self, num_bytes):
+        """退回到设备确认的位置，之后的数据会重新发送"""
+        num_bytes = min(num_bytes, self.bytes_sent)
+        self.bytes_sent -= num_bytes
+        self._last_bytes = min(self._last_bytes, self.bytes_sent)
+        if self.parent is not None:
+            self.parent.rewind(num_bytes)
+
+    def average_rate(self):
+        elapsed = time.perf_counter() - self.started
+        return (self.bytes_sent - self.skipped) / elapsed if elapsed > 0 else 0.0
+
+    def update(self, bytes_sent, force=False):
+        self.bytes_sent = min(bytes_sent, self.total)
+        now = time.perf_counter()
+        elapsed = now - self._last_time
+        percent = int(self.bytes_sent * 100 / self.total) if self.total else 100
+        if not force and percent < 100:
+            if elapsed < self.min_interval:
+                return
+            if percent - self._last_percent < self.min_step and elapsed < self.max_interval:
+                return
+        rate = (self.bytes_sent - self._last_bytes) / elapsed if elapsed > 0 else 0.0
+        total_elapsed = now - self.started
+        avg_rate = (self.bytes_sent - self.skipped) / total_elapsed if total_elapsed > 0 else 0.0
+        eta = (self.total - self.bytes_sent) / avg_rate if avg_rate > 0 else None
+        self._last_time = now
+        self._last_bytes = self.bytes_sent
+        self._last_percent = percent
+        self.callback(TransferProgress(self.bytes_sent, self.total, percent, rate, avg_rate, eta))
+
+    def finish(self):
+        """发送结束时强制输出最后一次进度"""
+        if self._last_bytes != self.bytes_sent or self._last_percent < 0:
+            self.update(self.bytes_sent, force=True)
+
+
+class LatencyHistogram:
+    """固定分桶的延迟直方图：每次记录只做一次二分查找和几次加法，可以常开"""
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)    # 最后一个桶为超过最大上限的部分
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """按桶上限估计分位数(超过最大上限时返回最大值)"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def cumulative(self):
+        """Prometheus格式的累计桶：[(上限, 不超过该上限的次数)]，最后一项上限为+Inf"""
+        result = []
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': round(self.sum, 6), 'max': round(self.max, 6),
+                'p50': round(self.quantile(0.5), 6), 'p90': round(self.quantile(0.9), 6),
+                'p99': round(self.quantile(0.99), 6),
+                'buckets': {('+Inf' if bound == float('inf') else repr(bound)): count
+                            for bound, count in self.cumulative()}}
+
+
+class TransferMetrics:
+    """一次传输的指标。写入相关的计数只在发送线程中修改，读取相关的只在接收线程中修改，不需要加锁"""
+
+    def __init__(self, labels=None):
+        self.labels = dict(labels or {})
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+        self.phases = collections.defaultdict(float)   # 阶段名 -> 耗时(秒)
+        self.write_latency = LatencyHistogram()
+        self.read_latency = LatencyHistogram()
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.write_timeouts = 0     # 写入超时/NAK次数
+        self.write_retries = 0      # 超时后重试的次数(超过重试上限的不算)
+        self.read_errors = 0
+        self.reconnects = 0
+        self.reader_stalls = 0      # 预读队列已满，读取线程等待发送端
+        self.reader_wait_time = 0.0
+        self.writer_stalls = 0      # 预读队列为空，发送端等待读取线程
+        self.writer_wait_time = 0.0
+        self.ack_stalls = 0         # ACK窗口已满，等待设备确认超时
+        self.completed = False
+        self.error = None
+        self.rate_interval = METRICS_RATE_INTERVAL
+        self.rate_samples = []      # [(开始后的秒数, 该区间的字节/秒)]
+        self._sample_time = self.started
+        self._sample_bytes = 0
+
+    def record_write(self, length, elapsed, now):
+        self.write_latency.observe(elapsed)
+        self.bytes_written += length
+        if now - self._sample_time >= self.rate_interval:
+            self._sample(now)
+
+    def record_read(self, length, elapsed):
+        self.read_latency.observe(elapsed)
+        self.bytes_read += length
+
+    def _sample(self, now):
+        self.rate_samples.append((round(now - self.started, 3),
+                                  round((self.bytes_written - self._sample_bytes) / (now - self._sample_time))))
+        self._sample_time = now
+        self._sample_bytes = self.bytes_written
+        if len(self.rate_samples) > METRICS_MAX_SAMPLES:
+            # 合并相邻采样点：取后一点的时间和两者的平均速率
+            samples = self.rate_samples
+            self.rate_samples = [(samples[i + 1][0], (samples[i][1] + samples[i + 1][1]) // 2)
+                                 for i in range(0, len(samples) - 1, 2)]
+            self.rate_interval *= 2
+
+    def add_phase(self, name, seconds):
+        self.phases[name] += seconds
+
+    def add_pipeline(self, pipeline):
+        """累计预读流水线的等待统计"""
+        self.reader_stalls += pipeline.reader_stalls
+        self.reader_wait_time += pipeline.reader_wait_time
+        self.writer_stalls += pipeline.writer_stalls
+        self.writer_wait_time += pipeline.writer_wait_time
+
+    def finish(self, completed, error=None):
+        now = time.perf_counter()
+        self.elapsed = now - self.started
+        if now > self._sample_time and self.bytes_written > self._sample_bytes:
+            self._sample(now)
+        self.completed = completed
+        self.error = error
+
+    @property
+    def mean_rate(self):
+        streaming = self.phases.get('streaming', 0.0)
+        return self.bytes_written / streaming if streaming > 0 else 0.0
+
+    def summary(self):
+        latency = self.write_latency
+        return (f"传输指标: 写入 {latency.count} 次 延迟 p50 {latency.quantile(0.5) * 1000:.2f}ms "
+                f"p99 {latency.quantile(0.99) * 1000:.2f}ms 最大 {latency.max * 1000:.2f}ms | "
+                f"超时 {self.write_timeouts} 次 重连 {self.reconnects} 次 | "
+                f"准备 {self.phases.get('setup', 0.0):.2f}s 发送 {self.phases.get('streaming', 0.0):.2f}s")
+
+    def to_dict(self):
+        return {
+            'time': self.started_at,
+            'labels': self.labels,
+            'completed': self.completed,
+            'error': self.error,
+            'elapsed': round(self.elapsed, 6),
+            'phases': {name: round(seconds, 6) for name, seconds in self.phases.items()},
+            'write': {'count': self.write_latency.count, 'bytes': self.bytes_written,
+                      'timeouts': self.write_timeouts, 'retries': self.write_retries,
+                      'mean_rate': round(self.mean_rate), 'latency': self.write_latency.to_dict()},
+            'read': {'count': self.read_latency.count, 'bytes': self.bytes_read, 'errors': self.read_errors,
+                     'latency': self.read_latency.to_dict()},
+            'reconnects': self.reconnects,
+            'stalls': {'reader': self.reader_stalls, 'reader_wait': round(self.reader_wait_time, 6),
+                       'writer': self.writer_stalls, 'writer_wait': round(self.writer_wait_time, 6),
+                       'ack_window': self.ack_stalls},
+            'rate_interval': self.rate_interval,
+            'rate_samples': self.rate_samples,
+        }
+
+    def prometheus(self):
+        """Prometheus文本格式(可由node_exporter的textfile收集器读取)，各指标为最近一次传输的值"""
+        def label_text(extra=None):
+            labels = dict(self.labels, **(extra or {}))
+            return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP find_send_last_{name} {help_text}")
+            lines.append(f"# TYPE find_send_last_{name} {kind}")
+            for suffix, extra, value in samples:
+                lines.append(f"find_send_last_{name}{suffix}{label_text(extra)} {value}")
+
+        def histogram(name, help_text, hist):
+            samples = [('_bucket', {'le': '+Inf' if bound == float('inf') else repr(bound)}, count)
+                       for bound, count in hist.cumulative()]
+            samples += [('_sum', None, round(hist.sum, 6)), ('_count', None, hist.count)]
+            metric(name, 'histogram', help_text, samples)
+
+        metric('transfer_timestamp_seconds', 'gauge', 'Start time of the last transfer',
+               [('', None, round(self.started_at, 3))])
+        metric('transfer_success', 'gauge', '1 if the last transfer completed',
+               [('', None, int(self.completed))])
+        metric('transfer_bytes', 'gauge', 'Bytes transferred in the last transfer',
+               [('', {'direction': 'out'}, self.bytes_written), ('', {'direction': 'in'}, self.bytes_read)])
+        metric('transfer_rate_bytes_per_second', 'gauge', 'Mean write rate while streaming',
+               [('', None, round(self.mean_rate))])
+        metric('transfer_phase_seconds', 'gauge', 'Time spent in each phase of the last transfer',
+               [('', {'phase': name}, round(seconds, 6)) for name, seconds in self.phases.items()])
+        metric('transfer_write_timeouts', 'gauge', 'Write timeouts (NAK) in the last transfer',
+               [('', None, self.write_timeouts)])
+        metric('transfer_write_retries', 'gauge', 'Write retries after timeouts in the last transfer',
+               [('', None, self.write_retries)])
+        metric('transfer_reconnects', 'gauge', 'Reconnects during the last transfer',
+               [('', None, self.reconnects)])
+        metric('transfer_queue_stalls', 'gauge', 'Queue stalls in the last transfer',
+               [('', {'side': 'reader'}, self.reader_stalls), ('', {'side': 'writer'}, self.writer_stalls),
+                ('', {'side': 'ack_window'}, self.ack_stalls)])
+        histogram('transfer_write_latency_seconds', 'Per-write latency of the last transfer', self.write_latency)
+        histogram('transfer_read_latency_seconds', 'Per-read latency of the last transfer', self.read_latency)
+        return '\n'.join(lines) + '\n'
+
+    def save(self, directory, name, keep=METRICS_KEEP):
+        """写入JSON摘要(每次传输一个文件，只保留最近keep个)和Prometheus文本文件(同一设备覆盖)；返回JSON路径"""
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started_at))
+        json_path = os.path.join(directory, f"transfer-{stamp}-{int(self.started_at * 1000) % 1000:03d}-{name}.json")
+        write_json_atomic(json_path, self.to_dict())
+        write_text_atomic(os.path.join(directory, f"find_send-{name}.prom"), self.prometheus())
+        try:
+            summaries = sorted(entry for entry in os.listdir(directory)
+                               if entry.startswith('transfer-') and entry.endswith('.json'))
+            for old in summaries[:max(0, len(summaries) - keep)]:
+                os.remove(os.path.join(directory, old))
+        except OSError:
+            pass
+        return json_path
+
+
+def make_name_matcher(keyword, mode=MATCH_SUBSTRING):
+    """根据匹配方式返回文件名匹配函数(均不区分大小写)；正则无效时抛出re.error"""
+    if mode == MATCH_REGEX:
+        return re.compile(keyword, re.IGNORECASE).search
+    keyword = keyword.lower()
+    if mode == MATCH_GLOB:
+        regex = re.compile(fnmatch.translate(keyword), re.IGNORECASE)
+        return regex.match
+    return lambda name: keyword in name.lower()
+
+
+def is_excluded_dir(name, exclude_dirs):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in exclude_dirs)
+
+
+def filter_search_results(results, options):
+    """对索引查询结果应用深度/排除目录/大小限制"""
+    if options == SearchOptions():
+        return results
+    filtered = []
+    for relative_path, size, mtime in results:
+        parts = relative_path.split(os.sep)
+        if options.max_depth is not None and len(parts) - 1 > options.max_depth:
+            continue
+        if options.exclude_dirs and any(is_excluded_dir(part, options.exclude_dirs) for part in parts[:-1]):
+            continue
+        if options.min_size is not None and size < options.min_size:
+            continue
+        if options.max_size is not None and size > options.max_size:
+            continue
+        filtered.append((relative_path, size, mtime))
+    return filtered
+
+
+class SearchResultStore:
+    """紧凑的搜索结果存储：路径以UTF-8拼接在一个bytearray中加偏移数组，大小/修改时间存于array"""
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._data = bytearray()
+        self._offsets = array.array('Q', [0])
+        self._sizes = array.array('q')
+        self._mtimes = array.array('d')
+        self._order = None  # 排序后的行号 -> 记录号；None表示按插入顺序
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def extend(self, results):
+        for relative_path, size, mtime in results:
+            self._data += relative_path.encode('utf-8', 'surrogateescape')
+            self._offsets.append(len(self._data))
+            self._sizes.append(-1 if size is None else size)
+            self._mtimes.append(0.0 if mtime is None else mtime)
+            if self._order is not None:
+                self._order.append(len(self._sizes) - 1)
+
+    def _record(self, row):
+        return self._order[row] if self._order is not None else row
+
+    def _path(self, i):
+        return self._data[self._offsets[i]:self._offsets[i + 1]].decode('utf-8', 'surrogateescape')
+
+    def path(self, row):
+        return self._path(self._record(row))
+
+    def size(self, row):
+        size = self._sizes[self._record(row)]
+        return None if size < 0 else size
+
+    def mtime(self, row):
+        return self._mtimes[self._record(row)]
+
+    def sort(self, key, descending=False):
+        if key == SORT_NONE:
+            self._order = None
+            return
+        if key == SORT_SIZE:
+            sort_key = self._sizes.__getitem__
+        elif key == SORT_MTIME:
+            sort_key = self._mtimes.__getitem__
+        else:
+            sort_key = lambda i: self._path(i).lower()
+        self._order = array.array('L', sorted(range(len(self)), key=sort_key, reverse=descending))
+
+
+class ParallelDirectoryWalker:
+    """基于os.scandir的并行目录遍历：子目录分发到线程池，可中途取消，匹配结果分批回调"""
+
+    def __init__(self, root, match, options=SearchOptions(), on_batch=None,
+                 max_workers=SEARCH_WORKERS, batch_size=SEARCH_BATCH_SIZE,
+                 batch_interval=SEARCH_BATCH_INTERVAL):
+        self.root = root
+        self.match = match
+        self.options = options
+        self.on_batch = on_batch
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.found = 0
+        self.dirs_scanned = 0
+        self._cancelled = threading.Event()
+        self._batch = []
+        self._last_flush = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def run(self):
+        """阻塞直到遍历完成或被取消，返回找到的文件数"""
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = {executor.submit(self._scan_dir, '', 0)}
+            while pending and not self.cancelled:
+                done, pending = concurrent.futures.wait(
+                    pending, timeout=self.batch_interval,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    for rel_dir, depth in future.result():
+                        pending.add(executor.submit(self._scan_dir, rel_dir, depth))
+                self._flush(force=False)
+            for future in pending:
+                future.cancel()
+        self._flush(force=True)
+        return self.found
+
+    def _scan_dir(self, rel_dir, depth):
+        """扫描一个目录，收集匹配文件，返回需要继续遍历的子目录"""
+        if self.cancelled:
+            return []
+        options = self.options
+        subdirs, matches = [], []
+        try:
+            with os.scandir(os.path.join(self.root, rel_dir)) as it:
+                for entry in it:
+                    if self.cancelled:
+                        break
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if options.max_depth is not None and depth >= options.max_depth:
+                                continue
+                            if options.exclude_dirs and is_excluded_dir(entry.name, options.exclude_dirs):
+                                continue
+                            subdirs.append((os.path.join(rel_dir, entry.name) if rel_dir else entry.name,
+                                            depth + 1))
+                        elif entry.is_file() and self.match(entry.name):
+                            # 只对文件名匹配的条目调用stat
+                            st = entry.stat()
+                            if options.min_size is not None and st.st_size < options.min_size:
+                                continue
+                            if options.max_size is not None and st.st_size > options.max_size:
+                                continue
+                            matches.append((os.path.join(rel_dir, entry.name) if rel_dir else entry.name,
+                                            st.st_size, st.st_mtime))
+                    except OSError:
+                        continue
+        except OSError:
+            return []
+        with self._lock:
+            self.dirs_scanned += 1
+            self._batch.extend(matches)
+        if len(self._batch) >= self.batch_size:
+            self._flush(force=True)
+        return subdirs
+
+    def _flush(self, force):
+        with self._lock:
+            now = time.perf_counter()
+            if not self._batch or (not force and now - self._last_flush < self.batch_interval):
+                return
+            batch, self._batch = self._batch, []
+            self._last_flush = now
+            self.found += len(batch)
+        if self.on_batch is not None and not self.cancelled:
+            self.on_batch(batch)
+
+
+class IndexWatcher:
+    """用inotify监视已索引目录，记录发生变化的目录；监视数超过系统上限时停止并回退为mtime比较"""
+
+    def __init__(self, root):
+        self.root = root
+        self.inotify = INotify()
+        self.watch_flags = (inotify_flags.CREATE | inotify_flags.DELETE | inotify_flags.MOVED_FROM |
+                            inotify_flags.MOVED_TO | inotify_flags.CLOSE_WRITE | inotify_flags.DELETE_SELF)
+        self.healthy = True
+        self._wd_to_dir = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def watch(self, rel_dir):
+        if not self.healthy:
+            return
+        try:
+            wd = self.inotify.add_watch(os.path.join(self.root, rel_dir), self.watch_flags)
+            self._wd_to_dir[wd] = rel_dir
+        except OSError:
+            # 超过max_user_watches等情况，后续改用mtime比较
+            self.healthy = False
+
+    def take_dirty(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        return dirty
+
+    def _run(self):
+        while True:
+            try:
+                events = self.inotify.read()
+            except (OSError, ValueError):
+                self.healthy = False
+                return
+            with self._lock:
+                for event in events:
+                    rel_dir = self._wd_to_dir.get(event.wd)
+                    if rel_dir is not None:
+                        self._dirty.add(rel_dir)
+                    if event.mask & inotify_flags.Q_OVERFLOW:
+                        self.healthy = False
+
+    def close(self):
+        self.healthy = False
+        self.inotify.close()
+
+
+class FileIndex:
+    """单个根目录的文件名索引：保存到磁盘，按目录mtime/inotify增量刷新，查询只在内存中匹配"""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        # 相对目录 -> (目录mtime_ns, 子目录名列表, [(文件名, 大小, mtime), ...])
+        self.dirs = {}
+        self.ready = False
+        self.watcher = None
+        self._flat = None
+        self._lock = threading.Lock()
+
+    @property
+    def index_path(self):
+        digest = hashlib.sha1(self.root.encode('utf-8', 'surrogateescape')).hexdigest()
+        return os.path.join(INDEX_DIR, digest + ".idx")
+
+    @property
+    def file_count(self):
+        return sum(len(files) for _, _, files in self.dirs.values())
+
+    def load(self):
+        """从磁盘加载索引，失败或版本不符返回False"""
+        try:
+            with open(self.index_path, 'rb') as f:
+                data = pickle.load(f)
+        except (OSError, pickle.PickleError, EOFError, AttributeError, ValueError):
+            return False
+        if data.get('version') != INDEX_VERSION or data.get('root') != self.root:
+            return False
+        with self._lock:
+            self.dirs = data['dirs']
+            self._flat = None
+        self.ready = True
+        return True
+
+    def save(self):
+        os.makedirs(INDEX_DIR, exist_ok=True)
+        tmp_path = self.index_path + ".tmp"
+        with self._lock:
+            data = {'version': INDEX_VERSION, 'root': self.root, 'dirs': self.dirs}
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.index_path)
+
+    def build(self):
+        """完整扫描根目录建立索引"""
+        with self._lock:
+            self.dirs = {}
+            self._flat = None
+        self._scan_tree('')
+        self.ready = True
+
+    def refresh(self):
+        """增量刷新：有可靠的inotify时只重扫变化的目录，否则逐个比较目录mtime；返回是否有变化"""
+        # inotify报告的目录即使mtime未变(文件内容被改写)也要重扫
+        force = self.watcher is not None and self.watcher.healthy
+        candidates = self.watcher.take_dirty() if force else list(self.dirs)
+        changed = False
+        for rel_dir in candidates:
+            entry = self.dirs.get(rel_dir)
+            if entry is None:
+                continue
+            try:
+                mtime = os.stat(os.path.join(self.root, rel_dir)).st_mtime_ns
+            except OSError:
+                self._remove_tree(rel_dir)
+                changed = True
+                continue
+            if force or mtime != entry[0]:
+                old_subdirs = set(entry[1])
+                new_subdirs = self._scan_dir(rel_dir)
+                for name in old_subdirs - set(new_subdirs):
+                    self._remove_tree(os.path.join(rel_dir, name))
+                for name in set(new_subdirs) - old_subdirs:
+                    self._scan_tree(os.path.join(rel_dir, name))
+                changed = True
+        return changed
+
+    def start_watching(self):
+        """inotify可用时为所有已索引目录添加监视"""
+        if INotify is None or self.watcher is not None:
+            return False
+        try:
+            self.watcher = IndexWatcher(self.root)
+        except OSError:
+            return False
+        for rel_dir in list(self.dirs):
+            self.watcher.watch(rel_dir)
+        return self.watcher.healthy
+
+    def search(self, keyword, mode=MATCH_SUBSTRING):
+        """返回匹配的[(相对路径, 大小, mtime), ...]"""
+        match = make_name_matcher(keyword, mode)
+        with self._lock:
+            if self._flat is None:
+                self._flat = [(name, os.path.join(rel_dir, name) if rel_dir else name, size, mtime)
+                              for rel_dir, (_, _, files) in self.dirs.items()
+                              for name, size, mtime in files]
+            flat = self._flat
+        return [(path, size, mtime) for name, path, size, mtime in flat if match(name)]
+
+    def _scan_tree(self, rel_dir):
+        stack = [rel_dir]
+        while stack:
+            current = stack.pop()
+            for name in self._scan_dir(current):
+                stack.append(os.path.join(current, name) if current else name)
+
+    def _scan_dir(self, rel_dir):
+        """扫描单个目录并更新索引，返回子目录名列表"""
+        path = os.path.join(self.root, rel_dir)
+        subdirs, files = [], []
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.name)
+                        elif entry.is_file():
+                            st = entry.stat()
+                            files.append((entry.name, st.st_size, st.st_mtime))
+                    except OSError:
+                        continue
+        except OSError:
+            return []
+        with self._lock:
+            self.dirs[rel_dir] = (mtime, subdirs, files)
+            self._flat = None
+        if self.watcher is not None:
+            self.watcher.watch(rel_dir)
+        return subdirs
+
+    def _remove_tree(self, rel_dir):
+        prefix = rel_dir + os.sep
+        with self._lock:
+            for key in [k for k in self.dirs if k == rel_dir or not rel_dir or k.startswith(prefix)]:
+                del self.dirs[key]
+            self._flat = None
+
+
+def usb_backend_available():
+    """只加载USB后端库而不枚举设备，用于启动时检查pyusb是否可用"""
+    from usb.backend import libusb1, openusb, libusb0
+    for module in (libusb1, openusb, libusb0):
+        try:
+            if module.get_backend() is not None:
+                return True
+        except Exception:
+            continue
+    return False
+
+
+def endpoint_type_name(attributes):
+    ep_type = usb.util.endpoint_type(attributes)
+    return "控制" if ep_type == usb.ENDPOINT_TYPE_CONTROL else \
+           "中断" if ep_type == usb.ENDPOINT_TYPE_INTERRUPT else \
+           "批量" if ep_type == usb.ENDPOINT_TYPE_BULK else \
+           "等时"
+
+
+# 缓存的描述符树
+EndpointInfo = collections.namedtuple('EndpointInfo', ['address', 'direction', 'type_name', 'max_packet_size'])
+InterfaceInfo = collections.namedtuple('InterfaceInfo', ['number', 'alternate', 'endpoints'])
+ConfigurationInfo = collections.namedtuple('ConfigurationInfo', ['value', 'interfaces'])
+DeviceInfo = collections.namedtuple('DeviceInfo', ['bus', 'address', 'port_path', 'vid', 'pid', 'configurations'])
+
+
+def read_device_info(dev):
+    """读取一个设备的完整描述符树；读取配置失败时只保留设备级信息"""
+    configurations = []
+    try:
+        for cfg in dev:
+            interfaces = []
+            for intf in cfg:
+                endpoints = [EndpointInfo(ep.bEndpointAddress,
+                                          "IN" if usb.util.endpoint_direction(ep.bEndpointAddress) == usb.ENDPOINT_IN else "OUT",
+                                          endpoint_type_name(ep.bmAttributes), ep.wMaxPacketSize)
+                             for ep in intf]
+                interfaces.append(InterfaceInfo(intf.bInterfaceNumber, intf.bAlternateSetting, endpoints))
+            configurations.append(ConfigurationInfo(cfg.bConfigurationValue, interfaces))
+    except usb.core.USBError:
+        pass
+    return DeviceInfo(dev.bus, dev.address, device_port_path(dev), dev.idVendor, dev.idProduct, configurations)
+
+
+def device_port_path(dev):
+    """设备所在的物理端口路径，重新枚举后地址会变但端口不变；后端不支持时返回空元组"""
+    try:
+        return tuple(dev.port_numbers or ())
+    except (usb.core.USBError, NotImplementedError, AttributeError):
+        return ()
+
+
+def device_label(info):
+    port = '.'.join(str(p) for p in info.port_path) or '-'
+    return f"Bus {info.bus:03d} 地址 {info.address:03d} 端口 {port} | VID=0x{info.vid:04x} PID=0x{info.pid:04x}"
+
+
+def endpoint_max_packet_size(info, address):
+    """从缓存的描述符树中查找端点的wMaxPacketSize，找不到时返回None"""
+    for configuration in info.configurations:
+        for interface in configuration.interfaces:
+            for endpoint in interface.endpoints:
+                if endpoint.address == address:
+                    return endpoint.max_packet_size
+    return None
+
+
+class DeviceRegistry:
+    """USB设备注册表：以(bus, address)为键缓存描述符树，每次轮询只读取新出现设备的描述符"""
+
+    def __init__(self, backend=None):
+        self.devices = {}
+        # backend为None时由pyusb自动选择，也可传入模拟后端(find_send_simulator)
+        self.backend = backend
+
+    def poll(self):
+        """与当前设备列表对比，返回(新增设备列表, 移除设备列表)"""
+        current = {}
+        added = []
+        for dev in usb.core.find(find_all=True, backend=self.backend):
+            key = (dev.bus, dev.address)
+            info = self.devices.get(key)
+            # 地址被重新分配给其他设备时也按新设备处理
+            if info is None or (info.vid, info.pid) != (dev.idVendor, dev.idProduct):
+                info = read_device_info(dev)
+                added.append(info)
+            current[key] = info
+            usb.util.dispose_resources(dev)
+        removed = [info for key, info in self.devices.items() if current.get(key) is not info]
+        # 整体替换，其他线程读取时总能拿到一致的快照
+        self.devices = current
+        return added, removed
+
+    def find(self, vid, pid):
+        return [info for info in self.devices.values() if info.vid == vid and info.pid == pid]
+
+
+class ReceiveRingBuffer:
+    """预分配的接收环形缓冲区；消费方来不及取走时覆盖最旧数据并计数"""
+
+    def __init__(self, capacity=RECEIVE_BUFFER_SIZE):
+        self.capacity = capacity
+        self._buf = bytearray(capacity)
+        self._written = 0     # 累计写入字节数
+        self._consumed = 0    # 累计取走(或被覆盖)字节数
+        self._dropped = 0
+        self._lock = threading.Lock()
+
+    @property
+    def total_written(self):
+        return self._written
+
+    def write(self, data):
+        data = memoryview(data)
+        with self._lock:
+            if len(data) > self.capacity:
+                self._written += len(data) - self.capacity
+                data = data[-self.capacity:]
+            length = len(data)
+            start = self._written % self.capacity
+            first = min(length, self.capacity - start)
+            self._buf[start:start + first] = data[:first]
+            self._buf[:length - first] = data[first:]
+            self._written += length
+            overflow = self._written - self._consumed - self.capacity
+            if overflow > 0:
+                self._dropped += overflow
+                self._consumed += overflow
+
+    def drain(self):
+        """取出自上次以来的新数据，返回(数据, 期间被覆盖的字节数)"""
+        with self._lock:
+            length = self._written - self._consumed
+            start = self._consumed % self.capacity
+            first = min(length, self.capacity - start)
+            data = bytes(self._buf[start:start + first]) + bytes(self._buf[:length - first])
+            self._consumed = self._written
+            dropped, self._dropped = self._dropped, 0
+        return data, dropped
+
+
+class CaptureFileWriter:
+    """后台线程把接收数据写入抓包文件，磁盘慢时不阻塞USB读取"""
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self.bytes_written = 0
+        self._file = open(path, 'ab' if append else 'wb')
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, data):
+        self._queue.put(bytes(data))
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                break
+            self._file.write(data)
+            self.bytes_written += len(data)
+        self._file.close()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join(5.0)
+
+
+class SessionRecorder:
+    """会话录制：收发线程只记下时间并拷贝数据入队，后台线程按记录格式(见SESSION_*常量)写入文件，
+    关闭时写入索引文件，查看工具不必扫描整个文件"""
+
+    def __init__(self, path):
+        self.path = path
+        self.records = 0
+        self.bytes_recorded = 0
+        self._started_ns = time.perf_counter_ns()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, 'wb', buffering=1024 * 1024)
+        self._file.write(struct.pack(SESSION_HEADER_FORMAT, SESSION_MAGIC, time.time()))
+        self._offset = SESSION_HEADER_SIZE
+        self._offsets = array.array('Q')
+        self._times = array.array('Q')
+        self._lengths = array.array('I')
+        self._meta = array.array('H')
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="session-recorder", daemon=True)
+        self._thread.start()
+
+    def record(self, direction, endpoint, data):
+        self._queue.put((time.perf_counter_ns(), direction, endpoint, bytes(data)))
+
+    def _run(self):
+        last = 0
+        pack = struct.Struct(SESSION_RECORD_FORMAT).pack
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            timestamp, direction, endpoint, data = item
+            # 发送和接收线程各自取时间后入队，先后可能颠倒；保持时间单调，便于按时间二分查找
+            last = max(last, timestamp - self._started_ns)
+            length = len(data)
+            self._file.write(pack(last, direction, endpoint, length))
+            self._file.write(data)
+            self._offsets.append(self._offset)
+            self._times.append(last)
+            self._lengths.append(length)
+            self._meta.append(direction << 8 | endpoint)
+            self._offset += SESSION_RECORD_SIZE + length
+            self.records += 1
+            self.bytes_recorded += length
+        self._file.close()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        write_session_index(self.path, self._offset, self._offsets, self._times, self._lengths, self._meta)
+
+
+def write_session_index(path, file_size, offsets, times, lengths, meta):
+    """写入会话索引文件，返回是否成功"""
+    try:
+        with open(path + SESSION_INDEX_SUFFIX, 'wb') as f:
+            f.write(struct.pack(SESSION_INDEX_FORMAT, SESSION_INDEX_MAGIC, file_size, len(offsets)))
+            for column in (offsets, times, lengths, meta):
+                column.tofile(f)
+        return True
+    except OSError:
+        return False
+
+
+class AckTracker:
+    """解析设备从输入端点回复的确认包(ACK_MAGIC + 本次确认的字节数)，累计设备已确认收到的字节数；
+    确认包之间夹杂的其它数据被忽略，确认包跨两次读取时拼接后再解析"""
+
+    def __init__(self):
+        self.total = 0
+        self.packets = 0
+        self._partial = bytearray()
+        self._cond = threading.Condition()
+
+    def wait_for(self, total, timeout):
+        """等待累计确认字节数达到total，超时返回False"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.total >= total, timeout)
+
+    def feed(self, data):
+        buf = self._partial
+        buf += data
+        pos = 0
+        acked = 0
+        while True:
+            index = buf.find(ACK_MAGIC, pos)
+            if index < 0:
+                # 保留末尾可能是下一个标识开头的几个字节
+                pos = max(pos, len(buf) - len(ACK_MAGIC) + 1)
+                break
+            if index + ACK_SIZE > len(buf):
+                pos = index
+                break
+            acked += struct.unpack_from(ACK_FORMAT, buf, index)[1]
+            self.packets += 1
+            pos = index + ACK_SIZE
+        del buf[:pos]
+        if acked:
+            with self._cond:
+                self.total += acked
+                self._cond.notify_all()
+
+
+class DigestReportTracker:
+    """解析设备从输入端点回复的校验结果(DIGEST_MAGIC + 长度 + CRC32 + SHA-256)"""
+
+    def __init__(self):
+        self.reports = []
+        self._partial = bytearray()
+        self._cond = threading.Condition()
+
+    def feed(self, data):
+        buf = self._partial
+        buf += data
+        pos = 0
+        while True:
+            index = buf.find(DIGEST_MAGIC, pos)
+            if index < 0:
+                pos = max(pos, len(buf) - len(DIGEST_MAGIC) + 1)
+                break
+            if index + DIGEST_REPORT_SIZE > len(buf):
+                pos = index
+                break
+            _, length, crc32, sha256 = struct.unpack_from(DIGEST_REPORT_FORMAT, buf, index)
+            with self._cond:
+                self.reports.append((length, crc32, sha256.hex()))
+                self._cond.notify_all()
+            pos = index + DIGEST_REPORT_SIZE
+        del buf[:pos]
+
+    def wait_for(self, count, timeout):
+        """等待收到第count个校验结果并返回(长度, CRC32, SHA-256)，超时返回None"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: len(self.reports) >= count, timeout):
+                return None
+            return self.reports[count - 1]
+
+
+class DeltaStatusTracker:
+    """解析设备对差量帧流END的STATUS回复，按收到的顺序记录(结果, 设备镜像标签)"""
+
+    def __init__(self):
+        self.reports = []
+        self._partial = bytearray()
+        self._cond = threading.Condition()
+
+    def feed(self, data):
+        buf = self._partial
+        buf += data
+        pos = 0
+        while True:
+            index = buf.find(DELTA_MAGIC, pos)
+            if index < 0:
+                pos = max(pos, len(buf) - len(DELTA_MAGIC) + 1)
+                break
+            if index + DELTA_STATUS_SIZE > len(buf):
+                pos = index
+                break
+            frame_type, flags, length, _ = parse_delta_header(buf, index)
+            if frame_type != DELTA_FRAME_STATUS or length != struct.calcsize(DELTA_STATUS_FORMAT):
+                # 回传(echo)的其它差量帧
+                pos = index + len(DELTA_MAGIC)
+                continue
+            tag, = struct.unpack_from(DELTA_STATUS_FORMAT, buf, index + DELTA_HEADER_SIZE)
+            with self._cond:
+                self.reports.append((flags, tag))
+                self._cond.notify_all()
+            pos = index + DELTA_STATUS_SIZE
+        del buf[:pos]
+
+    def wait_for(self, count, timeout):
+        """等待收到第count个STATUS回复并返回(结果, 设备镜像标签)，超时返回None"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: len(self.reports) >= count, timeout):
+                return None
+            return self.reports[count - 1]
+
+
+class UsbReceiver:
+    """高速接收：大块读取到预分配缓冲区，数据进入环形缓冲区(可同时写抓包文件)，按固定间隔汇总通知"""
+
+    def __init__(self, ep_in, on_data=None, read_size=RECEIVE_READ_SIZE, timeout=RECEIVE_READ_TIMEOUT,
+                 capture_path=None, notify_interval=RECEIVE_NOTIFY_INTERVAL, buffer_size=RECEIVE_BUFFER_SIZE,
+                 parsers=(), capture_append=False, metrics=None, recorder=None):
+        self.ep_in = ep_in
+        self.metrics = metrics
+        self.recorder = recorder
+        self.on_data = on_data
+        # 在接收线程中解析设备回复的对象(如AckTracker)，各自实现feed(data)
+        self.parsers = list(parsers)
+        self.timeout = timeout
+        self.notify_interval = notify_interval
+        max_packet = getattr(ep_in, 'wMaxPacketSize', 0) or 64
+        # 读取长度必须是wMaxPacketSize的整数倍，否则设备发满包时会溢出
+        self.read_size = max(max_packet, read_size - read_size % max_packet)
+        self.ring = ReceiveRingBuffer(buffer_size)
+        self.capture = CaptureFileWriter(capture_path, capture_append) if capture_path else None
+        self.errors = 0
+        self.dropped = 0
+
+    def run(self, is_cancelled, on_error=None):
+        """阻塞读取直到is_cancelled()返回True；之后继续读出设备已缓存的数据，直到读取超时或超过排空时限"""
+        buffer = array.array('B', bytes(self.read_size))
+        view = memoryview(buffer)
+        last_notify = time.perf_counter()
+        drain_deadline = None
+        try:
+            while True:
+                if drain_deadline is None and is_cancelled():
+                    drain_deadline = time.perf_counter() + RECEIVE_DRAIN_TIME
+                elif drain_deadline is not None and time.perf_counter() >= drain_deadline:
+                    break
+                try:
+                    # 传入array时pyusb直接读入该缓冲区，不再为每次读取分配对象
+                    started = time.perf_counter()
+                    length = self.ep_in.read(buffer, timeout=self.timeout)
+                    if length:
+                        now = time.perf_counter()
+                        if self.metrics is not None:
+                            self.metrics.record_read(length, now - started)
+                        if tracer.enabled:
+                            tracer.complete("usb.read", started, {'length': length}, now)
+                        chunk = view[:length]
+                        if self.recorder is not None:
+                            self.recorder.record(SESSION_DIR_IN, self.ep_in.bEndpointAddress, chunk)
+                        self.ring.write(chunk)
+                        if self.capture is not None:
+                            self.capture.write(chunk)
+                        for parser in self.parsers:
+                            parser.feed(chunk)
+                except usb.core.USBError as e:
+                    if drain_deadline is not None:
+                        break
+                    if not is_usb_timeout(e):
+                        self.errors += 1
+                        if self.metrics is not None:
+                            self.metrics.read_errors += 1
+                        if on_error is not None:
+                            on_error(e)
+                        time.sleep(self.timeout / 1000.0)
+                now = time.perf_counter()
+                if now - last_notify >= self.notify_interval:
+                    last_notify = now
+                    self.notify()
+        finally:
+            self.notify()
+            if self.capture is not None:
+                self.capture.close()
+
+    def notify(self):
+        data, dropped = self.ring.drain()
+        self.dropped += dropped
+        if data and self.on_data is not None:
+            self.on_data(data)
+
+    def summary(self):
+        text = f"接收统计: 共 {self.ring.total_written} 字节"
+        if self.dropped:
+            text += f"，界面来不及处理而丢弃 {self.dropped} 字节"
+        if self.capture is not None:
+            text += f"，已保存到 {self.capture.path}"
+        return text
+
+
+class DeviceNotFoundError(ValueError):
+    """未找到指定的USB设备或端点"""
+
+
+class VerifyError(ValueError):
+    """设备回复的校验结果与本地文件摘要不一致，或设备没有回复"""
+
+
+def parse_hex_id(value):
+    """VID/PID可以是整数或十六进制字符串(如"0483"、"0x0483")"""
+    return value if isinstance(value, int) else int(value, 16)
+
+
+class DeviceSession:
+    """设备会话：查找设备、声明接口、解析端点只做一次，之后可被多次传输复用，出错或断开时作废"""
+
+    def __init__(self, vid, pid, interface_num, device):
+        self.vid = vid
+        self.pid = pid
+        self.interface_num = interface_num
+        self.device = device
+        self.bus = device.bus
+        self.address = device.address
+        self.valid = False
+        self.in_use = False
+        self.last_used = 0.0
+        self._interface = None
+        self._endpoints = {}
+
+    @property
+    def key(self):
+        return (self.vid, self.pid, self.interface_num, self.bus, self.address)
+
+    def open(self):
+        with tracer.span("session.open", interface=self.interface_num):
+            configuration = self.device.get_active_configuration()
+            self._interface = configuration[(self.interface_num, 0)]
+            usb.util.claim_interface(self.device, self.interface_num)
+        self.valid = True
+
+    def endpoint(self, address):
+        """按地址查找端点，结果缓存在会话中"""
+        ep = self._endpoints.get(address)
+        if ep is None:
+            direction = usb.util.ENDPOINT_IN if address & usb.util.ENDPOINT_IN else usb.util.ENDPOINT_OUT
+            with tracer.span("endpoint.lookup", address=address):
+                ep = usb.util.find_descriptor(
+                    self._interface,
+                    custom_match=lambda e: \
+                        usb.util.endpoint_direction(e.bEndpointAddress) == direction and \
+                        e.bEndpointAddress == address
+                )
+            if ep is not None:
+                self._endpoints[address] = ep
+        return ep
+
+    def close(self):
+        self.valid = False
+        try:
+            usb.util.release_interface(self.device, self.interface_num)
+        except usb.core.USBError:
+            pass
+        usb.util.dispose_resources(self.device)
+
+
+class DeviceSessionPool:
+    """按VID/PID/接口(可选bus/地址)缓存设备会话，传输线程借出后归还，避免每次传输重新连接"""
+
+    def __init__(self, max_sessions=SESSION_POOL_SIZE, backend=None):
+        self.max_sessions = max_sessions
+        self.backend = backend
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, vid, pid, interface_num, bus=None, address=None):
+        """借出一个空闲的有效会话；没有时查找设备并新建"""
+        with self._lock:
+            for session in self._sessions.values():
+                if session.valid and not session.in_use and \
+                        (session.vid, session.pid, session.interface_num) == (vid, pid, interface_num) and \
+                        bus in (None, session.bus) and address in (None, session.address):
+                    session.in_use = True
+                    return session
+
+        busy = {(s.bus, s.address) for s in self._sessions.values() if s.in_use}
+        device = None
+        with tracer.span("usb.find", vid=vid, pid=pid):
+            for dev in usb.core.find(find_all=True, idVendor=vid, idProduct=pid, backend=self.backend):
+                if bus in (None, dev.bus) and address in (None, dev.address) and \
+                        (dev.bus, dev.address) not in busy:
+                    device = dev
+                    break
+        if device is None:
+            raise DeviceNotFoundError("未找到指定的USB设备")
+        session = DeviceSession(vid, pid, interface_num, device)
+        try:
+            session.open()
+        except Exception:
+            usb.util.dispose_resources(device)
+            raise
+        session.in_use = True
+        with self._lock:
+            old = self._sessions.pop(session.key, None)
+            if old is not None:
+                old.close()
+            self._sessions[session.key] = session
+            self._evict()
+        return session
+
+    def release(self, session, failed=False):
+        """归还会话；发生USB错误时作废，下次借出会重新连接"""
+        with self._lock:
+            session.in_use = False
+            session.last_used = time.monotonic()
+            if failed or not session.valid:
+                self._sessions.pop(session.key, None)
+                session.close()
+
+    def invalidate_device(self, bus, address):
+        """设备断开时作废相关会话(正在使用的会话由传输线程在出错后归还)"""
+        with self._lock:
+            for key, session in list(self._sessions.items()):
+                if (session.bus, session.address) == (bus, address):
+                    session.valid = False
+                    if not session.in_use:
+                        del self._sessions[key]
+                        session.close()
+
+    def close_all(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+    def _evict(self):
+        idle = sorted((s for s in self._sessions.values() if not s.in_use), key=lambda s: s.last_used)
+        while len(self._sessions) > self.max_sessions and idle:
+            session = idle.pop(0)
+            del self._sessions[session.key]
+            session.close()
+
+
+class _Timeval(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_usec', ctypes.c_long)]
+
+
+class _TransferSlot:
+    """一个传输槽：libusb传输结构加上预分配的数据缓冲区；按顺序报告完成之前不复用(失败时需要取回未发送的数据)"""
+
+    def __init__(self, transfer, size):
+        self.transfer = transfer
+        self.data = bytearray(size)
+        self.cbuf = (ctypes.c_char * size).from_buffer(self.data)
+        self.seq = -1
+        self.busy = False         # 已提交、尚未按顺序报告
+        self.in_flight = False    # 已提交、回调尚未返回
+        self.submitted = 0.0
+
+
+class AsyncOrderError(usb.core.USBError):
+    """一个异步传输未完整发送时其后的传输已有数据发出，设备收到的数据不再是连续的前缀"""
+
+
+class AsyncBulkSender:
+    """基于libusb异步传输的发送引擎：同时保持queue_depth个批量OUT传输在途，按提交顺序报告完成
+
+    某个传输超时或失败时只报告它已发送的部分(actual_length)，取消其后的传输且不再报告，
+    因此on_complete累计的字节数总是设备按顺序收到的前缀；超时时没有发出的数据可由take_unsent()取回重发"""
+
+    # libusb_transfer_status
+    TRANSFER_COMPLETED = 0
+    TRANSFER_TIMED_OUT = 2
+    TRANSFER_CANCELLED = 3
+    TRANSFER_TYPE_BULK = 2
+
+    def __init__(self, device, ep_out, transfer_size, queue_depth=DEFAULT_QUEUE_DEPTH,
+                 timeout=DEFAULT_WRITE_TIMEOUT, on_complete=None):
+        from usb.backend import libusb1
+        self._libusb1 = libusb1
+        self._lib = libusb1._lib
+        self._ctx = device._ctx.backend.ctx
+        device._ctx.managed_open()
+        self._handle = device._ctx.handle.handle
+        self.endpoint = ep_out.bEndpointAddress
+        self.transfer_size = transfer_size
+        self.timeout = timeout
+        self.on_complete = on_complete
+        self._lock = threading.Lock()
+        self._callback = libusb1._libusb_transfer_cb_fn_p(self._transfer_done)
+        self._slots = {}
+        for _ in range(max(1, queue_depth)):
+            transfer = self._lib.libusb_alloc_transfer(0)
+            if not transfer:
+                self.close()
+                raise MemoryError("无法分配libusb传输结构")
+            self._slots[ctypes.addressof(transfer.contents)] = _TransferSlot(transfer, transfer_size)
+        self._next_seq = 0
+        self._next_report = 0
+        self._finished = {}
+        self._error = None
+        self._unsent = None
+
+    @staticmethod
+    def is_supported(device):
+        """仅当pyusb使用libusb1后端时才能使用异步传输"""
+        try:
+            from usb.backend import libusb1
+            return isinstance(device._ctx.backend, libusb1._LibUSB) and \
+                hasattr(libusb1, '_libusb_transfer_cb_fn_p') and libusb1._lib is not None
+        except (ImportError, AttributeError):
+            return False
+
+    @property
+    def in_flight(self):
+        return sum(1 for slot in self._slots.values() if slot.in_flight)
+
+    def submit(self, data):
+        """提交一块数据；在途传输已满时处理事件直到有空闲槽"""
+        if len(data) > self.transfer_size:
+            raise ValueError(f"数据长度 {len(data)} 超过传输大小 {self.transfer_size}")
+        slot = self._acquire_slot()
+        length = len(data)
+        slot.data[:length] = data
+        slot.seq = self._next_seq
+        self._next_seq += 1
+
+        t = slot.transfer.contents
+        t.dev_handle = self._handle
+        t.flags = 0
+        t.endpoint = self.endpoint
+        t.type = self.TRANSFER_TYPE_BULK
+        t.timeout = self.timeout
+        t.length = length
+        t.actual_length = 0
+        t.buffer = ctypes.cast(slot.cbuf, dict(type(t)._fields_)['buffer'])
+        t.callback = self._callback
+        t.num_iso_packets = 0
+        slot.busy = slot.in_flight = True
+        slot.submitted = time.perf_counter()
+        ret = self._lib.libusb_submit_transfer(slot.transfer)
+        if ret != 0:
+            slot.busy = slot.in_flight = False
+            self._next_seq -= 1
+            self._fail(usb.core.USBError(f"提交传输失败 (libusb错误 {ret})", errno=None))
+            self._raise_pending()
+
+    def flush(self):
+        """等待所有在途传输完成"""
+        while self.in_flight:
+            self._pump()
+        self._report()
+        self._raise_pending()
+
+    def take_unsent(self):
+        """超时后取回没有发出的数据(按顺序的bytes列表)，没有时返回None；取回后可以继续submit"""
+        unsent, self._unsent = self._unsent, None
+        return unsent
+
+    def cancel(self):
+        """取消所有在途传输并等待回调返回"""
+        for slot in self._slots.values():
+            if slot.in_flight:
+                self._lib.libusb_cancel_transfer(slot.transfer)
+        while self.in_flight:
+            self._pump()
+
+    def close(self):
+        if self.in_flight:
+            self.cancel()
+        for slot in self._slots.values():
+            self._lib.libusb_free_transfer(slot.transfer)
+        self._slots = {}
+
+    def _acquire_slot(self):
+        while True:
+            self._report()
+            self._raise_pending()
+            for slot in self._slots.values():
+                if not slot.busy:
+                    return slot
+            self._pump()
+
+    def _pump(self):
+        # 处理libusb事件；回调可能在本线程或其他正在处理事件的线程中执行
+        tv = _Timeval(0, 100000)
+        self._lib.libusb_handle_events_timeout(self._ctx, ctypes.byref(tv))
+
+    def _transfer_done(self, transfer_p):
+        slot = self._slots.get(ctypes.addressof(transfer_p.contents))
+        if slot is None:
+            return
+        t = transfer_p.contents
+        with self._lock:
+            self._finished[slot.seq] = (t.status, t.actual_length, t.length,
+                                        time.perf_counter() - slot.submitted, slot)
+            slot.in_flight = False
+
+    def _report(self):
+        # 按提交顺序报告完成，乱序完成的结果先缓存
+        while True:
+            with self._lock:
+                result = self._finished.pop(self._next_report, None)
+            if result is None:
+                return
+            status, actual, length, elapsed, slot = result
+            seq = self._next_report
+            self._next_report += 1
+            if status == self.TRANSFER_COMPLETED and actual == length:
+                slot.busy = False
+                if self.on_complete:
+                    self.on_complete(seq, actual, elapsed)
+                continue
+            # 未完整发送：只报告已发出的部分，其后的传输不再报告
+            if actual and self.on_complete:
+                self.on_complete(seq, actual, elapsed)
+            self._halt(seq, status, actual, length, slot)
+            return
+
+    def _halt(self, seq, status, actual, length, slot):
+        """取消其后的全部传输并取回没有发出的数据；其后的传输已有数据发出时按顺序错误处理"""
+        unsent = [bytes(slot.data[actual:length])]
+        slot.busy = False
+        self.cancel()
+        with self._lock:
+            later = sorted(self._finished.items())
+            self._finished.clear()
+        sent_later = 0
+        for _, (_, later_actual, later_length, _, later_slot) in later:
+            sent_later += later_actual
+            unsent.append(bytes(later_slot.data[:later_length]))
+            later_slot.busy = False
+        self._next_report = self._next_seq
+        if sent_later:
+            self._fail(AsyncOrderError(f"传输 #{seq} 未完整发送 ({actual}/{length} 字节)，其后的传输已发出 "
+                                       f"{sent_later} 字节，设备收到的数据不连续", errno=None))
+        elif status == self.TRANSFER_TIMED_OUT:
+            self._unsent = unsent
+            self._fail(usb.core.USBError(f"传输 #{seq} 超时 (已发送 {actual}/{length} 字节)", errno=110))
+        elif status != self.TRANSFER_CANCELLED:
+            self._fail(usb.core.USBError(f"传输 #{seq} 失败 (状态 {status})", errno=None))
+
+    def _fail(self, error):
+        if self._error is None:
+            self._error = error
+
+    def _raise_pending(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            self.cancel()
+            raise error
+
+
+class TransferEngine:
+    """文件发送引擎：不依赖Qt，通过回调报告状态、进度和接收数据，可在任意线程中调用run()
+
+    回调均为可选参数：
+      on_status(str)                         状态文字
+      on_file_started(index, count, path)    开始发送第index个文件
+      on_progress(TransferProgress)          当前文件进度
+      on_overall_progress(TransferProgress)  整批进度
+      on_data(bytes)                         自动读取收到的数据(按固定间隔汇总)
+    """
+
+    def __init__(self, vid, pid, interface, ep_in, ep_out, file_paths, packet_size=64, auto_read=False,
+                 transfer_mode=TRANSFER_MODE_BULK, transfer_size=DEFAULT_TRANSFER_SIZE,
+                 queue_depth=DEFAULT_QUEUE_DEPTH, read_ahead_depth=DEFAULT_READ_AHEAD_DEPTH,
+                 read_ahead_chunk=DEFAULT_READ_AHEAD_CHUNK, log_buffer=None, session_pool=None,
+                 bus=None, address=None, shared_sources=None, capture_path=None,
+                 auto_tune=False, tune_cache=None, use_ack=False, resume=False,
+                 max_reconnects=RESUME_MAX_RECONNECTS, checkpoint_store=None,
+                 delta=False, delta_full=False, hash_cache=None, manifest_store=None,
+                 verify=False, digest_cache=None, metrics_dir=None, trace_path=None, profile_path=None,
+                 record_path=None, on_status=None, on_file_started=None, on_progress=None, on_overall_progress=None,
+                 on_data=None):
+        self.vid = vid
+        self.pid = pid
+        self.interface = interface
+        self.ep_in = ep_in
+        self.ep_out = ep_out
+        # 可以是单个文件路径或按顺序发送的文件列表
+        self.file_paths = [file_paths] if isinstance(file_paths, str) else list(file_paths)
+        self.file_path = self.file_paths[0]
+        self.overall_progress = None
+        self.packet_size = packet_size
+        self.is_cancelled = False
+        self.completed = False
+        self.usb_device = None
+        # 未提供会话池时使用私有会话池，传输结束后关闭
+        self.session_pool = session_pool
+        self.owns_session_pool = session_pool is None
+        self.session = None
+        self.receive_thread = None
+        # 指定bus/地址时只连接该设备(群发模式)；shared_sources为各文件共享的内存数据
+        self.bus = bus
+        self.address = address
+        self.shared_sources = shared_sources or {}
+        self.capture_path = capture_path
+        # 预读线程与发送循环之间的有界队列
+        self.read_ahead_depth = read_ahead_depth
+        self.read_ahead_chunk = read_ahead_chunk
+        self.data_queue = queue.Queue(maxsize=max(1, read_ahead_depth))
+        self.auto_read = auto_read
+        self.transfer_mode = transfer_mode
+        self.transfer_size = transfer_size
+        self.queue_depth = queue_depth
+        self.async_sender = None
+        self.write_buffer = WriteBuffer()
+        self.bulk_writer = None
+        self.log_buffer = log_buffer if log_buffer is not None else LogBuffer()
+        # 自动调优：packet_size为None时取端点wMaxPacketSize；校准结果按VID/PID/接口/端点缓存
+        self.auto_tune = auto_tune
+        self.tune_cache = tune_cache if tune_cache is not None else default_tune_cache
+        self.tune_key = None
+        # 断点续传：USB错误时最多重连max_reconnects次并从已确认的偏移继续；
+        # resume为True时把断点写入checkpoint_store，下次发送同一文件时从断点继续
+        self.max_reconnects = max_reconnects
+        self.resume = resume
+        self.checkpoint_store = checkpoint_store if checkpoint_store is not None else default_checkpoint_store
+        self.checkpoint_key = None
+        self.file_progress = None
+        # use_ack: 以设备在输入端点回复的确认包为准确定已发送的偏移；ACK窗口流控模式总是使用确认包；
+        # 确认包由自动读取的接收线程解析
+        self.use_ack = use_ack or transfer_mode == TRANSFER_MODE_WINDOW
+        self.ack_tracker = AckTracker() if self.use_ack and auto_read and ep_in is not None else None
+        self.ack_origin = None
+        self.ack_window = None
+        # 差量发送：按设备记录上次送达镜像的块哈希，只发送变化的块(帧格式见DELTA_*常量)
+        self.delta = delta
+        self.delta_full = delta_full    # 忽略设备记录的清单完整发送(设备镜像被其它方式改写过时使用)
+        self.hash_cache = hash_cache if hash_cache is not None else default_hash_cache
+        self.manifest_store = manifest_store if manifest_store is not None else default_manifest_store
+        self.delta_plans = {}
+        self.device_id = None
+        # 完整性校验：摘要在预读线程中计算并按文件缓存；verify时发送结束后请求设备回复摘要进行比较
+        self.verify = verify
+        self.digest_cache = digest_cache if digest_cache is not None else default_digest_cache
+        self.digest_reports = DigestReportTracker() if verify and auto_read and ep_in is not None else None
+        # 差量发送需要设备对END帧的STATUS回复确认已应用，才能记录清单
+        self.delta_reports = DeltaStatusTracker() if delta and auto_read and ep_in is not None else None
+        self.digests = {}       # 路径 -> (CRC32, SHA-256)
+        self.stream_digest = None
+        # 传输指标：常开(开销为每次写入两次计时)，指定metrics_dir时传输结束后写入JSON摘要和Prometheus文本文件
+        self.metrics = TransferMetrics()
+        self.metrics_dir = metrics_dir
+        # 只分析本次传输：trace_path保存跟踪文件(Chrome跟踪格式)，profile_path保存cProfile结果(pstats格式)
+        self.trace_path = trace_path
+        self.profile_path = profile_path
+        # 会话录制：把所有收发数据按记录写入二进制文件(格式见SESSION_*常量)，可用find_send_replay.py查看和回放
+        self.record_path = record_path
+        self.recorder = None
+        self.receiver_stop = None
+        self.receiver_starts = 0
+        self.on_status = on_status
+        self.on_file_started = on_file_started
+        self.on_progress = on_progress
+        self.on_overall_progress = on_overall_progress
+        self.on_data = on_data
+
+    def log(self, message, level=LOG_INFO):
+        self.log_buffer.log(level, message)
+
+    def status(self, message):
+        if self.on_status is not None:
+            self.on_status(message)
+
+    def emit_progress(self, progress):
+        if self.on_progress is not None:
+            self.on_progress(progress)
+
+    def emit_overall_progress(self, progress):
+        if self.on_overall_progress is not None:
+            self.on_overall_progress(progress)
+
+    def run(self):
+        """连接设备并依次发送所有文件，返回已发送字节数；出错时抛出异常。
+        指定了trace_path/profile_path或存在分析请求(PROFILE_TRIGGER_PATH)时，同时保存本次传输的跟踪文件/cProfile结果"""
+        trace_path, profile_path = self.trace_path, self.profile_path
+        if take_profile_request():
+            stamp = time.strftime('%Y%m%d-%H%M%S')
+            trace_path = trace_path or os.path.join(TRACE_DIR, f"transfer-{stamp}.trace.json")
+            profile_path = profile_path or os.path.join(TRACE_DIR, f"transfer-{stamp}.prof")
+        trace_started = tracer.begin_capture() if trace_path else None
+        profiler = None
+        if profile_path:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError as e:
+                # 同一进程中已有其他分析器在运行(如群发时另一个传输正在分析)
+                self.log(f"无法启动cProfile: {str(e)}", LOG_WARNING)
+                profiler = None
+        try:
+            with tracer.span("transfer", files=len(self.file_paths)):
+                return self.transfer()
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                try:
+                    os.makedirs(os.path.dirname(os.path.abspath(profile_path)), exist_ok=True)
+                    profiler.dump_stats(profile_path)
+                    self.log(f"cProfile结果已保存到 {profile_path} (python -m pstats 查看)")
+                except OSError as e:
+                    self.log(f"cProfile结果保存失败: {str(e)}", LOG_WARNING)
+            if trace_started is not None:
+                count = tracer.end_capture(trace_started, trace_path)
+                self.log(f"跟踪文件已保存到 {trace_path} ({count} 个事件，可用chrome://tracing或Perfetto打开)")
+
+    def transfer(self):
+        """run()的传输过程"""
+        failed = False
+        error = None
+        try:
+            setup_started = time.perf_counter()
+            if self.record_path:
+                self.recorder = SessionRecorder(self.device_file_path(self.record_path))
+            self.vid_int = parse_hex_id(self.vid)
+            self.pid_int = parse_hex_id(self.pid)
+            self.interface_num = int(self.interface)
+
+            # 查找USB设备
+            self.status("正在连接USB设备...")
+            self.log(f"尝试连接设备: VID=0x{self.vid_int:04x}, PID=0x{self.pid_int:04x}, 接口={self.interface_num}, "
+                     f"输入端点={hex(self.ep_in) if self.ep_in is not None else '无'}, 输出端点={hex(self.ep_out)}")
+
+            # 配置设备
+            self.log(f"当前平台: {platform.system()}", LOG_DEBUG)
+
+#            if self.usb_device.is_kernel_driver_active(interface_num):
+#                self.usb_device.detach_kernel_driver(interface_num)
+
+            if self.auto_read and self.ep_in is not None:
+                self.log("自动读取已启用，启动接收线程")
+            else:
+                self.log("自动读取未启用，接收线程不会启动")
+            if self.transfer_mode == TRANSFER_MODE_WINDOW and self.ack_tracker is None:
+                self.log("ACK窗口流控需要启用自动读取并指定输入端点，回退为高速批量发送", LOG_WARNING)
+            elif self.use_ack and self.ack_tracker is None:
+                self.log("设备确认需要启用自动读取并指定输入端点，本次只按主机写入结果确认偏移", LOG_WARNING)
+            if self.verify and self.digest_reports is None:
+                self.log("设备校验需要启用自动读取并指定输入端点，本次只计算本地摘要", LOG_WARNING)
+            elif self.verify and self.delta:
+                self.log("差量发送由设备对END帧的STATUS回复确认，不再单独请求设备摘要", LOG_WARNING)
+            if self.delta and self.delta_reports is None:
+                self.log("差量发送需要启用自动读取并指定输入端点以接收设备的确认，本次完整发送且不记录清单",
+                         LOG_WARNING)
+
+            # 从会话池借出已声明接口的设备会话，端点在会话中缓存
+            if self.session_pool is None:
+                self.session_pool = DeviceSessionPool()
+            ep_out = self.connect(self.bus, self.address)
+            self.check_packet_size(ep_out)
+            self.tune_key = TransferSizeCache.key(self.vid_int, self.pid_int, self.interface_num, self.ep_out)
+            # 群发时各设备的断点分开保存
+            self.checkpoint_key = self.tune_key if self.bus is None else f"{self.tune_key}@bus{self.bus}"
+            # 设备标识：端点加物理端口，同型号的多个设备各自记录差量清单
+            port_path = '.'.join(str(port) for port in device_port_path(self.usb_device)) or '-'
+            self.device_id = f"{self.tune_key}@{self.session.bus}-{port_path}"
+            if self.delta:
+                with tracer.span("delta.plan"):
+                    self.plan_deltas()
+            self.metrics.labels.update(vid=f"{self.vid_int:04x}", pid=f"{self.pid_int:04x}",
+                                       interface=self.interface_num, endpoint=f"0x{self.ep_out:02x}",
+                                       bus=self.session.bus, address=self.session.address)
+            self.metrics.add_phase('setup', time.perf_counter() - setup_started)
+
+            # 在同一个会话中依次发送队列中的所有文件
+            total_size = sum(self.send_size(path) for path in self.file_paths)
+            self.overall_progress = ProgressTracker(total_size, self.emit_overall_progress)
+            start_index, start_offset = 0, 0
+            if self.resume:
+                start_index, start_offset = self.checkpoint_store.find(self.checkpoint_key, self.file_paths)
+                if start_index or start_offset:
+                    self.log(f"断点续传: 跳过已发送的 {start_index} 个文件，"
+                             f"{os.path.basename(self.file_paths[start_index])} 从偏移 {start_offset} 处继续")
+                    self.overall_progress.skip(sum(self.send_size(path) for path in self.file_paths[:start_index]))
+            files_sent = 0
+            for index, file_path in enumerate(self.file_paths):
+                if self.is_cancelled:
+                    break
+                if index < start_index:
+                    continue
+                self.file_path = file_path
+                if self.on_file_started is not None:
+                    self.on_file_started(index, len(self.file_paths), file_path)
+                delta_count = len(self.delta_reports.reports) + 1 if self.delta_reports is not None else 0
+                with tracer.span("file", index=index, path=os.path.basename(file_path)):
+                    ep_out = self.send_file_resumable(ep_out, start_offset if index == start_index else 0)
+                if self.is_cancelled:
+                    break
+                self.finish_digest(ep_out)
+                if delta_count:
+                    self.confirm_delta(self.delta_plans[file_path], delta_count)
+                files_sent += 1
+            self.overall_progress.finish()
+            bytes_sent = self.overall_progress.bytes_sent - self.overall_progress.skipped
+
+            if not self.is_cancelled:
+                self.completed = True
+                if self.resume:
+                    self.checkpoint_store.clear(self.checkpoint_key)
+                self.status("文件发送完成!")
+                if len(self.file_paths) > 1:
+                    self.log(f"成功发送 {files_sent} 个文件，共 {bytes_sent} 字节，"
+                             f"平均 {format_size(self.overall_progress.average_rate())}/s")
+                else:
+                    self.log(f"成功发送 {bytes_sent} 字节")
+            return bytes_sent
+
+        except Exception as e:
+            failed = isinstance(e, usb.core.USBError)
+            error = str(e)
+            self.log(f"错误: {str(e)}", LOG_ERROR)
+            raise
+        finally:
+            # 清理资源：接收线程退出后再归还会话，避免下一次传输与其争用端点；USB错误时作废会话
+            self.is_cancelled = True
+            teardown_started = time.perf_counter()
+            self.disconnect(failed)
+            if self.resume and not self.completed and self.file_progress is not None:
+                self.save_checkpoint()
+            if self.owns_session_pool and self.session_pool is not None:
+                self.session_pool.close_all()
+            if self.recorder is not None:
+                self.recorder.close()
+                self.log(f"会话已录制到 {self.recorder.path} ({self.recorder.records} 条记录，"
+                         f"{format_size(self.recorder.bytes_recorded)})")
+                self.recorder = None
+            self.metrics.add_phase('teardown', time.perf_counter() - teardown_started)
+            self.finish_metrics(error)
+
+    def finish_metrics(self, error):
+        """汇总本次传输的指标写入日志，指定了指标目录时保存JSON摘要和Prometheus文本文件"""
+        self.metrics.finish(self.completed, error)
+        self.log(self.metrics.summary(), LOG_INFO if self.metrics.write_latency.count else LOG_DEBUG)
+        if self.metrics_dir:
+            labels = self.metrics.labels
+            name = f"{labels.get('vid', 'na')}-{labels.get('pid', 'na')}-{labels.get('bus', 'na')}-" \
+                   f"{labels.get('address', 'na')}"
+            path = self.metrics.save(self.metrics_dir, name)
+            self.log(f"传输指标已保存到 {path}", LOG_DEBUG)
+
+    def finish_digest(self, ep_out):
+        """记录当前文件的摘要：优先使用预读线程完整计算的结果，否则取缓存(没有时读取文件计算)；
+        启用设备校验时请求设备回复摘要并比较"""
+        digest = self.stream_digest
+        self.stream_digest = None
+        if digest is not None and digest.complete:
+            self.digest_cache.put(self.file_path, os.stat(self.file_path), digest)
+            result = (digest.crc32, digest.sha256)
+        elif self.verify:
+            result = self.digest_cache.get(self.file_path)
+        else:
+            result = self.digest_cache.lookup(self.file_path)
+        if result is None:
+            return
+        self.digests[self.file_path] = result
+        self.log(f"{os.path.basename(self.file_path)}: {format_digest(*result)}")
+        if self.digest_reports is not None and not self.delta:
+            started = time.perf_counter()
+            try:
+                with tracer.span("verify"):
+                    self.verify_file(ep_out, result)
+            finally:
+                self.metrics.add_phase('verify', time.perf_counter() - started)
+
+    def verify_file(self, ep_out, expected):
+        """发送校验请求(单独一次写入)，等待设备回复收到数据的摘要并与本地摘要比较"""
+        size = os.path.getsize(self.file_path)
+        count = len(self.digest_reports.reports) + 1
+        request = memoryview(struct.pack(VERIFY_REQUEST_FORMAT, VERIFY_MAGIC, size))
+        self.write_with_backpressure(ep_out, self.write_buffer.load(request), BackpressurePacer())
+        report = self.digest_reports.wait_for(count, VERIFY_TIMEOUT)
+        if report is not None and report == (size, *expected):
+            self.log(f"设备校验通过: {os.path.basename(self.file_path)}")
+            return
+        # 数据已经发完但设备内容不对，断点续传没有意义：清除断点，下次从头发送
+        self.file_progress = None
+        if self.resume:
+            self.checkpoint_store.clear(self.checkpoint_key)
+        if report is None:
+            raise VerifyError(f"设备在 {VERIFY_TIMEOUT}s 内没有回复校验结果")
+        length, crc32, sha256 = report
+        raise VerifyError(f"校验失败: 设备收到 {length} 字节 {format_digest(crc32, sha256)}，"
+                          f"本地 {size} 字节 {format_digest(*expected)}")
+
+    def confirm_delta(self, plan, count):
+        """等待设备对第count个END帧的STATUS回复，确认已应用新镜像后才记录清单；
+        设备丢弃或没有回复时设备上的镜像未知，清除该设备的清单(下次完整发送)并按校验失败处理"""
+        started = time.perf_counter()
+        try:
+            with tracer.span("delta.confirm"):
+                report = self.delta_reports.wait_for(count, DELTA_STATUS_TIMEOUT)
+        finally:
+            self.metrics.add_phase('verify', time.perf_counter() - started)
+        if report == (DELTA_STATUS_APPLIED, plan.tag):
+            self.manifest_store.put(self.device_id, self.file_path, plan)
+            self.log(f"设备已应用差量: {os.path.basename(self.file_path)}")
+            return
+        self.manifest_store.clear(self.device_id)
+        self.file_progress = None
+        if self.resume:
+            self.checkpoint_store.clear(self.checkpoint_key)
+        if report is None:
+            raise VerifyError(f"设备在 {DELTA_STATUS_TIMEOUT}s 内没有确认差量，已清除该设备的清单，下次完整发送")
+        status, tag = report
+        reason = {DELTA_STATUS_BASE_MISMATCH: "设备上不是差量的基础镜像",
+                  DELTA_STATUS_CRC_MISMATCH: "应用后CRC32不符"}.get(status, f"结果 {status}")
+        if status == DELTA_STATUS_APPLIED:
+            reason = f"设备镜像标签 {tag:016x} 与新镜像 {plan.tag:016x} 不符"
+        raise VerifyError(f"设备未应用差量({reason})，已清除该设备的清单，下次完整发送")
+
+    def plan_deltas(self):
+        """按发送顺序为每个文件生成差量计划：第一个文件与设备记录的清单比较，之后的文件与前一个文件比较；
+        收不到设备确认时完整发送"""
+        if self.delta_reports is None:
+            # 设备镜像会被这次无法确认的发送改写，原有清单不再可靠
+            self.manifest_store.clear(self.device_id)
+        base = None if self.delta_full or self.delta_reports is None else self.manifest_store.get(self.device_id)
+        for path in self.file_paths:
+            hashes, size, crc = self.hash_cache.get(path)
+            plan = self.delta_plans[path] = DeltaPlan(hashes, size, crc, base, self.hash_cache.block_size)
+            self.log(f"{os.path.basename(path)}: {plan.summary()}")
+            base = plan.manifest(path) if self.delta_reports is not None else None
+
+    def send_size(self, path):
+        """文件实际要发送的字节数：差量发送时为帧流长度"""
+        plan = self.delta_plans.get(path)
+        return plan.stream_size if plan is not None else os.path.getsize(path)
+
+    def connect(self, bus, address):
+        """从会话池借出会话并解析端点，自动读取时启动接收线程；返回输出端点"""
+        with tracer.span("connect", bus=bus, address=address):
+            return self._connect(bus, address)
+
+    def _connect(self, bus, address):
+        self.session = self.session_pool.acquire(self.vid_int, self.pid_int, self.interface_num, bus, address)
+        self.usb_device = self.session.device
+        self.log(f"使用设备会话: Bus {self.session.bus:03d} 地址 {self.session.address:03d}", LOG_DEBUG)
+
+        # 获取端点(未指定输入端点时不接收数据)
+        ep_in = self.session.endpoint(self.ep_in) if self.ep_in is not None else None
+        ep_out = self.session.endpoint(self.ep_out)
+
+        if ep_out is None or (self.ep_in is not None and ep_in is None):
+            raise DeviceNotFoundError("无法找到指定的端点")
+
+        # 创建接收数据的线程
+        if self.auto_read and ep_in is not None:
+            self.receiver_stop = threading.Event()
+            self.receiver_starts += 1
+            self.receive_thread = threading.Thread(target=self.receive_data, args=(ep_in, self.receiver_stop),
+                                                   name="usb-receiver")
+            self.receive_thread.daemon = False  # 修改为非守护线程 True
+            self.receive_thread.start()
+        return ep_out
+
+    def disconnect(self, failed=False):
+        """停止接收线程并把会话归还会话池，USB错误时作废"""
+        if self.receive_thread is not None:
+            self.receiver_stop.set()
+            self.receive_thread.join(1.0)
+            self.receive_thread = None
+        if self.session is not None:
+            self.session_pool.release(self.session, failed)
+            self.session = None
+        self.bulk_writer = None
+
+    def reconnect(self, attempt):
+        """按退避时间等待后重新连接设备，返回新的输出端点；等待期间被取消时返回None"""
+        delay = min(RESUME_RECONNECT_DELAY * 2 ** (attempt - 1), RESUME_RECONNECT_MAX_DELAY)
+        self.status(f"传输中断，{delay:.1f}秒后第 {attempt}/{self.max_reconnects} 次重连...")
+        deadline = time.monotonic() + delay
+        while not self.is_cancelled and time.monotonic() < deadline:
+            time.sleep(0.05)
+        if self.is_cancelled:
+            return None
+        self.metrics.reconnects += 1
+        try:
+            ep_out = self.connect(self.bus, self.address)
+        except DeviceNotFoundError:
+            if self.address is None:
+                raise
+            # 设备重新枚举后地址会变化，退而只按bus查找
+            ep_out = self.connect(self.bus, None)
+        self.log(f"第 {attempt} 次重连成功")
+        return ep_out
+
+    def send_file_resumable(self, ep_out, start=0):
+        """从start偏移发送当前文件；USB错误时重连设备并从已确认的偏移继续，返回(重连后可能更换的)输出端点"""
+        progress = self.file_progress = self.new_file_progress(self.send_size(self.file_path))
+        if start:
+            progress.skip(start)
+        attempt = 0
+        failed_offset = -1
+        while True:
+            try:
+                if ep_out is None:
+                    started = time.perf_counter()
+                    with tracer.span("reconnect", attempt=attempt):
+                        ep_out = self.reconnect(attempt)
+                    self.metrics.add_phase('reconnect', time.perf_counter() - started)
+                    if ep_out is None:
+                        return None
+                if self.ack_tracker is not None:
+                    self.ack_origin = (progress.bytes_sent, self.ack_tracker.total)
+                started = time.perf_counter()
+                try:
+                    self.send_file(ep_out, progress, progress.bytes_sent)
+                    if not self.is_cancelled:
+                        self.wait_for_ack(progress)
+                finally:
+                    self.metrics.add_phase('streaming', time.perf_counter() - started)
+                return ep_out
+            except AsyncOrderError:
+                # 异步队列中设备收到的数据已不连续，从任何偏移续传都会得到错误的文件：清除断点，下次从头发送
+                self.log("异步传输中断后设备收到的数据不连续，无法续传", LOG_ERROR)
+                self.file_progress = None
+                if self.resume:
+                    self.checkpoint_store.clear(self.checkpoint_key)
+                raise
+            except (usb.core.USBError, DeviceNotFoundError) as e:
+                # 上次中断后有新的数据被确认时重新计数，只限制连续无进展的重连次数
+                if self.confirmed_offset(progress) > failed_offset:
+                    attempt = 0
+                if self.is_cancelled or attempt >= self.max_reconnects:
+                    raise
+                attempt += 1
+                self.log(f"传输中断: {str(e)}", LOG_WARNING)
+                self.disconnect(failed=True)
+                ep_out = None
+                offset = failed_offset = self.resume_offset(progress)
+                self.log(f"已确认发送到偏移 {offset}/{progress.total}，重连后从该处继续")
+
+    def confirmed_offset(self, progress):
+        """当前文件已确认的偏移：主机写入已完成的位置(异步队列模式下为按顺序完成的前缀)；启用ACK时不超过设备确认收到的位置"""
+        offset = progress.bytes_sent
+        if self.ack_tracker is not None and self.ack_origin is not None:
+            origin_offset, origin_total = self.ack_origin
+            offset = min(offset, origin_offset + self.ack_tracker.total - origin_total)
+        return offset
+
+    def resume_offset(self, progress):
+        """续传位置：已确认的偏移按包大小向下对齐，进度退回到该处"""
+        offset = self.confirmed_offset(progress)
+        offset -= offset % self.packet_size
+        progress.rewind(progress.bytes_sent - offset)
+        return offset
+
+    def wait_for_ack(self, progress):
+        """启用ACK时等待设备确认当前文件的全部数据；超时按USB错误处理，由调用方重连续传"""
+        if self.ack_tracker is None:
+            return
+        origin_offset, origin_total = self.ack_origin
+        if not self.ack_tracker.wait_for(origin_total + progress.bytes_sent - origin_offset,
+                                         DEFAULT_WRITE_TIMEOUT / 1000.0):
+            raise usb.core.USBError(f"设备只确认了 {self.confirmed_offset(progress)}/{progress.bytes_sent} 字节",
+                                    errno=110)
+
+    def save_checkpoint(self):
+        offset = self.confirmed_offset(self.file_progress)
+        offset -= offset % self.packet_size
+        try:
+            self.checkpoint_store.save(self.checkpoint_key, self.file_path, offset)
+            self.log(f"断点已保存: {os.path.basename(self.file_path)} 偏移 {offset}")
+        except OSError as e:
+            self.log(f"断点保存失败: {str(e)}", LOG_WARNING)
+
+    def check_packet_size(self, ep_out):
+        """未指定包大小时使用端点的wMaxPacketSize；传统模式下两者不一致时提示"""
+        max_packet = getattr(ep_out, 'wMaxPacketSize', 0)
+        if self.packet_size is None:
+            self.packet_size = max_packet or 64
+            self.log(f"包大小自动设为端点wMaxPacketSize: {self.packet_size} 字节")
+        elif max_packet and self.transfer_mode == TRANSFER_MODE_LEGACY and self.packet_size != max_packet:
+            self.log(f"包大小 {self.packet_size} 与端点wMaxPacketSize {max_packet} 不一致"
+                     f"{'，每包都是短包' if self.packet_size < max_packet else '，每包会被拆成多个USB包'}",
+                     LOG_WARNING)
+    
+    def iter_progress(self):
+        """在后台线程中运行，逐个产出整批进度(TransferProgress)；传输失败时在迭代结束前抛出异常"""
+        events = queue.Queue()
+        previous = self.on_overall_progress
+
+        def on_overall_progress(progress):
+            if previous is not None:
+                previous(progress)
+            events.put(progress)
+
+        def worker():
+            try:
+                self.run()
+            except BaseException as e:
+                events.put(e)
+            else:
+                events.put(None)
+
+        self.on_overall_progress = on_overall_progress
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            while True:
+                event = events.get()
+                if event is None:
+                    break
+                if isinstance(event, BaseException):
+                    raise event
+                yield event
+        finally:
+            # 迭代被提前结束时取消传输
+            if thread.is_alive():
+                self.cancel()
+            thread.join()
+            self.on_overall_progress = previous
+
+    def send_file(self, ep_out, progress, start=0):
+        """从start偏移发送当前文件(self.file_path)，进度累计到progress，返回已发送字节数"""
+        # 映射文件，获取文件大小(群发时使用已读入内存的共享数据)
+        shared = self.shared_sources.get(self.file_path)
+        source = shared if shared is not None else MappedFileSource(self.file_path, self.packet_size)
+        plan = self.delta_plans.get(self.file_path)
+        if plan is not None:
+            source = DeltaFrameSource(source, plan, self.packet_size)
+        file_size = source.size
+        bytes_sent = 0
+
+        if start:
+            self.status(f"继续发送文件: {os.path.basename(self.file_path)} (从 {format_size(start)} 处)")
+        else:
+            self.status(f"开始发送文件: {os.path.basename(self.file_path)}")
+        if plan is not None:
+            self.log(f"差量帧流: {file_size} 字节 (文件 {plan.size} 字节) | 包大小: {self.packet_size} 字节")
+        else:
+            self.log(f"文件大小: {file_size} 字节 | 包大小: {self.packet_size} 字节")
+
+        # 发送文件数据
+        with source:
+            # 启用预读时由读取线程预取数据，发送循环只从队列取数据
+            stream = source
+            if self.read_ahead_depth > 0 and shared is None:
+                # 从头读取原始文件时顺便计算摘要(续传和差量帧流不是完整的文件内容)；
+                # 缓存中已有该文件(路径、大小、修改时间不变)的摘要时不再计算
+                self.stream_digest = None
+                if start == 0 and plan is None and self.digest_cache.lookup(self.file_path) is None:
+                    self.stream_digest = StreamingDigest(file_size)
+                stream = ReadAheadPipeline(source, self.data_queue, self.read_ahead_chunk, self.stream_digest)
+            try:
+                if self.transfer_mode == TRANSFER_MODE_LEGACY:
+                    bytes_sent = self.send_file_legacy(stream, ep_out, progress, start)
+                elif self.transfer_mode == TRANSFER_MODE_WINDOW and self.ack_tracker is not None:
+                    bytes_sent = self.send_file_windowed(stream, ep_out, progress, start)
+                elif self.queue_depth > 1 and AsyncBulkSender.is_supported(self.usb_device):
+                    bytes_sent = self.send_file_queued(stream, ep_out, progress, start)
+                else:
+                    if self.queue_depth > 1:
+                        self.log("当前USB后端不支持异步传输，回退为同步批量发送")
+                    bytes_sent = self.send_file_bulk(stream, ep_out, progress, start)
+            finally:
+                if stream is not source:
+                    stream.close()
+                    self.metrics.add_pipeline(stream)
+                    self.log(stream.stall_summary())
+        return bytes_sent
+
+    def new_file_progress(self, size):
+        """单个文件的进度，同时累计到整批进度"""
+        return ProgressTracker(size, self.emit_progress, parent=self.overall_progress)
+    
+    def send_file_legacy(self, source, ep_out, progress, start=0):
+        """传统节流模式：逐包发送，每包之后固定延迟"""
+        pacer = BackpressurePacer()
+        for chunk in source.chunks(self.packet_size, start):
+            if self.is_cancelled:
+                break
+            
+            # 发送数据到输出端点
+            #print(f"发送数据: {chunk.hex()}")
+            self.send_data(ep_out, chunk, pacer)
+            
+            # 更新进度
+            progress.add(len(chunk))
+            
+            # 添加一点延迟以防止USB过载
+            time.sleep(LEGACY_PACKET_DELAY)
+        progress.finish()
+        if pacer.pushback_count:
+            self.log(f"写入超时重试 {pacer.pushback_count} 次")
+        return progress.bytes_sent
+    
+    def write_unit(self, ep_out):
+        """批量写入的对齐单位：端点wMaxPacketSize与包大小的较大者"""
+        max_packet = getattr(ep_out, 'wMaxPacketSize', 0) or self.packet_size
+        return max(max_packet, self.packet_size)
+    
+    def bulk_write_size(self, ep_out):
+        """计算批量写入大小：按端点wMaxPacketSize对齐，且为包大小的整数倍；自动调优时优先使用校准结果"""
+        unit = self.write_unit(ep_out)
+        tuned = self.tuned_write_size(ep_out)
+        transfer_size = tuned if tuned is not None else self.transfer_size
+        return max(unit, transfer_size - transfer_size % unit)
+    
+    def tuned_write_size(self, ep_out):
+        if not self.auto_tune or self.tune_key is None:
+            return None
+        return self.tune_cache.get(self.tune_key, getattr(ep_out, 'wMaxPacketSize', None))
+    
+    def send_file_bulk(self, source, ep_out, progress, start=0):
+        """高吞吐模式：多包合并为一次批量写入，只有设备反压时才节流；
+        自动调优且没有缓存结果时，先用文件开头的数据依次校准各候选写入大小"""
+        write_size = self.bulk_write_size(ep_out)
+        tuner = self.start_tuning(ep_out, source.size - start)
+        if tuner is None:
+            self.log(f"批量发送模式: 单次写入 {write_size} 字节 "
+                     f"(wMaxPacketSize={getattr(ep_out, 'wMaxPacketSize', '未知')})")
+        pacer = BackpressurePacer()
+        # 校准期间按最大候选大小取块再切分，候选大小变化时不需要重新定位数据源
+        for chunk in source.chunks(write_size if tuner is None else tuner.max_size, start):
+            if self.is_cancelled:
+                break
+            
+            offset = 0
+            while offset < len(chunk) and not self.is_cancelled:
+                size = write_size if tuner is None else tuner.size
+                piece = chunk if offset == 0 and size >= len(chunk) else chunk[offset:offset + size]
+                if tuner is None:
+                    self.write_with_backpressure(ep_out, self.write_buffer.load(piece), pacer)
+                else:
+                    started = time.perf_counter()
+                    pushbacks = pacer.pushback_count
+                    self.write_with_backpressure(ep_out, self.write_buffer.load(piece), pacer)
+                    tuner.record(len(piece), time.perf_counter() - started, pacer.pushback_count - pushbacks)
+                    if tuner.done:
+                        write_size = self.finish_tuning(tuner, ep_out)
+                        tuner = None
+                progress.add(len(piece))
+                offset += len(piece)
+        progress.finish()
+        if tuner is not None and tuner.best() is not None and not self.is_cancelled:
+            self.finish_tuning(tuner, ep_out)
+        
+        if pacer.pushback_count:
+            self.log(f"设备反压 {pacer.pushback_count} 次，已自动节流")
+        return progress.bytes_sent
+    
+    def start_tuning(self, ep_out, data_size):
+        """自动调优且没有缓存结果时返回校准器，否则返回None"""
+        if not self.auto_tune or self.tuned_write_size(ep_out) is not None:
+            return None
+        tuner = TransferSizeTuner.for_endpoint(self.write_unit(ep_out), data_size)
+        self.log(f"自动调优: 依次校准写入大小 {', '.join(map(str, tuner.candidates))}，"
+                 f"每个 {format_size(tuner.burst_bytes)}")
+        return tuner
+    
+    def finish_tuning(self, tuner, ep_out):
+        """校准结束：记录并缓存已测量的候选中最佳的写入大小，返回该大小；
+        文件不足以测完所有候选时也缓存，之后的传输不再重复校准"""
+        best = tuner.best()
+        self.tune_cache.put(self.tune_key, getattr(ep_out, 'wMaxPacketSize', None), best, tuner.rate(best))
+        if tuner.done:
+            self.log(f"自动调优完成: {tuner.summary()}；选用 {best} 字节")
+        else:
+            self.log(f"自动调优: 文件不足以测完所有候选 ({tuner.summary()})；按已测量的结果选用 {best} 字节")
+        return best
+    
+    def send_file_queued(self, source, ep_out, progress, start=0):
+        """异步队列模式：保持queue_depth个批量传输在途，按顺序统计完成的字节数；
+        自动调优时每个候选大小的一段数据全部完成后计时，再换下一个大小"""
+        write_size = self.bulk_write_size(ep_out)
+        tuner = self.start_tuning(ep_out, source.size - start)
+        if tuner is None:
+            self.log(f"异步队列发送: 队列深度 {self.queue_depth} | 单次写入 {write_size} 字节")
+        else:
+            self.log(f"异步队列发送: 队列深度 {self.queue_depth}")
+
+        metrics = self.metrics
+
+        def on_complete(seq, length, elapsed):
+            now = time.perf_counter()
+            metrics.record_write(length, elapsed, now)
+            if tracer.enabled:
+                tracer.complete("usb.write.async", now - elapsed, {'length': length}, now)
+            progress.add(length)
+
+        sender = self.async_sender = AsyncBulkSender(self.usb_device, ep_out,
+                                                     write_size if tuner is None else tuner.max_size,
+                                                     self.queue_depth, DEFAULT_WRITE_TIMEOUT, on_complete)
+        recorder = self.recorder
+        pacer = BackpressurePacer()
+        burst = 0
+        burst_started = time.perf_counter()
+        try:
+            # 校准期间按最大候选大小取块再切分
+            for chunk in source.chunks(write_size if tuner is None else tuner.max_size, start):
+                if self.is_cancelled:
+                    break
+                offset = 0
+                while offset < len(chunk):
+                    size = write_size if tuner is None else tuner.size
+                    piece = chunk if offset == 0 and size >= len(chunk) else chunk[offset:offset + size]
+                    # 异步传输在提交时录制(完成回调中数据缓冲区已被复用)
+                    if recorder is not None:
+                        recorder.record(SESSION_DIR_OUT, self.ep_out, piece)
+                    self.async_call(sender, lambda: sender.submit(piece), ep_out, progress, pacer)
+                    offset += len(piece)
+                    if tuner is not None:
+                        burst += len(piece)
+                        if burst >= tuner.burst_bytes:
+                            self.async_call(sender, sender.flush, ep_out, progress, pacer)
+                            now = time.perf_counter()
+                            tuner.record(burst, now - burst_started)
+                            burst, burst_started = 0, now
+                            if tuner.done:
+                                write_size = self.finish_tuning(tuner, ep_out)
+                                tuner = None
+            if self.is_cancelled:
+                sender.cancel()
+            else:
+                self.async_call(sender, sender.flush, ep_out, progress, pacer)
+                if tuner is not None and burst:
+                    tuner.record(burst, time.perf_counter() - burst_started)
+        finally:
+            sender.close()
+            self.async_sender = None
+        progress.finish()
+        if tuner is not None and tuner.best() is not None and not self.is_cancelled:
+            self.finish_tuning(tuner, ep_out)
+        return progress.bytes_sent
+
+    def async_call(self, sender, call, ep_out, progress, pacer):
+        """执行一次异步提交/等待；传输超时时按退避延迟用同步写入重发设备没有接收的数据后重试，
+        重试次数用完或其他错误时按USB错误抛出(已完成的字节数仍是按顺序的前缀)"""
+        while True:
+            try:
+                return call()
+            except usb.core.USBError:
+                unsent = sender.take_unsent()
+                if unsent is None or self.is_cancelled:
+                    raise
+                self.metrics.write_timeouts += 1
+                if not pacer.on_pushback():
+                    raise
+                self.metrics.write_retries += 1
+                self.log(f"异步传输超时，同步重发未发送的 {sum(len(data) for data in unsent)} 字节", LOG_DEBUG)
+                # 提交时已经录制过，重发时不再录制
+                for data in unsent:
+                    self.write_with_backpressure(ep_out, data, pacer, record=False)
+                    if self.is_cancelled:
+                        return None
+                    progress.add(len(data))
+    
+    def send_file_windowed(self, source, ep_out, progress, start=0):
+        """ACK窗口流控：未确认的写入不超过窗口大小，由接收线程解析的设备确认包打开窗口，不做固定延迟；
+        窗口跨文件保留，同一批后续文件直接使用已收敛的窗口"""
+        write_size = self.bulk_write_size(ep_out)
+        if self.ack_window is None:
+            self.ack_window = AckWindow()
+        window = self.ack_window
+        tracker = self.ack_tracker
+        self.log(f"ACK窗口流控: 单次写入 {write_size} 字节 | 初始窗口 {window.limit}")
+        pacer = BackpressurePacer()
+        base = tracker.total    # 本次发送开始时设备累计确认的字节数
+        written = 0
+        acked = 0
+
+        def collect_acks():
+            nonlocal acked
+            newly = tracker.total - base - acked
+            if newly > 0:
+                acked += newly
+                window.on_ack(newly / write_size)
+
+        for chunk in source.chunks(write_size, start):
+            if self.is_cancelled:
+                break
+            # 窗口已满时等待设备确认；长时间没有确认时逐次缩小窗口，仍无确认按USB错误处理
+            stalls = 0
+            while self.ack_tracker is not None and written - acked >= window.limit * write_size and \
+                    not self.is_cancelled:
+                if not tracker.wait_for(base + acked + 1, ACK_WAIT_TIMEOUT):
+                    window.on_timeout()
+                    self.metrics.ack_stalls += 1
+                    stalls += 1
+                    if stalls < ACK_MAX_STALLS:
+                        continue
+                    if not tracker.packets:
+                        # 设备从未回复确认包(固件不支持)，重连也没有用
+                        self.log("设备没有回复任何确认包，改为不等待确认继续发送", LOG_WARNING)
+                        self.ack_tracker = None
+                        break
+                    raise usb.core.USBError(f"设备连续 {stalls} 次未在 {ACK_WAIT_TIMEOUT}s 内确认数据",
+                                            errno=110)
+                collect_acks()
+            pushbacks = pacer.pushback_count
+            self.write_with_backpressure(ep_out, self.write_buffer.load(chunk), pacer)
+            if pacer.pushback_count > pushbacks:
+                window.on_timeout()
+            written += len(chunk)
+            progress.add(len(chunk))
+            collect_acks()
+        progress.finish()
+        self.log(window.summary())
+        return progress.bytes_sent
+    
+    def write_with_backpressure(self, ep_out, data, pacer, record=True):
+        """写入一块数据；超时/NAK时按退避延迟重试，只重发设备没有接收的部分；record为False时不录制"""
+        writer = self.bulk_writer
+        if writer is None or writer.ep_out is not ep_out:
+            writer = self.bulk_writer = BulkWriter(self.usb_device, ep_out)
+            if writer.granularity:
+                self.log(f"当前USB后端超时时无法得知已发送的字节数，按 {writer.granularity} 字节逐包写入", LOG_DEBUG)
+        step = writer.granularity or len(data)
+        metrics = self.metrics
+        recorder = self.recorder if record else None
+        offset = 0
+        while offset < len(data) and not self.is_cancelled:
+            pacer.wait()
+            started = time.perf_counter()
+            written, timeout_error = writer.write(data[offset:offset + step] if offset or step < len(data) else data,
+                                                  DEFAULT_WRITE_TIMEOUT)
+            now = time.perf_counter()
+            if written:
+                metrics.record_write(written, now - started, now)
+                if tracer.enabled:
+                    tracer.complete("usb.write", started, {'length': written}, now)
+                if recorder is not None:
+                    recorder.record(SESSION_DIR_OUT, self.ep_out, memoryview(data)[offset:offset + written])
+                offset += written
+            if timeout_error is None:
+                pacer.on_success()
+                continue
+            if tracer.enabled:
+                tracer.complete("usb.write.timeout", started, {'length': written}, now)
+            metrics.write_timeouts += 1
+            if not pacer.on_pushback():
+                raise timeout_error
+            metrics.write_retries += 1
+    
+    def send_data(self, ep_out, data, pacer):
+        """发送数据到USB设备(数据源已把最后一包补齐到包大小)；超时时按退避重试，不丢包"""
+        if self.log_buffer.enabled(LOG_TRACE):
+            self.log(f"发送数据(16进制): {data.hex()}", LOG_TRACE)
+        # 发送数据
+        self.write_with_backpressure(ep_out, self.write_buffer.load(data), pacer)
+    
+    def receive_data(self, ep_in, stop_event):
+        """在后台线程中持续接收USB数据，按固定间隔把汇总后的数据交给on_data"""
+        try:
+            # 重连后继续追加到同一个抓包文件
+            parsers = [parser for parser in (self.ack_tracker, self.digest_reports, self.delta_reports)
+                       if parser is not None]
+            receiver = UsbReceiver(ep_in, self.on_data, capture_path=self.device_file_path(self.capture_path),
+                                   parsers=parsers, capture_append=self.receiver_starts > 1, metrics=self.metrics,
+                                   recorder=self.recorder)
+            receiver.run(lambda: self.is_cancelled or stop_event.is_set(),
+                         on_error=lambda e: self.log(f"读取错误: {str(e)}", LOG_ERROR))
+            self.log(receiver.summary(), LOG_DEBUG if not receiver.ring.total_written else LOG_INFO)
+        except Exception as e:
+            self.log(f"接收线程错误: {str(e)}", LOG_ERROR)
+    
+    def device_file_path(self, path):
+        """群发时每个设备单独一个抓包/录制文件"""
+        if not path or self.bus is None:
+            return path
+        base, ext = os.path.splitext(path)
+        return f"{base}_bus{self.bus:03d}_addr{self.address:03d}{ext}"
+    
+    def cancel(self):
+        self.is_cancelled = True
+        self.status("操作已取消")
+        # 会话由发送循环结束后归还会话池，这里不释放设备资源；
+        # 写入超时有上限，发送循环会在当前写入返回后退出
@@ -0,0 +1,409 @@
+'''
+ 会话文件查看与回放：内存映射会话文件(命令行 --record 或界面“录制会话”生成)，按方向/端点/时间过滤、
+ 按内容搜索、按记录号或时间定位；也可以把录制的发送数据回放到真实设备或模拟设备，与录制时设备的回复比较
+ 用法: find-send-replay FILE info|list|search|replay ...
+'''
+import sys
+import mmap
+import array
+import bisect
+import struct
+import argparse
+import itertools
+import threading
+import time
+import collections
+import usb.core
+
+from find_send_engine import (SESSION_MAGIC, SESSION_HEADER_FORMAT, SESSION_HEADER_SIZE, SESSION_RECORD_FORMAT,
+                              SESSION_RECORD_SIZE, SESSION_DIR_OUT, SESSION_DIR_IN, SESSION_INDEX_MAGIC,
+                              SESSION_INDEX_FORMAT, SESSION_INDEX_SUFFIX, DEFAULT_WRITE_TIMEOUT,
+                              BackpressurePacer, BulkWriter, DeviceNotFoundError, DeviceSessionPool,
+                              SessionRecorder, UsbReceiver, format_hex, format_size, hex_dump, write_session_index)
+
+# 退出码
+EXIT_OK = 0
+EXIT_FAILED = 1              # 回放出错或设备回复与录制时不一致
+EXIT_USAGE = 2               # 参数错误(argparse默认)
+EXIT_DEVICE_NOT_FOUND = 3    # 未找到设备或端点
+EXIT_FILE_ERROR = 4          # 会话文件无法读取或格式错误
+
+DIRECTION_NAMES = {SESSION_DIR_OUT: "OUT", SESSION_DIR_IN: "IN"}
+PREVIEW_BYTES = 16           # list 每条记录预览的字节数
+
+SessionRecord = collections.namedtuple('SessionRecord', ['index', 'time', 'direction', 'endpoint', 'payload'])
+
+
+class SessionFile:
+    """只读打开会话文件：数据内存映射，不读入内存；记录索引从索引文件载入，没有或与文件不符时扫描一遍并重建"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError(f"会话文件为空: {path}")
+        if len(self._map) < SESSION_HEADER_SIZE or self._map[:len(SESSION_MAGIC)] != SESSION_MAGIC:
+            self.close()
+            raise ValueError(f"不是会话文件: {path}")
+        _, self.started_at = struct.unpack_from(SESSION_HEADER_FORMAT, self._map)
+        self.offsets = array.array('Q')
+        self.times = array.array('Q')      # 相对开始的纳秒
+        self.lengths = array.array('I')
+        self.meta = array.array('H')       # 方向<<8|端点
+        self.index_rebuilt = not self._load_index()
+        if self.index_rebuilt:
+            self._scan()
+
+    def _load_index(self):
+        try:
+            with open(self.path + SESSION_INDEX_SUFFIX, 'rb') as f:
+                header = f.read(struct.calcsize(SESSION_INDEX_FORMAT))
+                magic, file_size, count = struct.unpack(SESSION_INDEX_FORMAT, header)
+                if magic != SESSION_INDEX_MAGIC or file_size != len(self._map):
+                    return False
+                for column in (self.offsets, self.times, self.lengths, self.meta):
+                    column.fromfile(f, count)
+            return True
+        except (OSError, struct.error, EOFError):
+            for column in (self.offsets, self.times, self.lengths, self.meta):
+                del column[:]
+            return False
+
+    def _scan(self):
+        """按记录头逐条扫描(录制中途退出时没有索引文件，末尾不完整的记录忽略)，并写回索引文件"""
+        unpack = struct.Struct(SESSION_RECORD_FORMAT).unpack_from
+        data = self._map
+        offset = SESSION_HEADER_SIZE
+        end = len(data)
+        while offset + SESSION_RECORD_SIZE <= end:
+            timestamp, direction, endpoint, length = unpack(data, offset)
+            if offset + SESSION_RECORD_SIZE + length > end:
+                break
+            self.offsets.append(offset)
+            self.times.append(timestamp)
+            self.lengths.append(length)
+            self.meta.append(direction << 8 | endpoint)
+            offset += SESSION_RECORD_SIZE + length
+        if offset == end:
+            write_session_index(self.path, end, self.offsets, self.times, self.lengths, self.meta)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @property
+    def duration(self):
+        return self.times[-1] / 1e9 if self.times else 0.0
+
+    def record(self, index):
+        """第index条记录，数据为指向映射区的memoryview，不拷贝"""
+        start = self.offsets[index] + SESSION_RECORD_SIZE
+        meta = self.meta[index]
+        payload = memoryview(self._map)[start:start + self.lengths[index]]
+        return SessionRecord(index, self.times[index] / 1e9, meta >> 8, meta & 0xFF, payload)
+
+    def index_at(self, seconds):
+        """时间不早于seconds(相对开始)的第一条记录"""
+        return bisect.bisect_left(self.times, int(seconds * 1e9))
+
+    def select(self, direction=None, endpoint=None, start=None, end=None, first=0):
+        """按方向/端点/时间范围过滤，逐个返回记录号"""
+        lo = max(first, self.index_at(start) if start is not None else 0)
+        hi = self.index_at(end) if end is not None else len(self)
+        indexes = range(lo, hi)
+        if direction is None and endpoint is None:
+            return iter(indexes)
+        meta = self.meta
+        if endpoint is None:
+            return (i for i in indexes if meta[i] >> 8 == direction)
+        if direction is None:
+            return (i for i in indexes if meta[i] & 0xFF == endpoint)
+        wanted = direction << 8 | endpoint
+        return (i for i in indexes if meta[i] == wanted)
+
+    def search(self, pattern, first=0):
+        """在记录数据中查找pattern，逐个返回(记录号, 数据内偏移)；用mmap.find在整个文件上查找，不逐条比较"""
+        if not pattern or first >= len(self):
+            return
+        position = self.offsets[first]
+        while True:
+            position = self._map.find(pattern, position)
+            if position < 0:
+                return
+            index = bisect.bisect_right(self.offsets, position) - 1
+            payload_start = self.offsets[index] + SESSION_RECORD_SIZE
+            # 落在记录头里或跨越两条记录的匹配不算
+            if position >= payload_start and position + len(pattern) <= payload_start + self.lengths[index]:
+                yield index, position - payload_start
+            position += 1
+
+    def summary(self):
+        """按方向和端点统计记录数和字节数：{(方向, 端点): (记录数, 字节数)}"""
+        counts = collections.Counter(self.meta)
+        sizes = collections.Counter()
+        for meta, length in zip(self.meta, self.lengths):
+            sizes[meta] += length
+        return {(meta >> 8, meta & 0xFF): (counts[meta], sizes[meta]) for meta in sorted(counts)}
+
+    def close(self):
+        try:
+            self._map.close()
+        except BufferError:
+            # 还有记录数据的memoryview未释放，映射随其一起回收
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def int_auto(text):
+    return int(text, 0)
+
+
+def direction_arg(text):
+    directions = {"out": SESSION_DIR_OUT, "in": SESSION_DIR_IN}
+    if text not in directions:
+        raise argparse.ArgumentTypeError(f"方向应为 out 或 in: {text}")
+    return directions[text]
+
+
+def format_record(record, hex_payload=False):
+    line = (f"{record.index:>9} {record.time:>12.6f}s {DIRECTION_NAMES.get(record.direction, '?'):<3} "
+            f"0x{record.endpoint:02x} {len(record.payload):>8}  {format_hex(record.payload[:PREVIEW_BYTES])}"
+            f"{' ...' if len(record.payload) > PREVIEW_BYTES else ''}")
+    if hex_payload:
+        line += '\n' + hex_dump(record.payload)
+    return line
+
+
+def cmd_info(session, args):
+    started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(session.started_at))
+    print(f"会话文件: {session.path}")
+    print(f"开始时间: {started}  时长: {session.duration:.3f}s  记录: {len(session)} 条"
+          f"{'  (已重建索引)' if session.index_rebuilt else ''}")
+    for (direction, endpoint), (count, size) in session.summary().items():
+        print(f"  {DIRECTION_NAMES.get(direction, '?'):<3} 0x{endpoint:02x}: {count} 条 {format_size(size)}")
+    return EXIT_OK
+
+
+def cmd_list(session, args):
+    first = args.index if args.index is not None else 0
+    indexes = session.select(args.direction, args.endpoint, args.start, args.end, first)
+    for index in itertools.islice(indexes, args.limit):
+        print(format_record(session.record(index), args.hex))
+    return EXIT_OK
+
+
+def cmd_search(session, args):
+    try:
+        # 十六进制允许空格，如 "DE AD BE EF"
+        pattern = args.pattern.encode('utf-8') if args.text else bytes.fromhex(args.pattern)
+    except ValueError:
+        print(f"错误: 无效的十六进制: {args.pattern}", file=sys.stderr)
+        return EXIT_USAGE
+    matches = ((index, offset) for index, offset in session.search(pattern, args.index or 0)
+               if (args.direction is None or session.meta[index] >> 8 == args.direction) and
+               (args.endpoint is None or session.meta[index] & 0xFF == args.endpoint))
+    found = 0
+    for index, offset in itertools.islice(matches, args.limit):
+        found += 1
+        print(f"{format_record(session.record(index))}  (数据偏移 {offset})")
+    if not found:
+        print("没有找到")
+    return EXIT_OK
+
+
+def write_record(writer, payload, is_cancelled=lambda: False):
+    """写入一条录制的数据：先拷入array('B')，pyusb不必逐字节转换mmap的memoryview；
+    超时/NAK时退避重试，只重发设备没有接收的部分(见BulkWriter)"""
+    data = array.array('B')
+    data.frombytes(payload)
+    step = writer.granularity or len(data)
+    pacer = BackpressurePacer()
+    offset = 0
+    while offset < len(data) and not is_cancelled():
+        pacer.wait()
+        written, timeout_error = writer.write(data[offset:offset + step] if offset or step < len(data) else data,
+                                              DEFAULT_WRITE_TIMEOUT)
+        offset += written
+        if timeout_error is None:
+            pacer.on_success()
+        elif not pacer.on_pushback():
+            raise timeout_error
+
+
+def recorded_replies(session, endpoint):
+    """录制时设备从endpoint回复的全部数据"""
+    return b''.join(bytes(session.record(i).payload) for i in session.select(SESSION_DIR_IN, endpoint))
+
+
+def cmd_replay(session, args):
+    """按录制的时间间隔(--speed倍速，--fast不等待)把发送记录写入设备，同时接收设备回复，--compare时与录制时的回复比较"""
+    out_endpoints = sorted({endpoint for direction, endpoint in session.summary() if direction == SESSION_DIR_OUT})
+    source_ep = args.source_ep if args.source_ep is not None else (out_endpoints[0] if out_endpoints else None)
+    if source_ep is None:
+        print("会话中没有发送记录", file=sys.stderr)
+        return EXIT_FAILED
+    ep_out_address = args.ep_out if args.ep_out is not None else source_ep
+    ep_in_address = args.ep_in
+    backend = None
+    if args.simulate:
+        # 模拟后端只在需要时导入
+        from find_send_simulator import SimulatedBackend, SimulatedDevice
+        device = SimulatedDevice(vid=args.vid, pid=args.pid, bus=args.bus or 1, address=args.address or 1,
+                                 interface=args.interface, ep_out=ep_out_address,
+                                 ep_in=ep_in_address if ep_in_address is not None else ep_out_address | 0x80,
+                                 response=args.response)
+        backend = SimulatedBackend(device)
+    pool = DeviceSessionPool(backend=backend)
+    try:
+        device_session = pool.acquire(args.vid, args.pid, args.interface, args.bus, args.address)
+    except DeviceNotFoundError as e:
+        print(f"错误: {str(e)}", file=sys.stderr)
+        return EXIT_DEVICE_NOT_FOUND
+    recorder = SessionRecorder(args.record) if args.record else None
+    received = bytearray()
+    stop = threading.Event()
+    receive_thread = None
+    ep_in = None
+    failed = False
+    try:
+        ep_out = device_session.endpoint(ep_out_address)
+        ep_in = device_session.endpoint(ep_in_address) if ep_in_address is not None else None
+        if ep_out is None or (ep_in_address is not None and ep_in is None):
+            print("错误: 无法找到指定的端点", file=sys.stderr)
+            return EXIT_DEVICE_NOT_FOUND
+        if ep_in is not None:
+            receiver = UsbReceiver(ep_in, received.extend, recorder=recorder)
+            receive_thread = threading.Thread(target=receiver.run, args=(stop.is_set,), name="usb-receiver")
+            receive_thread.start()
+
+        writer = BulkWriter(device_session.device, ep_out)
+        indexes = list(session.select(SESSION_DIR_OUT, source_ep, args.start, args.end))
+        total = sum(session.lengths[i] for i in indexes)
+        print(f"回放 {len(indexes)} 条发送记录 ({format_size(total)}) 到端点 0x{ep_out_address:02x}", file=sys.stderr)
+        wall_start = time.perf_counter()
+        first_time = session.times[indexes[0]] if indexes else 0
+        for index in indexes:
+            record = session.record(index)
+            if not args.fast:
+                delay = (session.times[index] - first_time) / 1e9 / args.speed - (time.perf_counter() - wall_start)
+                if delay > 0:
+                    time.sleep(delay)
+            write_record(writer, record.payload)
+            if recorder is not None:
+                recorder.record(SESSION_DIR_OUT, ep_out_address, record.payload)
+        elapsed = time.perf_counter() - wall_start
+        print(f"回放完成: {elapsed:.3f}s (录制时 {(session.times[indexes[-1]] - first_time) / 1e9 if indexes else 0:.3f}s)",
+              file=sys.stderr)
+    except usb.core.USBError as e:
+        failed = True
+        print(f"错误: {str(e)}", file=sys.stderr)
+        return EXIT_FAILED
+    finally:
+        # 接收线程在停止后继续读出设备已缓存的回复
+        stop.set()
+        if receive_thread is not None:
+            receive_thread.join()
+        if recorder is not None:
+            recorder.close()
+            print(f"回放会话已录制到 {recorder.path} ({recorder.records} 条记录)", file=sys.stderr)
+        pool.release(device_session, failed)
+        pool.close_all()
+
+    if ep_in is not None:
+        print(f"设备回复 {len(received)} 字节", file=sys.stderr)
+    if not args.compare:
+        return EXIT_OK
+    if ep_in is None:
+        print("比较设备回复需要指定 --ep-in", file=sys.stderr)
+        return EXIT_FAILED
+    expected = recorded_replies(session, args.source_in if args.source_in is not None else ep_in_address)
+    if received == expected:
+        print(f"设备回复与录制时一致 ({len(expected)} 字节)")
+        return EXIT_OK
+    mismatch = next((i for i, (a, b) in enumerate(zip(received, expected)) if a != b), min(len(received), len(expected)))
+    print(f"设备回复与录制时不一致: 录制 {len(expected)} 字节，回放 {len(received)} 字节，第一个差异在偏移 {mismatch}")
+    print(f"  录制: {format_hex(expected[mismatch:mismatch + PREVIEW_BYTES])}")
+    print(f"  回放: {format_hex(received[mismatch:mismatch + PREVIEW_BYTES])}")
+    return EXIT_FAILED
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="find-send-replay", description="查看、搜索和回放会话录制文件")
+    parser.add_argument("session", metavar="FILE", help="会话文件(.fss)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("info", help="会话概要：时长、各方向/端点的记录数和字节数")
+
+    def add_filters(sub):
+        sub.add_argument("--dir", dest="direction", type=direction_arg, metavar="{out,in}", default=None,
+                         help="只看发送(out)或接收(in)")
+        sub.add_argument("--ep", dest="endpoint", type=int_auto, default=None, help="只看该端点，如 0x86")
+        sub.add_argument("--index", type=int, default=None, help="从第几条记录开始")
+        sub.add_argument("--limit", type=int, default=50, help="最多输出多少条(默认50)")
+
+    list_parser = commands.add_parser("list", help="按条件列出记录")
+    add_filters(list_parser)
+    list_parser.add_argument("--from", dest="start", type=float, default=None, help="从第几秒开始(相对会话开始)")
+    list_parser.add_argument("--to", dest="end", type=float, default=None, help="到第几秒为止")
+    list_parser.add_argument("--hex", action="store_true", help="输出每条记录的完整十六进制转储")
+
+    search_parser = commands.add_parser("search", help="在记录数据中查找字节序列")
+    search_parser.add_argument("pattern", help="十六进制字节，如 \"41 43 4B 00\"；--text 时为文本")
+    search_parser.add_argument("--text", action="store_true", help="按UTF-8文本查找")
+    add_filters(search_parser)
+
+    replay_parser = commands.add_parser("replay", help="把录制的发送数据回放到设备")
+    replay_parser.add_argument("--vid", type=lambda text: int(text, 16), required=True, help="厂商ID(十六进制)")
+    replay_parser.add_argument("--pid", type=lambda text: int(text, 16), required=True, help="产品ID(十六进制)")
+    replay_parser.add_argument("--interface", type=int, default=0, help="接口号(默认0)")
+    replay_parser.add_argument("--bus", type=int, default=None, help="只连接指定bus上的设备")
+    replay_parser.add_argument("--address", type=int, default=None, help="只连接指定地址的设备")
+    replay_parser.add_argument("--ep-out", type=int_auto, default=None, help="回放到的输出端点(默认与录制时相同)")
+    replay_parser.add_argument("--ep-in", type=int_auto, default=None, help="接收设备回复的输入端点")
+    replay_parser.add_argument("--source-ep", type=int_auto, default=None,
+                               help="回放会话中哪个输出端点的记录(默认第一个)")
+    replay_parser.add_argument("--source-in", type=int_auto, default=None,
+                               help="与会话中哪个输入端点的回复比较(默认与--ep-in相同)")
+    replay_parser.add_argument("--from", dest="start", type=float, default=None, help="从第几秒开始回放")
+    replay_parser.add_argument("--to", dest="end", type=float, default=None, help="回放到第几秒为止")
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="按录制节奏的倍速回放(默认1)")
+    replay_parser.add_argument("--fast", action="store_true", help="不按录制节奏，尽快回放")
+    replay_parser.add_argument("--compare", action="store_true", help="与录制时设备的回复比较，不一致时退出码1")
+    replay_parser.add_argument("--record", metavar="PATH", default=None, help="把回放过程也录制为会话文件")
+    replay_parser.add_argument("--simulate", action="store_true", help="回放到模拟设备(不需要硬件)")
+    replay_parser.add_argument("--response", choices=("none", "echo", "ack"), default="echo",
+                               help="模拟设备的回复方式(默认echo)")
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command == "replay" and args.speed <= 0:
+        parser.error("--speed 必须大于0")
+    try:
+        session = SessionFile(args.session)
+    except (OSError, ValueError) as e:
+        print(f"错误: {str(e)}", file=sys.stderr)
+        return EXIT_FILE_ERROR
+    handlers = {"info": cmd_info, "list": cmd_list, "search": cmd_search, "replay": cmd_replay}
+    try:
+        with session:
+            return handlers[args.command](session, args)
+    except BrokenPipeError:
+        # 输出被 head 等提前关闭
+        return EXIT_OK
+    except KeyboardInterrupt:
+        return 130
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,408 @@
+'''
+ 模拟USB后端：实现pyusb的后端接口(usb.backend.IBackend)，没有硬件时代替真实设备，
+ usb.core.find(backend=...)返回的设备对象和端点write/read与真实设备用法完全相同
+'''
+import zlib
+import errno
+import hashlib
+import struct
+import collections
+import random
+import threading
+import time
+import usb.core
+import usb.backend
+
+from find_send_engine import (ACK_MAGIC, ACK_FORMAT, DELTA_MAGIC, DELTA_HEADER_SIZE, DELTA_BEGIN_FORMAT,
+                              DELTA_END_FORMAT, DELTA_FRAME_BEGIN, DELTA_FRAME_DATA, DELTA_FRAME_END,
+                              DELTA_FRAME_STATUS, DELTA_FLAG_FULL, DELTA_STATUS_FORMAT, DELTA_STATUS_APPLIED,
+                              DELTA_STATUS_BASE_MISMATCH, DELTA_STATUS_CRC_MISMATCH, pack_delta_header, VERIFY_MAGIC, VERIFY_REQUEST_FORMAT, DIGEST_MAGIC,
+                              DIGEST_REPORT_FORMAT, parse_delta_header)
+
+# 设备对发送数据的响应方式
+RESPONSE_NONE = "none"    # 只接收不回复
+RESPONSE_ECHO = "echo"    # 原样回传收到的数据
+RESPONSE_ACK = "ack"      # 每次批量写入回复一个确认包(格式见引擎的ACK_FORMAT)
+
+USB_ENDPOINT_TYPE_BULK = 2
+
+
+class _Descriptor:
+    """按关键字参数构造的描述符对象，pyusb只按属性名读取"""
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+def usb_timeout_error(message="Operation timed out"):
+    """构造与libusb1后端一致的超时异常(旧版pyusb没有USBTimeoutError时退回USBError)"""
+    error_class = getattr(usb.core, 'USBTimeoutError', usb.core.USBError)
+    return error_class(message, error_code=-7, errno=errno.ETIMEDOUT)
+
+
+def usb_no_device_error(message="No such device (it may have been disconnected)"):
+    """构造与libusb1后端一致的设备断开异常"""
+    return usb.core.USBError(message, error_code=-4, errno=errno.ENODEV)
+
+
+class SimulatedDevice:
+    """模拟设备：一个接口、一个批量OUT端点和一个批量IN端点
+
+    bandwidth      总线带宽(字节/秒)，None表示不限速
+    latency        每次传输的固定开销(秒)
+    timeout_rate   写入随机超时(模拟NAK反压)的概率
+    partial_timeouts  超时前先接收随机个整包(与真实设备一样，超时的批量写入可能已部分发送)
+    response       对写入数据的响应：RESPONSE_NONE/RESPONSE_ECHO/RESPONSE_ACK
+    keep_data      保留收到的全部数据(用于校验)，默认只计数
+    disconnect_at  模拟断开：累计收到的字节数达到这些值时，那次写入失败并丢弃数据
+    process_rate   设备处理数据的速度(字节/秒)，None表示收到即处理；处理完一次写入后才回复
+    fifo_size      设备接收缓冲区大小(字节)，缓冲区满时写入阻塞，超过写入超时则报超时(NAK)
+    delta_image    按差量帧格式解析收到的数据并维护设备上的镜像(image/image_tag)，每个END回复STATUS帧，用于验证差量发送
+    verify         响应校验请求(见引擎的VERIFY_*常量)：回复上一次请求之后收到的数据的CRC32和SHA-256
+    """
+
+    def __init__(self, vid=0x0483, pid=0x8004, bus=1, address=1, interface=0, ep_out=0x06, ep_in=0x86,
+                 max_packet_size=512, bandwidth=None, latency=0.0, timeout_rate=0.0,
+                 response=RESPONSE_NONE, keep_data=False, seed=None, disconnect_at=(),
+                 process_rate=None, fifo_size=64 * 1024, delta_image=False, verify=False,
+                 partial_timeouts=False):
+        self.vid = vid
+        self.pid = pid
+        self.bus = bus
+        self.address = address
+        self.interface = interface
+        self.ep_out = ep_out
+        self.ep_in = ep_in
+        self.max_packet_size = max_packet_size
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.timeout_rate = timeout_rate
+        self.partial_timeouts = partial_timeouts
+        self.response = response
+        self.received = bytearray() if keep_data else None
+        self.bytes_received = 0
+        self.write_count = 0
+        self.timeout_count = 0
+        self.disconnect_at = sorted(disconnect_at)
+        self.disconnect_count = 0
+        self.process_rate = process_rate
+        self.fifo_size = fifo_size
+        self.claimed = set()
+        self._pending = bytearray()     # 等待主机从IN端点读取的数据
+        self._fifo = collections.deque()  # 设备缓冲区中待处理的写入: (处理完成时间, 长度, 回复)
+        self._fifo_level = 0
+        self._process_until = 0.0
+        self.delta_image = delta_image
+        self.image = bytearray()        # 设备当前镜像(最近一次校验通过的)
+        self.image_tag = 0
+        self.images_completed = 0
+        self.frame_errors = 0
+        self._frames = bytearray()      # 尚未凑成完整帧的数据
+        self._work = None               # 正在更新的镜像副本，None表示丢弃到下一个BEGIN
+        self._discarding = False        # 当前帧流因基础镜像不符被丢弃，END时回复BASE_MISMATCH
+        self._target = None             # (新镜像大小, 新镜像标签, 是否完整发送)
+        self.verify = verify
+        self._verify_data = bytearray()  # 上一次校验请求之后收到的数据
+        self._cond = threading.Condition()
+        self._busy_until = 0.0
+        self._random = random.Random(seed)
+
+    def _occupy_bus(self, length):
+        """按带宽和延迟占用总线，返回时本次传输已完成"""
+        if self.bandwidth is None and not self.latency:
+            return
+        cost = self.latency + (length / self.bandwidth if self.bandwidth else 0.0)
+        now = time.perf_counter()
+        self._busy_until = max(now, self._busy_until) + cost
+        delay = self._busy_until - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def _process(self, now):
+        """把已处理完的写入移出设备缓冲区，回复放入IN端点待读数据(调用时已持有_cond)"""
+        while self._fifo and self._fifo[0][0] <= now:
+            _, length, reply = self._fifo.popleft()
+            self._fifo_level -= length
+            if reply:
+                self._pending += reply
+                self._cond.notify_all()
+
+    def _wait_time(self, now, deadline):
+        """等待到截止时间或下一个写入处理完成，返回False表示已超时"""
+        remaining = deadline - now
+        if remaining <= 0:
+            return False
+        if self._fifo:
+            remaining = min(remaining, max(self._fifo[0][0] - now, 0.0))
+        self._cond.wait(remaining)
+        return True
+
+    def _enqueue(self, length, reply, timeout):
+        """按处理速度排队；缓冲区放不下时等待设备处理，超过写入超时报超时"""
+        deadline = time.monotonic() + (timeout or 1000) / 1000.0
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._process(now)
+                if self._fifo_level + length <= max(self.fifo_size, length):
+                    break
+                if not self._wait_time(now, deadline):
+                    self.timeout_count += 1
+                    raise usb_timeout_error()
+            self._process_until = max(now, self._process_until) + length / self.process_rate
+            self._fifo.append((self._process_until, length, reply))
+            self._fifo_level += length
+            # 唤醒正在等待回复的读取，按新的处理完成时间重新计算等待
+            self._cond.notify_all()
+
+    def write(self, endpoint, data, timeout):
+        """与pyusb后端一致：超时时抛出异常，不返回超时前已接收的字节数"""
+        written, error = self.write_partial(endpoint, data, timeout)
+        if error is not None:
+            raise error
+        return written
+
+    def write_partial(self, endpoint, data, timeout):
+        """写入数据，返回(已接收的字节数, 超时异常或None)"""
+        if endpoint != self.ep_out:
+            raise usb.core.USBError("Invalid endpoint", error_code=-2, errno=errno.EINVAL)
+        timed_out = self.timeout_rate and self._random.random() < self.timeout_rate
+        accepted = len(data)
+        if timed_out:
+            self.timeout_count += 1
+            accepted = 0
+            if self.partial_timeouts and len(data) > self.max_packet_size:
+                accepted = self._random.randrange(len(data) // self.max_packet_size) * self.max_packet_size
+        try:
+            if accepted or not timed_out:
+                self._accept(data if accepted == len(data) else memoryview(data)[:accepted], timeout)
+            else:
+                self._occupy_bus(0)
+        except usb.core.USBError as e:
+            # 设备缓冲区已满：整块都没有被接收
+            if e.errno != errno.ETIMEDOUT:
+                raise
+            return 0, e
+        return accepted, usb_timeout_error() if timed_out else None
+
+    def _accept(self, data, timeout):
+        length = len(data)
+        if self.disconnect_at and self.bytes_received + length > self.disconnect_at[0]:
+            self.disconnect_at.pop(0)
+            self.disconnect_count += 1
+            raise usb_no_device_error()
+        reply = None
+        if self.response != RESPONSE_NONE:
+            # 延后回复时数据缓冲区会被主机复用，需要拷贝
+            echo = bytes(data) if self.process_rate else data
+            reply = echo if self.response == RESPONSE_ECHO else struct.pack(ACK_FORMAT, ACK_MAGIC, length)
+        if self.verify:
+            report = self._verify(data)
+            if report is not None:
+                reply = (bytes(reply) if reply is not None else b'') + report
+        if self.process_rate:
+            self._enqueue(length, reply, timeout)
+        self._occupy_bus(length)
+        self.write_count += 1
+        self.bytes_received += length
+        if self.received is not None:
+            self.received += data
+        if self.delta_image:
+            status = self._apply_frames(data)
+            if status:
+                with self._cond:
+                    self._pending += status
+                    self._cond.notify_all()
+        if reply is not None and not self.process_rate:
+            with self._cond:
+                self._pending += reply
+                self._cond.notify_all()
+        return length
+
+    def _verify(self, data):
+        """校验请求返回摘要回复，其他写入记入待校验数据"""
+        if len(data) == struct.calcsize(VERIFY_REQUEST_FORMAT) and bytes(data[:len(VERIFY_MAGIC)]) == VERIFY_MAGIC:
+            _, length = struct.unpack(VERIFY_REQUEST_FORMAT, data)
+            received = bytes(self._verify_data[:length])
+            self._verify_data = bytearray()
+            return struct.pack(DIGEST_REPORT_FORMAT, DIGEST_MAGIC, len(received), zlib.crc32(received),
+                               hashlib.sha256(received).digest())
+        self._verify_data += data
+        return None
+
+    def _apply_frames(self, data):
+        """按差量帧格式(见引擎的DELTA_*常量)解析收到的数据，帧不完整时等待后续写入；返回要回复的STATUS帧"""
+        status = bytearray()
+        buf = self._frames
+        buf += data
+        pos = 0
+        while len(buf) - pos >= DELTA_HEADER_SIZE:
+            try:
+                frame_type, flags, length, offset = parse_delta_header(buf, pos)
+            except ValueError:
+                # END之后的补零或错位数据：跳到下一个帧头标识
+                index = buf.find(DELTA_MAGIC, pos + 1)
+                pos = index if index >= 0 else len(buf) - len(DELTA_MAGIC) + 1
+                continue
+            if len(buf) - pos < DELTA_HEADER_SIZE + length:
+                break
+            payload = bytes(buf[pos + DELTA_HEADER_SIZE:pos + DELTA_HEADER_SIZE + length])
+            pos += DELTA_HEADER_SIZE + length
+            result = self._apply_frame(frame_type, flags, offset, payload)
+            if result is not None:
+                status += pack_delta_header(DELTA_FRAME_STATUS, len(self.image), struct.calcsize(DELTA_STATUS_FORMAT),
+                                            result) + struct.pack(DELTA_STATUS_FORMAT, self.image_tag)
+        del buf[:pos]
+        return status
+
+    def _apply_frame(self, frame_type, flags, offset, payload):
+        """应用一个帧；END帧返回STATUS结果，其它帧返回None"""
+        if frame_type == DELTA_FRAME_BEGIN:
+            base_tag, tag = struct.unpack(DELTA_BEGIN_FORMAT, payload)
+            full = bool(flags & DELTA_FLAG_FULL)
+            if not full and base_tag != self.image_tag:
+                # 设备上不是差量的基础镜像
+                self.frame_errors += 1
+                self._work = None
+                self._discarding = True
+                return None
+            self._work = bytearray() if full else bytearray(self.image)
+            self._target = (offset, tag)
+            self._discarding = False
+        elif self._work is None:
+            if frame_type == DELTA_FRAME_END and self._discarding:
+                self._discarding = False
+                return DELTA_STATUS_BASE_MISMATCH
+            return None
+        elif frame_type == DELTA_FRAME_DATA:
+            end = offset + len(payload)
+            if len(self._work) < end:
+                self._work += bytes(end - len(self._work))
+            self._work[offset:end] = payload
+        elif frame_type == DELTA_FRAME_END:
+            size, tag = self._target
+            del self._work[size:]
+            self._work += bytes(size - len(self._work))
+            result = DELTA_STATUS_APPLIED
+            if zlib.crc32(self._work) == struct.unpack(DELTA_END_FORMAT, payload)[0]:
+                self.image, self.image_tag = self._work, tag
+                self.images_completed += 1
+            else:
+                self.frame_errors += 1
+                result = DELTA_STATUS_CRC_MISMATCH
+            self._work = None
+            return result
+        return None
+
+    def read(self, endpoint, buff, timeout):
+        if endpoint != self.ep_in:
+            raise usb.core.USBError("Invalid endpoint", error_code=-2, errno=errno.EINVAL)
+        deadline = time.monotonic() + (timeout or 1000) / 1000.0
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._process(now)
+                if self._pending:
+                    break
+                if not self._wait_time(now, deadline):
+                    raise usb_timeout_error()
+            length = min(len(buff), len(self._pending))
+            memoryview(buff)[:length] = self._pending[:length]
+            del self._pending[:length]
+        return length
+
+    def device_descriptor(self):
+        return _Descriptor(bLength=18, bDescriptorType=1, bcdUSB=0x0200, bDeviceClass=0, bDeviceSubClass=0,
+                           bDeviceProtocol=0, bMaxPacketSize0=64, idVendor=self.vid, idProduct=self.pid,
+                           bcdDevice=0x0100, iManufacturer=0, iProduct=0, iSerialNumber=0, bNumConfigurations=1,
+                           address=self.address, bus=self.bus, port_number=1, port_numbers=(1,), speed=3)
+
+    def configuration_descriptor(self):
+        return _Descriptor(bLength=9, bDescriptorType=2, wTotalLength=32, bNumInterfaces=1,
+                           bConfigurationValue=1, iConfiguration=0, bmAttributes=0x80, bMaxPower=50,
+                           extra_descriptors=[])
+
+    def interface_descriptor(self):
+        return _Descriptor(bLength=9, bDescriptorType=4, bInterfaceNumber=self.interface, bAlternateSetting=0,
+                           bNumEndpoints=2, bInterfaceClass=0xFF, bInterfaceSubClass=0, bInterfaceProtocol=0,
+                           iInterface=0, extra_descriptors=[])
+
+    def endpoint_descriptor(self, index):
+        address = (self.ep_out, self.ep_in)[index]
+        return _Descriptor(bLength=7, bDescriptorType=5, bEndpointAddress=address,
+                           bmAttributes=USB_ENDPOINT_TYPE_BULK, wMaxPacketSize=self.max_packet_size,
+                           bInterval=0, bRefresh=0, bSynchAddress=0, extra_descriptors=[])
+
+
+class SimulatedBackend(usb.backend.IBackend):
+    """pyusb后端：枚举并操作若干SimulatedDevice，用法 usb.core.find(backend=SimulatedBackend(dev))"""
+
+    def __init__(self, *devices):
+        self.devices = list(devices)
+
+    def enumerate_devices(self):
+        return iter(list(self.devices))
+
+    def get_device_descriptor(self, dev):
+        return dev.device_descriptor()
+
+    def get_configuration_descriptor(self, dev, config):
+        if config != 0:
+            raise IndexError("配置不存在")
+        return dev.configuration_descriptor()
+
+    def get_interface_descriptor(self, dev, intf, alt, config):
+        if (intf, alt, config) != (0, 0, 0):
+            raise IndexError("接口不存在")
+        return dev.interface_descriptor()
+
+    def get_endpoint_descriptor(self, dev, ep, intf, alt, config):
+        if (intf, alt, config) != (0, 0, 0) or ep not in (0, 1):
+            raise IndexError("端点不存在")
+        return dev.endpoint_descriptor(ep)
+
+    def open_device(self, dev):
+        return dev
+
+    def close_device(self, dev_handle):
+        dev_handle.claimed.clear()
+
+    def set_configuration(self, dev_handle, config_value):
+        pass
+
+    def get_configuration(self, dev_handle):
+        return 1
+
+    def set_interface_altsetting(self, dev_handle, intf, altsetting):
+        pass
+
+    def claim_interface(self, dev_handle, intf):
+        dev_handle.claimed.add(intf)
+
+    def release_interface(self, dev_handle, intf):
+        dev_handle.claimed.discard(intf)
+
+    def bulk_write(self, dev_handle, ep, intf, data, timeout):
+        return dev_handle.write(ep, data, timeout)
+
+    def bulk_write_partial(self, dev_handle, ep, intf, data, timeout):
+        # pyusb后端接口之外的扩展：超时时同时返回已接收的字节数(见引擎的BulkWriter)
+        return dev_handle.write_partial(ep, data, timeout)
+
+    def bulk_read(self, dev_handle, ep, intf, buff, timeout):
+        return dev_handle.read(ep, buff, timeout)
+
+    def clear_halt(self, dev_handle, ep):
+        pass
+
+    def reset_device(self, dev_handle):
+        pass
+
+    def is_kernel_driver_active(self, dev_handle, intf):
+        return False
+
+    def detach_kernel_driver(self, dev_handle, intf):
+        pass
+
+    def attach_kernel_driver(self, dev_handle, intf):
+        pass